@@ -0,0 +1,159 @@
+"""Time each processing stage on the bundled recordings
+
+Usage:
+    python benchmarks/run_benchmarks.py [-o results.json] [--baseline old.json] [--threshold 0.1]
+
+Every stage is run --repeat times on each recording in test/data, and the
+minimum and median wall times are reported. With --baseline, the run is
+compared against a saved results file, and the command exits with status 1 if
+any stage is slower than the baseline by more than the threshold.
+"""
+import contextlib
+import datetime
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import click
+from tabulate import tabulate
+
+import janissary
+import janissary.body
+import janissary.reports
+from janissary.reports.actions_rate_report import ActionsRateReport
+from janissary.reports.command_summary_report import CommandSummaryReport
+from janissary.reports.unit_production_report import UnitProductionReport
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "test", "data")
+
+# Differences smaller than this are treated as noise when comparing runs
+MIN_SIGNIFICANT_SECONDS = 0.002
+
+def stages(path):
+    """Return a list of (stage name, function) for a recording
+
+    Each function runs one stage from scratch; its inputs are prepared here,
+    outside of the timed region.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    def recorded_game():
+        return janissary.RecordedGame(io.BytesIO(data))
+
+    rec = recorded_game()
+    header_dict = rec.header().header_dict()
+    commands = janissary.body.timestamped_commands(rec.body_reader())
+
+    def body_parser():
+        for _ in janissary.BodyParser(recorded_game().body_reader()):
+            pass
+
+    return [
+        ("header_inflate", lambda: recorded_game().header_bytes()),
+        ("header_dict", lambda: recorded_game().header().header_dict()),
+        ("body_parser", body_parser),
+        ("timestamped_commands", lambda: janissary.body.timestamped_commands(recorded_game().body_reader())),
+        ("CommandSummaryReport", lambda: CommandSummaryReport(header_dict, commands).serializeable()),
+        ("UnitProductionReport", lambda: UnitProductionReport(header_dict, commands).serializeable()),
+        ("ActionsRateReport", lambda: ActionsRateReport(header_dict, commands).serializeable()),
+        ("report", lambda: janissary.reports.report(header_dict, commands)),
+        ("render_html", lambda: janissary.reports.render_html(header_dict, commands)),
+    ]
+
+def time_stage(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times)}
+
+def run(paths, repeat):
+    results = {}
+    for path in paths:
+        name = os.path.basename(path)
+        results[name] = {}
+        # The parsers print debug information, which is only noise here
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                recording_stages = stages(path)
+            except Exception as e:
+                results[name]['setup'] = {'error': "%s: %s" % (type(e).__name__, e)}
+                continue
+            for stage, func in recording_stages:
+                try:
+                    results[name][stage] = time_stage(func, repeat)
+                except Exception as e:
+                    results[name][stage] = {'error': "%s: %s" % (type(e).__name__, e)}
+    return results
+
+def compare(results, baseline, threshold):
+    """Compare minimum times against a baseline
+
+    Returns table rows, and the number of stages slower than the baseline by
+    more than threshold (a fraction)
+    """
+    rows = []
+    regressions = 0
+    for recording, recording_stages in results.items():
+        for stage, r in recording_stages.items():
+            base = baseline.get(recording, {}).get(stage)
+            if base is None or 'min' not in base or 'min' not in r:
+                continue
+            ratio = r['min'] / base['min'] if base['min'] > 0 else float('inf')
+            regressed = ratio > 1 + threshold and r['min'] - base['min'] > MIN_SIGNIFICANT_SECONDS
+            if regressed:
+                regressions += 1
+            rows.append((recording, stage, "%.4f" % base['min'], "%.4f" % r['min'],
+                "%.2fx" % ratio, "REGRESSION" if regressed else ""))
+    return rows, regressions
+
+@click.command()
+@click.option('--output', '-o', default=None, help="Write results as JSON to this file")
+@click.option('--baseline', '-b', default=None, help="Compare against results saved by a previous run")
+@click.option('--threshold', default=0.10, show_default=True, help="Allowed slowdown against the baseline, as a fraction")
+@click.option('--repeat', '-r', default=5, show_default=True, help="Number of times each stage is run")
+@click.option('--recording', 'recordings', multiple=True, help="Recording to use (default: all bundled recordings)")
+def main(output, baseline, threshold, repeat, recordings):
+    paths = list(recordings) or sorted(glob.glob(os.path.join(DATA_DIR, "*.aoe2record")))
+    results = run(paths, repeat)
+
+    rows = []
+    for recording, recording_stages in results.items():
+        for stage, r in recording_stages.items():
+            if 'error' in r:
+                rows.append((recording, stage, "", "", r['error']))
+            else:
+                rows.append((recording, stage, "%.4f" % r['min'], "%.4f" % r['median'], ""))
+    print(tabulate(rows, headers=["Recording", "Stage", "Min (s)", "Median (s)", "Error"]))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'date': datetime.datetime.now().isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'repeat': repeat,
+                },
+                'results': results,
+            }, f, indent=2)
+
+    if baseline is not None:
+        with open(baseline) as f:
+            baseline_results = json.load(f)['results']
+        rows, regressions = compare(results, baseline_results, threshold)
+        print("")
+        print(tabulate(rows, headers=["Recording", "Stage", "Baseline (s)", "Current (s)", "Ratio", ""]))
+        if regressions:
+            print("\n%d stage(s) slower than the baseline by more than %d%%" % (regressions, threshold * 100))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
 from .recorded_game import RecordedGame
 from .utils import BinReader
 from .body import BodyParser, Sync, Chat, GameStart, Command
+from .command_table import CommandTable
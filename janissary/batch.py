@@ -0,0 +1,177 @@
+import concurrent.futures
+import contextlib
+import glob
+import io
+import os
+import time
+
+import janissary.reports
+from .body import feed_commands
+from .cache import load_game
+from .profiling import stage
+from .recorded_game import RecordedGame
+
+DEFAULT_PATTERN = "*.aoe2record"
+
+def find_recordings(paths, pattern=DEFAULT_PATTERN):
+    """Expand a list of directories, files and glob patterns into recording files
+
+    Directories are searched recursively for files matching pattern. Anything
+    else is treated as a glob. Returns a sorted list without duplicates.
+    """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            found.update(glob.glob(os.path.join(path, "**", pattern), recursive=True))
+        else:
+            found.update(p for p in glob.glob(path, recursive=True) if os.path.isfile(p))
+    return sorted(found)
+
+def report_in_one_pass(gamefile, keep_commands=True):
+    """Parse a recording, computing its reports in a single pass over the body
+
+    Returns (header_dict, timestamped_commands, consumers), where consumers are
+    the finalized reports from `janissary.reports.report_consumers`, and
+    timestamped_commands is None unless keep_commands is set.
+    """
+    with stage("load"):
+        with open(gamefile, 'rb') as f:
+            rec = RecordedGame(f)
+            with stage("header"):
+                header_dict = rec.header().header_dict()
+            consumers = janissary.reports.report_consumers(header_dict)
+            with stage("body"), rec.body_reader() as body_reader:
+                timestamped_commands = feed_commands(body_reader,
+                    [consumer for _, consumer in consumers], keep_commands)
+    return header_dict, timestamped_commands, consumers
+
+def write_report(gamefile, outputfile, json_output=False, cache=None, compact=False, bytes_encoding=None,
+        include_commands=True, parse_workers=None):
+    """Parse a recording and write its HTML (or JSON) report to outputfile
+
+    If a ParseCache is given, the parsed recording is taken from or stored in it.
+    If parse_workers is given, the body is decoded across that many processes
+    (see `janissary.parallel`). Otherwise the reports are computed in a single
+    pass over the body. compact and bytes_encoding select the layout of the
+    commands, as for `janissary.reports.report()`. If include_commands is
+    False, the commands are left out of the report.
+    """
+    if cache is None and parse_workers is None:
+        header_dict, timestamped_commands, consumers = report_in_one_pass(gamefile, include_commands)
+    else:
+        header_dict, timestamped_commands = load_game(gamefile, cache, parse_workers)
+        consumers = None
+        if not include_commands:
+            consumers = janissary.reports.consume_commands(
+                janissary.reports.report_consumers(header_dict), timestamped_commands)
+            timestamped_commands = None
+
+    if json_output:
+        with open(outputfile, 'w') as f:
+            janissary.reports.write_report_json(f, header_dict, timestamped_commands, compact, bytes_encoding,
+                consumers)
+    else:
+        with open(outputfile, 'w') as f:
+            janissary.reports.write_html(f, header_dict, timestamped_commands, compact, bytes_encoding,
+                consumers)
+
+class BatchResult(object):
+    """Outcome of reporting on one recording in a batch
+    """
+    def __init__(self, gamefile, outputfile, size, elapsed, error=None):
+        self.gamefile = gamefile
+        self.outputfile = outputfile
+        self.size = size
+        self.elapsed = elapsed
+        self.error = error
+
+    def ok(self):
+        return self.error is None
+
+def describe_error(e):
+    message = str(e)
+    if message:
+        return "%s: %s" % (type(e).__name__, message)
+    return type(e).__name__
+
+def quiet_call(fn, *args, **kwargs):
+    """Call fn(*args, **kwargs) for a worker process, returning (result, error) and never raising
+
+    The parsers print debug information, which is only noise in a worker, so
+    stdout is discarded. If fn raises, result is None and error describes the
+    exception (see `describe_error`); otherwise error is None.
+    """
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn(*args, **kwargs), None
+    except Exception as e:
+        return None, describe_error(e)
+
+def report_worker(gamefile, outputfile, json_output, cache=None, parse_workers=None):
+    """Worker process entry point: report on one file, never raising
+    """
+    start = time.perf_counter()
+    size, error = quiet_call(os.path.getsize, gamefile)
+    if error is None:
+        _, error = quiet_call(write_report, gamefile, outputfile, json_output, cache,
+            parse_workers=parse_workers)
+    return BatchResult(gamefile, outputfile, size or 0, time.perf_counter() - start, error)
+
+def output_paths(gamefiles, output_dir, extension):
+    """Choose an output file in output_dir for each recording
+
+    Files are named after the recording; recordings with the same name (from
+    different directories) get a numeric suffix.
+    """
+    used = set()
+    paths = []
+    for gamefile in gamefiles:
+        stem = os.path.splitext(os.path.basename(gamefile))[0]
+        name = stem + extension
+        counter = 1
+        while name in used:
+            name = "%s-%d%s" % (stem, counter, extension)
+            counter += 1
+        used.add(name)
+        paths.append(os.path.join(output_dir, name))
+    return paths
+
+def run_batch(gamefiles, output_dir, json_output=False, workers=None, callback=None, cache=None,
+        parse_workers=None):
+    """Write reports for many recordings across a process pool
+
+    Arguments:
+        gamefiles - List of recording paths
+        output_dir - Directory the reports are written to (created if needed)
+        json_output - Write JSON instead of HTML reports
+        workers - Number of worker processes (default: one per CPU)
+        callback - Optionally called with each BatchResult as it completes
+        cache - Optional ParseCache shared by the workers
+        parse_workers - If given, each worker decodes long bodies across that
+        many more processes (see `janissary.parallel`)
+    Returns:
+        results, elapsed - A list of BatchResult, in completion order, and the
+        total wall time in seconds
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    extension = ".json" if json_output else ".html"
+    outputfiles = output_paths(gamefiles, output_dir, extension)
+
+    start = time.perf_counter()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(report_worker, g, o, json_output, cache, parse_workers): (g, o)
+            for g, o in zip(gamefiles, outputfiles)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. out of memory)
+                gamefile, outputfile = futures[future]
+                result = BatchResult(gamefile, outputfile, 0, 0.0, describe_error(e))
+            results.append(result)
+            if callback is not None:
+                callback(result)
+    return results, time.perf_counter() - start
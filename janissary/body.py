@@ -1,26 +1,68 @@
-from .utils import EndOfData, BinReader
+import functools
+import itertools
+
+from .utils import EndOfData, get_struct
 from .static import command_name
+from .profiling import stage
+
+# Op types of the body
+OP_COMMAND = 1
+OP_SYNC = 2
+OP_CHAT = 4
 
 class Command(object):
-    def __init__(self, command_type, command_data, unknown1):
+    __slots__ = ('type', 'data', 'unknown1', 'offset')
+
+    # Length of the data, and its first byte (the command type)
+    HEAD = get_struct("LB")
+
+    def __init__(self, command_type, command_data, unknown1, offset=None):
         self.type = command_type
         self.data = command_data
         self.unknown1 = unknown1
+        # Position of command_data in the body
+        self.offset = offset
 
     @staticmethod
     def parse(io):
         """Consume a command from the io object
         """
         length = io.read_u32()
+        offset = io.tell()
         data = io.read(length)
         unknown = io.read_u32()
         # First word of data is the command type
         # Note that it is left in the data attribute of the
         # command object
-        command_type = BinReader.from_bytes(data).read_u8()
-        return Command(command_type, data, unknown)
+        if len(data) < 1:
+            raise EndOfData
+        command_type = data[0]
+        return Command(command_type, data, unknown, offset)
+
+    @staticmethod
+    def parse_if(io, command_types):
+        """Consume a command, returning it only if its type is in command_types
+
+        Other commands are skipped without reading their data, and None is
+        returned.
+        """
+        offset = io.tell()
+        length, command_type = io.read_struct(Command.HEAD)
+        if length < 1:
+            raise EndOfData
+        if command_type in command_types:
+            io.seek(offset)
+            return Command.parse(io)
+        # The rest of the data, and the unknown word
+        io.skip(length + 3)
+        return None
 
 class Sync(object):
+    __slots__ = ('time_delta', 'view_x', 'view_y', 'player_index')
+
+    # Time delta and the unknown word which tells the length of the op
+    HEAD = get_struct("iL")
+
     def __init__(self, time, view_x, view_y, player_index):
         self.time_delta = time
         self.view_x = view_x
@@ -35,17 +77,30 @@ class Sync(object):
         # unknown
         unknown1 = io.read_u32()
         if unknown1 == 0:
-            io.read(28)
+            io.read_exact(28)
         view_x = io.read_float()
         view_y = io.read_float()
         player_index = io.read_u32()
         return Sync(time_delta, view_x, view_y, player_index)
 
+    @staticmethod
+    def skip(io):
+        """Consume a Sync operation, returning only its time delta
+        """
+        time_delta, unknown1 = io.read_struct(Sync.HEAD)
+        # The optional unknown block, the view position and player index
+        io.skip(40 if unknown1 == 0 else 12)
+        return time_delta
+
 class GameStart(object):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
 class Chat(object):
+    __slots__ = ('message',)
+
     def __init__(self, message):
         self.message = message
 
@@ -56,33 +111,65 @@ class Chat(object):
         # a GameStart message, not a chat message. The first four bytes are a
         # command that distinguishes
         if command == 0x1F4:
-            io.read(20) # unknown meaning
+            io.read_exact(20) # unknown meaning
             return GameStart()
         if command != 0xFFFFFFFF:
             raise RuntimeError("Got unexpected chat command %x" % command)
 
         length = io.read_u32()
-        message = io.read(length)
+        message = io.read_exact(length)
         return Chat(message)
 
+    @staticmethod
+    def skip(io):
+        """Consume a Chat (or GameStart) operation without decoding it
+        """
+        command = io.read_u32()
+        if command == 0x1F4:
+            io.skip(20)
+        elif command == 0xFFFFFFFF:
+            io.skip(io.read_u32())
+        else:
+            raise RuntimeError("Got unexpected chat command %x" % command)
+
 class BodyParser(object):
     """Provide iterator to iterate over the operations stored in the log body
+
+    The ops returned can be limited to some op types (OP_COMMAND, OP_SYNC,
+    OP_CHAT) and command types. Other ops are skipped over, without being
+    decoded or copied; the time deltas of skipped syncs still count towards
+    `time`.
     """
-    def __init__(self, bin_reader):
+    def __init__(self, bin_reader, start=0, op_types=None, command_types=None):
+        """start optionally gives the body offset of the first op to read
+
+        op_types and command_types optionally give the sets of op types and
+        command types to return.
+        """
         self._io = bin_reader
+        self._start = start
+        self._op_types = op_types
+        self._command_types = command_types
+        # Total of the time deltas of the syncs read from start
+        self.time = 0
 
     def __iter__(self):
-        self._io.seek(0)
+        self._io.seek(self._start)
+        self.time = 0
         return self
 
     def __next__(self):
+        if self._op_types is not None or self._command_types is not None:
+            return self._next_filtered()
         try:
             op_type = self._io.read_u32()
-            if op_type == 1:
+            if op_type == OP_COMMAND:
                 return Command.parse(self._io)
-            elif op_type == 2:
-                return Sync.parse(self._io)
-            elif op_type == 4:
+            elif op_type == OP_SYNC:
+                op = Sync.parse(self._io)
+                self.time += op.time_delta
+                return op
+            elif op_type == OP_CHAT:
                 return Chat.parse(self._io)
             else:
                 raise RuntimeError("Unknown op type %d" % op_type)
@@ -90,17 +177,137 @@ class BodyParser(object):
         except EndOfData:
             raise StopIteration
 
+    def frames(self):
+        """Iterate over the ops without decoding them
+
+        Yields the body offset and op type of each op. While an op is
+        yielded, `time` is the time at its start.
+        """
+        io = self._io
+        io.seek(self._start)
+        self.time = 0
+        try:
+            while True:
+                offset = io.tell()
+                op_type = io.read_u32()
+                yield offset, op_type
+                if op_type == OP_COMMAND:
+                    Command.parse_if(io, ())
+                elif op_type == OP_SYNC:
+                    self.time += Sync.skip(io)
+                elif op_type == OP_CHAT:
+                    Chat.skip(io)
+                else:
+                    raise RuntimeError("Unknown op type %d" % op_type)
+        except EndOfData:
+            return
+
+    def _next_filtered(self):
+        io = self._io
+        op_types = self._op_types
+        command_types = self._command_types
+        try:
+            while True:
+                op_type = io.read_u32()
+                wanted = op_types is None or op_type in op_types
+                if op_type == OP_COMMAND:
+                    if not wanted:
+                        Command.parse_if(io, ())
+                    elif command_types is None:
+                        return Command.parse(io)
+                    else:
+                        op = Command.parse_if(io, command_types)
+                        if op is not None:
+                            return op
+                elif op_type == OP_SYNC:
+                    if wanted:
+                        op = Sync.parse(io)
+                        self.time += op.time_delta
+                        return op
+                    self.time += Sync.skip(io)
+                elif op_type == OP_CHAT:
+                    if wanted:
+                        return Chat.parse(io)
+                    Chat.skip(io)
+                else:
+                    raise RuntimeError("Unknown op type %d" % op_type)
+
+        except EndOfData:
+            raise StopIteration
+
 class GameContext(object):
     """A context object for command parsers
 
     Sometimes parsing a command depends on previous commands. This object is
     used by all parsers to share a common state
+
+    Objects selected together must be owned by the same player, so besides
+    the owner of each object that we are told about, it keeps disjoint sets
+    (union-find) of the objects known to share an owner. Once the owner of any
+    object in a group is known, it applies to the whole group, and the player
+    lookups waiting on the group are resolved. The owner we are told about for
+    an object itself always takes precedence over its group's: a lookup
+    resolved through the group is checked again at the end of the log.
+    Selections reused from a previous command (a count of 0xFF) are never
+    grouped.
+
+    If keep_history is set, every change to the objects and groups is also
+    appended to a ContextHistory, so that checkpoints of the state only need
+    to note a position in it.
     """
-    def __init__(self):
+    def __init__(self, keep_history=False):
         self.timestamp = 0
         self.last_selected_ids = []
         self.objects = {}
         self.unresolved_lookups = []
+        # object ID -> parent object ID, for objects in a group. The root of
+        # each group is its own parent.
+        self.group_parent = {}
+        # root object ID -> number of objects in the group
+        self.group_size = {}
+        # root object ID -> player ID owning the group, once known
+        self.group_owner = {}
+        # root object ID -> unresolved lookups waiting for the group's owner
+        self._group_lookups = {}
+        self.history = ContextHistory() if keep_history else None
+
+    def checkpoint(self, offset):
+        """Return a ContextCheckpoint of the current state
+
+        offset is the body offset of the next op to be parsed in this state.
+        The context must keep a history.
+        """
+        return ContextCheckpoint(offset, self.timestamp, self.last_selected_ids.copy(),
+            self.history, len(self.history.changes), len(self.unresolved_lookups))
+
+    @staticmethod
+    def from_checkpoint(checkpoint):
+        """Create a GameContext in the state saved by a ContextCheckpoint
+        """
+        game_context = GameContext()
+        game_context.timestamp = checkpoint.timestamp
+        game_context.last_selected_ids = checkpoint.last_selected_ids.copy()
+        tables = (game_context.objects, game_context.group_parent, game_context.group_size,
+            game_context.group_owner)
+        for table, key, value in itertools.islice(checkpoint.history.changes, checkpoint.change_count):
+            if value is REMOVED:
+                del tables[table][key]
+            else:
+                tables[table][key] = value
+        # The object records are updated in place
+        game_context.objects = {k: dict(v) for k, v in game_context.objects.items()}
+        return game_context
+
+    def _changed(self, table, key, value=None):
+        """Append a change to the history, if kept
+
+        value is the new value of key in table (see ContextHistory), or
+        REMOVED. Changes to OBJECTS take a copy of the current record.
+        """
+        if self.history is not None:
+            if table == OBJECTS:
+                value = dict(self.objects[key])
+            self.history.changes.append((table, key, value))
 
     def create_building(self, building_id, building_type, player_id):
         """Whenever a unit is trained, we learn about the building it was trained at
@@ -112,94 +319,454 @@ class GameContext(object):
                 'object_type_id': building_type,
                 'player_id': player_id
             }
+            self._changed(OBJECTS, building_id)
+            if player_id is not None and building_id in self.group_parent:
+                self._set_group_owner(self._find(building_id), player_id)
 
-    def create_unit(self, unit_id, unit_type_id, player_id):
+    def create_unit(self, unit_id, unit_type_id, player_id, group=True):
         """Whenever we can, associate a type or a owner with a unit ID
+
+        If group is False, the owner is not applied to the unit's group (see
+        `lookup_player_from_objects`).
         """
-        if unit_id not in self.objects:
+        obj = self.objects.get(unit_id)
+        if obj is None:
             self.objects[unit_id] = {
                 'type': 'unit',
                 'object_id': unit_id,
                 'object_type_id': unit_type_id,
                 'player_id': player_id
             }
-        else:
+            self._changed(OBJECTS, unit_id)
+        elif ((unit_type_id is not None and obj['object_type_id'] != unit_type_id)
+                or (player_id is not None and obj['player_id'] != player_id)):
             if unit_type_id is not None:
-                self.objects[unit_id]['object_type_id'] = unit_type_id
+                obj['object_type_id'] = unit_type_id
             if player_id is not None:
-                self.objects[unit_id]['player_id'] = player_id
+                obj['player_id'] = player_id
+            self._changed(OBJECTS, unit_id)
+        if group and player_id is not None and unit_id in self.group_parent:
+            self._set_group_owner(self._find(unit_id), player_id)
 
-    def lookup_player_from_objects(self, object_ids, callback=None):
-        """Lookup a player based on a list of selected object IDs
+    def _find(self, object_id):
+        """Return the root of the group of an object, adding it as a group of its own if new
+        """
+        parent = self.group_parent
+        if object_id not in parent:
+            parent[object_id] = object_id
+            self._changed(GROUP_PARENT, object_id, object_id)
+            obj = self.objects.get(object_id)
+            if obj is not None and obj['player_id'] is not None:
+                self.group_owner[object_id] = obj['player_id']
+                self._changed(GROUP_OWNER, object_id, obj['player_id'])
+            return object_id
+        root = object_id
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression. It doesn't change the roots, so it is left out of
+        # the history.
+        while object_id != root:
+            parent[object_id], object_id = root, parent[object_id]
+        return root
+
+    def _union(self, a, b):
+        """Merge the groups with roots a and b, and return the new root
+
+        Groups which are known to have different owners are left apart: the
+        owner of a unit can change when it is converted.
+        """
+        if a == b:
+            return a
+        owner_a = self.group_owner.get(a)
+        owner_b = self.group_owner.get(b)
+        if owner_a is not None and owner_b is not None and owner_a != owner_b:
+            return a
+        size = self.group_size
+        if size.get(a, 1) < size.get(b, 1):
+            a, b = b, a
+        self.group_parent[b] = a
+        self._changed(GROUP_PARENT, b, a)
+        if b in size:
+            self._changed(GROUP_SIZE, b, REMOVED)
+        size[a] = size.get(a, 1) + size.pop(b, 1)
+        self._changed(GROUP_SIZE, a, size[a])
+        waiting = self._group_lookups.pop(b, None)
+        if waiting:
+            self._group_lookups.setdefault(a, []).extend(waiting)
+        owner = self.group_owner.pop(b, None)
+        if owner is not None:
+            self._changed(GROUP_OWNER, b, REMOVED)
+        if owner is not None and a not in self.group_owner:
+            self._set_group_owner(a, owner)
+        return a
+
+    def _set_group_owner(self, root, player_id):
+        """Record the owner of a group, if not known yet, and resolve the lookups waiting on it
+        """
+        if root in self.group_owner:
+            return
+        self.group_owner[root] = player_id
+        self._changed(GROUP_OWNER, root, player_id)
+        for lu in self._group_lookups.pop(root, ()):
+            if not lu.get('resolved'):
+                self._resolve(lu, player_id)
+
+    def group_objects(self, object_ids):
+        """Record that the objects in object_ids share an owner
+
+        Returns the root of their group, or None if object_ids is empty
+        """
+        root = None
+        for id in object_ids:
+            id_root = self._find(id)
+            root = id_root if root is None else self._union(root, id_root)
+        return root
 
-        Works like `lookup_player_from_object`, but with a list of IDs. If we
-        know the owner of any, we can return a player_id
+    def _known_owner(self, object_ids):
+        """Owner of the first of object_ids that we were told about, or None
         """
-        # TODO: Objections in a selected group tell us that all of the objects
-        # are owned by the same player. If we identify any one in the future, we
-        # can identy all. We should track these associations.
-        player_id = None
         for id in object_ids:
-            player_id = self.lookup_player_from_object(id)
-            if player_id is not None:
-                break
+            obj = self.objects.get(id)
+            if obj is not None and obj['player_id'] is not None:
+                return obj['player_id']
+        return None
 
-        if callback is not None:
-            if player_id is not None:
+    def _group_owner(self, object_ids):
+        """Owner of the group of the first of object_ids whose group's owner is known, or None
+        """
+        for id in object_ids:
+            if id in self.group_parent:
+                player_id = self.group_owner.get(self._find(id))
+                if player_id is not None:
+                    return player_id
+        return None
+
+    def _lookup(self, object_ids, root, callback):
+        """Lookup the owner of object_ids (all owned by one player), for the lookup_* methods
+
+        An owner we were told about for one of the objects is final. Failing
+        that, the owner of their group is used, but only provisionally: the
+        lookup is kept, and `resolve_lookups` prefers the owner known for the
+        objects themselves at the end of the log. If neither is known yet, the
+        lookup waits for the owner of the group at root.
+        """
+        player_id = self._known_owner(object_ids)
+        if player_id is not None or callback is None:
+            if player_id is None:
+                player_id = self._group_owner(object_ids)
+            if player_id is not None and callback is not None:
                 callback(player_id)
-            else:
-                self.unresolved_lookups.append({
-                    'object_id': object_ids,
-                    'callback': callback
-                })
-
+            return player_id
+
+        lu = {
+            'object_ids': object_ids,
+            'callback': callback
+        }
+        self.unresolved_lookups.append(lu)
+        player_id = self._group_owner(object_ids)
+        if player_id is not None:
+            self._resolve(lu, player_id)
+        elif root is not None:
+            self._group_lookups.setdefault(root, []).append(lu)
         return player_id
 
+    def lookup_player_from_objects(self, object_ids, callback=None, group=True):
+        """Lookup a player based on a list of selected object IDs
+
+        Works like `lookup_player_from_object`, but with a list of IDs, which
+        are put in the same group. If we know the owner of any, we can return
+        a player_id
+
+        If group is False, the IDs are not grouped. This is the case for a
+        selection reused from a previous command (a count of 0xFF), which may
+        well have been another player's.
+        """
+        root = self.group_objects(object_ids) if group else None
+        return self._lookup(object_ids, root, callback)
+
     def lookup_player_from_object(self, object_id, callback=None):
         """Lookup a player based on a single building or unit ID
 
         If found, player_id is returned. Otherwise, None.
         However, it is possible that we do not know who owns the building yet,
         but that we will learn by the time we are finished parsingn the log. If
-        a callback method is provided, it will be called either now, or after
-        parsing the entire log with a single argument: the player id.
+        a callback method is provided, it will be called either as soon as the
+        owner is known, or after parsing the entire log, with a single
+        argument: the player id. (If the owner is only known through the
+        object's group, it may be called again after parsing the log, see
+        `_lookup`.)
         """
-        player_id = None
-        if object_id in self.objects:
-            player_id = self.objects[object_id]['player_id']
-
-        if player_id is not None and callback is not None:
-                callback(player_id)
-        elif callback is not None:
-            #no player id found, schedule to check later
-            self.unresolved_lookups.append({
-                'object_id': object_id,
-                'callback': callback
-            })
+        root = self._find(object_id) if callback is not None else None
+        return self._lookup([object_id], root, callback)
 
-        return player_id # None if not found
+    def _resolve(self, lu, player_id):
+        lu['resolved'] = True
+        lu['player_id'] = player_id
+        lu['callback'](player_id)
 
     def resolve_lookups(self):
+        """Resolve the lookups still waiting at the end of the log
+
+        Lookups get the owner known for their objects by now if there is one,
+        even if their group's owner was used during the pass, and otherwise
+        their group's owner.
+        """
         for lu in self.unresolved_lookups:
-            player_id = None
-            if isinstance(lu['object_id'], list):
-                for id in lu['object_id']:
-                    player_id = self.lookup_player_from_object(id)
-                    if player_id is not None:
-                        break
-            else:
-                player_id = self.lookup_player_from_object(lu['object_id'])
+            object_ids = lu['object_ids']
+            player_id = self._known_owner(object_ids)
+            if player_id is None and not lu.get('resolved'):
+                player_id = self._group_owner(object_ids)
+            if player_id is not None and player_id != lu.get('player_id'):
+                self._resolve(lu, player_id)
+
+# Tables of the GameContext in ContextHistory changes
+OBJECTS, GROUP_PARENT, GROUP_SIZE, GROUP_OWNER = range(4)
+# Value of a ContextHistory change removing a key
+REMOVED = object()
+
+class ContextHistory(object):
+    """What a pass over the body learned about object ownership, in order
+
+    Shared by the checkpoints of the pass, which each note how far into it
+    they are, so that memory grows with the length of the game rather than
+    with the number of checkpoints times the number of objects.
+    """
+    def __init__(self):
+        # (table, key, value): tables[table][key] was set to value (a copy,
+        # for object records) or, if value is REMOVED, deleted
+        self.changes = []
+        # Player ID that each deferred player lookup resolved to, in the
+        # order they were deferred (None if never resolved); set at the end
+        self.lookup_owners = []
+
+class ContextCheckpoint(object):
+    """Snapshot of the GameContext state at an op boundary in the body
+
+    Parsing can resume from offset with `GameContext.from_checkpoint()`, and
+    gives the same results as parsing from the start of the body, once the
+    player lookups left unresolved are given the owners found by the full
+    pass (see `commands_from_checkpoint`).
+    """
+    def __init__(self, offset, timestamp, last_selected_ids, history, change_count, lookup_count):
+        self.offset = offset
+        self.timestamp = timestamp
+        self.last_selected_ids = last_selected_ids
+        self.history = history
+        # Number of changes in history made before the checkpoint
+        self.change_count = change_count
+        # Number of player lookups deferred before the checkpoint
+        self.lookup_count = lookup_count
+
+class DecodeContext(object):
+    """Stand-in for GameContext used to decode a command outside of the pass
+
+    It replays the state that the command saw during the pass (the selection
+    and the player ID) and ignores any new facts about objects, which the real
+    GameContext has already been told about.
+    """
+    def __init__(self, timestamp, player_id, selected_ids):
+        self.timestamp = timestamp
+        self.player_id = player_id
+        self.last_selected_ids = selected_ids
+        self.objects = {}
 
-            if player_id is not None:
-                lu['callback'](player_id)
+    def create_building(self, building_id, building_type, player_id):
+        pass
+
+    def create_unit(self, unit_id, unit_type_id, player_id, group=True):
+        pass
+
+    def lookup_player_from_objects(self, object_ids, callback=None, group=True):
+        return self.lookup_player_from_object(None, callback)
+
+    def lookup_player_from_object(self, object_id, callback=None):
+        if self.player_id is not None and callback is not None:
+            callback(self.player_id)
+        return self.player_id
+
+# Field name in a CommandLayout for the count of selected IDs following the
+# layout. It is decoded into the 'selected_ids' attribute.
+SELECTION_COUNT = 'selection_count'
+
+class ChunkContext(object):
+    """Stand-in for GameContext used to decode a chunk of the body on its own
+
+    The selection before the chunk is not known, so commands which reuse it
+    get an empty one (see `selection_set` to tell them apart), and facts about
+    objects are ignored. Both are applied in order afterwards, by
+    `TimestampedCommand.stitch`, against the real GameContext.
+    """
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.objects = {}
+        self._last_selected_ids = []
+        # Set once a command in the chunk sets the selection
+        self.selection_set = False
+
+    @property
+    def last_selected_ids(self):
+        return self._last_selected_ids
+
+    @last_selected_ids.setter
+    def last_selected_ids(self, selected_ids):
+        self._last_selected_ids = selected_ids
+        self.selection_set = True
+
+    def create_building(self, building_id, building_type, player_id):
+        pass
+
+    def create_unit(self, unit_id, unit_type_id, player_id, group=True):
+        pass
+
+    def lookup_player_from_objects(self, object_ids, callback=None, group=True):
+        return None
+
+    def lookup_player_from_object(self, object_id, callback=None):
+        return None
+
+def unpack_command(st, data, offset=0):
+    """unpack_from a struct.Struct in command data, raising EndOfData if it is too short
+    """
+    if offset + st.size > len(data):
+        raise EndOfData
+    return st.unpack_from(data, offset)
+
+def read_selected_ids(game_context, data, offset, selection_count):
+    """Decode the selected IDs at offset in command data
+
+    A count of 0xFF means the selection is unchanged from the previous command
+    """
+    if selection_count == 0xFF:
+        return game_context.last_selected_ids.copy()
+    if offset + 4 * selection_count > len(data):
+        raise EndOfData
+    selected_ids = list(get_struct("%dI" % selection_count).unpack_from(data, offset))
+    game_context.last_selected_ids = selected_ids.copy()
+    return selected_ids
+
+class CommandLayout(object):
+    """Describes the fixed-size start of a command's data
+
+    fmt is a struct format (little-endian, without the leading "<") decoded in
+    one go, with pad bytes ("x") for the command id and unknown fields. fields
+    names the decoded values, in order; these become the attributes of the
+    command, except for SELECTION_COUNT. If there is a SELECTION_COUNT field,
+    the selected IDs follow the fixed part.
+
+    labels maps a field to (label attribute, dict of names), to add the name of
+    a coded value as an attribute following the field.
+    """
+    def __init__(self, fmt, fields, labels=None):
+        self.struct = get_struct(fmt)
+        self.fields = fields
+        self.labels = labels or {}
+        self.has_selection = SELECTION_COUNT in fields
+        self._selection_index = fields.index(SELECTION_COUNT) if self.has_selection else None
+        # names -> [(index, name)] of those fields, for decode_context
+        self._context_indices = {}
+
+    def decode(self, data, game_context):
+        """Return the attributes dict decoded from command data
+        """
+        st = self.struct
+        if st.size > len(data):
+            raise EndOfData
+        values = st.unpack_from(data)
+        if self.labels:
+            a = {}
+            for name, value in zip(self.fields, values):
+                a[name] = value
+                if name in self.labels:
+                    label, names = self.labels[name]
+                    a[label] = names.get(value, "UNKNOWN")
+        else:
+            a = dict(zip(self.fields, values))
+        if self.has_selection:
+            a['selected_ids'] = read_selected_ids(game_context, data, self.struct.size,
+                a.pop(SELECTION_COUNT))
+        return a
+
+    def reuses_selection(self, data):
+        """Whether the command reuses the selection of the previous command (a count of 0xFF)
+        """
+        return self.struct.unpack_from(data)[self._selection_index] == 0xFF
+
+    def decode_context(self, data, game_context, names):
+        """Decode only the fields in names, and the selected IDs
+
+        Used in lazy mode: labels are not added, and the other fields are
+        left out. The selection is read (and the context's updated) as in
+        `decode`.
+        """
+        st = self.struct
+        if st.size > len(data):
+            raise EndOfData
+        values = st.unpack_from(data)
+        indices = self._context_indices.get(names)
+        if indices is None:
+            indices = [(i, name) for i, name in enumerate(self.fields) if name in names]
+            self._context_indices[names] = indices
+        a = {name: values[i] for i, name in indices}
+        if self.has_selection:
+            a['selected_ids'] = read_selected_ids(game_context, data, st.size,
+                values[self._selection_index])
+        return a
+
+# command id -> TimestampedCommand subclass that decodes it
+COMMAND_CLASSES = {}
+# command name -> TimestampedCommand subclass
+COMMAND_TYPE_MAP = {}
+
+def register_command(command_id):
+    """Class decorator registering the class which decodes a command id
+
+    A new command type is added by declaring its layout, and how it updates the
+    game context:
+
+        @register_command(0x6C)
+        class TributeCommand(TimestampedCommand):
+            __slots__ = ()
+
+            LAYOUT = CommandLayout("xBBBf", ('player_id', 'to_player_id', 'resource_id', 'amount'))
+    """
+    def register(cls):
+        COMMAND_CLASSES[command_id] = cls
+        COMMAND_TYPE_MAP[command_name(command_id)] = cls
+        return cls
+    return register
 
 class TimestampedCommand(object):
-    def __init__(self, command_type, command_data, game_context):
+    # Commands are kept in memory by the tens of thousands per game, so they
+    # have no per-instance __dict__. Subclasses must declare empty __slots__.
+    __slots__ = ('type', 'data', 'timestamp', '_attributes', '_decoded')
+
+    # CommandLayout of the command data, or None if it isn't understood
+    LAYOUT = None
+    # Set if the selected units are owned by the command's player
+    OWNS_SELECTED = False
+    # (building ID attribute, building type ID or attribute) of a building
+    # owned by the command's player
+    CREATES_BUILDING = None
+    # Attributes holding object IDs (or lists of IDs) owned by the command's
+    # player, which are looked up in order to find the player ID
+    PLAYER_FROM = ()
+
+    def __init__(self, command_type, command_data, game_context, lazy=False):
+        """Create a command, parsing it in the given game context
+
+        If lazy is set, only the fields which carry GameContext state (the
+        player ID, selected IDs and object ownership) are decoded now. The
+        complete attributes are decoded the first time they are requested.
+        """
         self.type = command_type
         self.data = command_data
         self.timestamp = game_context.timestamp
         self._attributes = {}
-        self.parse(game_context)
+        self._decoded = not lazy
+        if lazy:
+            self.parse_context(game_context)
+        else:
+            self.parse(game_context)
 
     def command_name(self):
         return command_name(self.type)
@@ -213,15 +780,28 @@ class TimestampedCommand(object):
         r['id'] = self.type
         r['name'] = command_name(self.type)
         r['time'] = self.timestamp
-        r['bytes'] = [b for b in self.data]
+        r['bytes'] = None if self.data is None else [b for b in self.data]
         r['attributes'] = self.attributes()
         return r
 
+    def drop_data(self):
+        """Decode the attributes, then release the raw command bytes
+
+        Afterwards `data` is None, and `serializable()` gives None for bytes.
+        """
+        self.attributes()
+        self.data = None
+
     def attributes(self):
         """Default blank attribute parser
 
         Specific command types can override this if needed
         """
+        if not self._decoded:
+            self._decoded = True
+            self.parse(DecodeContext(self.timestamp,
+                self._attributes.get('player_id', None),
+                self._attributes.get('selected_ids', [])))
         return self._attributes
 
     def player_id(self):
@@ -233,170 +813,174 @@ class TimestampedCommand(object):
         return self._attributes.get('player_id', None)
 
     def parse(self, game_context):
-        """Default blank parse method
+        """Decode the attributes of the command using its LAYOUT
 
-        To be overridden
+        Commands whose data can't be described by a layout override this
         """
-        pass
+        if self.LAYOUT is None:
+            return
+        a = self.LAYOUT.decode(self.data, game_context)
+        self._attributes = a
+        self._update_context(a, game_context)
 
-    @staticmethod
-    def get_selected_ids(game_context, bin_reader, selection_count):
-        selected_ids = None
-        if selection_count == 0xFF:
-            selected_ids = game_context.last_selected_ids.copy()
-        else:
-            selected_ids = [bin_reader.read_u32() for _ in range(selection_count)]
-            game_context.last_selected_ids = selected_ids.copy()
-        return selected_ids
+    def parse_context(self, game_context):
+        """Context parse method, used in lazy mode
 
+        Stores only the player_id, selected_ids and the other fields read by
+        `_update_context` (see `context_fields`) in `self._attributes`, and
+        updates the game context as `parse` does.
+        """
+        if self.LAYOUT is None:
+            return
+        a = self.LAYOUT.decode_context(self.data, game_context, self.context_fields())
+        self._attributes = a
+        self._update_context(a, game_context)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def context_fields(cls):
+        """Names of the LAYOUT fields that `_update_context` reads, besides the selection
+        """
+        names = {'player_id'}
+        names.update(name for name in cls.PLAYER_FROM if name != 'selected_ids')
+        if cls.CREATES_BUILDING is not None:
+            names.update(name for name in cls.CREATES_BUILDING if isinstance(name, str))
+        return frozenset(names)
+
+    def _update_context(self, a, game_context):
+        """Apply what the decoded attributes a tell us about object ownership
+        """
+        # A selection reused from the previous command may not be this
+        # player's, so it doesn't tell us anything about groups
+        group = not (self.LAYOUT.has_selection and self.LAYOUT.reuses_selection(self.data))
+        if self.OWNS_SELECTED:
+            for id in a['selected_ids']:
+                # We learn who owns these units
+                game_context.create_unit(id, None, a['player_id'], group)
+        if self.CREATES_BUILDING is not None:
+            building_id, building_type = self.CREATES_BUILDING
+            if isinstance(building_type, str):
+                building_type = a[building_type]
+            game_context.create_building(a[building_id], building_type, a['player_id'])
+        for name in self.PLAYER_FROM:
+            if isinstance(a[name], list):
+                game_context.lookup_player_from_objects(a[name], self._set_player_id, group)
+            else:
+                game_context.lookup_player_from_object(a[name], self._set_player_id)
+
+    def stitch(self, game_context, outer_selection=None):
+        """Apply a command decoded in a ChunkContext to the real GameContext
+
+        outer_selection is the selection before the chunk, for a command
+        which reused it. Afterwards the command is the same as if it had been
+        decoded in game_context.
+        """
+        if outer_selection is not None:
+            self._attributes['selected_ids'] = outer_selection.copy()
+        if self.LAYOUT is not None:
+            game_context.timestamp = self.timestamp
+            self._update_context(self._attributes, game_context)
+
+    @classmethod
+    def updates_context(cls):
+        """Whether decoding the command changes the GameContext
+
+        That is, whether it reads or sets the selected IDs, or tells us about
+        object ownership. Commands which don't can be skipped without changing
+        how the others are decoded.
+        """
+        layout = cls.LAYOUT
+        return layout is not None and (layout.has_selection or cls.OWNS_SELECTED or
+            cls.CREATES_BUILDING is not None or len(cls.PLAYER_FROM) > 0)
+
+    def _set_player_id(self, player_id):
+        """Callback for player lookups
+        """
+        self._attributes['player_id'] = player_id
+
+@register_command(0x00)
 class AttackCommand(TimestampedCommand):
     """Notably, this action is used for all right-click commands, so it isn't
     just attack
     """
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        a['player_id'] = br.read_u8()
-        br.read_u16()
-        # The ID of the targetted object (Do trees have IDs??)
-        a['target_id'] = br.read_u32()
-        selection_count = br.read_u32()
-        a['x_coord'] = br.read_float()
-        a['y_coord'] = br.read_float()
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
-
-        for id in a['selected_ids']:
-            game_context.create_unit(id, None, a['player_id'])
+    __slots__ = ()
 
-        self._attributes = a
+    # target_id is the ID of the targetted object (Do trees have IDs??)
+    LAYOUT = CommandLayout("xBxxIIff",
+        ('player_id', 'target_id', SELECTION_COUNT, 'x_coord', 'y_coord'))
+    OWNS_SELECTED = True
 
+@register_command(0x80)
 class BackToWorkCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        br.read(3) # padding
-        a['building_id'] = br.read_u32()
+    __slots__ = ()
 
-        def player_id_callback(player_id):
-            a['player_id'] = player_id
-        game_context.lookup_player_from_object(a['building_id'], player_id_callback)
-
-        self._attributes = a
+    LAYOUT = CommandLayout("x3xI", ('building_id',))
+    PLAYER_FROM = ('building_id',)
 
+@register_command(0x66)
 class BuildCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        selection_count = br.read_u8()
-        a['player_id'] = br.read_u8()
-        br.read_u8()
-        a['x_coord'] = br.read_float()
-        a['y_coord'] = br.read_float()
-        a['building_type_id'] = br.read_u16()
-        br.read_u16() # padding
-        br.read_u32() # unknown
-        br.read_u32() # sprite ID
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
+    __slots__ = ()
 
-        self._attributes = a
+    # Followed by padding, an unknown u32 and the sprite ID
+    LAYOUT = CommandLayout("xBBxffH2x4x4x",
+        (SELECTION_COUNT, 'player_id', 'x_coord', 'y_coord', 'building_type_id'))
 
+@register_command(0x7B)
 class BuyCommand(TimestampedCommand):
+    __slots__ = ()
+
     RESOURCE_TYPE = {
         0: "Food",
         1: "Wood",
         2: "Stone"
     }
 
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        a['player_id'] = br.read_u8()
-        a['resource_type_id'] = br.read_u8()
-        a['resource_type'] = self.RESOURCE_TYPE.get(a['resource_type_id'], "UNKNOWN")
-        a['amount'] = br.read_u8()
-        a['building_id'] = br.read_u32()
-        # We learned that this is a market, owned by player
-        game_context.create_building(a['building_id'], 84, a['player_id'])
-        self._attributes = a
+    LAYOUT = CommandLayout("xBBBI", ('player_id', 'resource_type_id', 'amount', 'building_id'),
+        labels={'resource_type_id': ('resource_type', RESOURCE_TYPE)})
+    # We learned that this is a market, owned by player
+    CREATES_BUILDING = ('building_id', 84)
 
+@register_command(0x6A)
 class DeleteCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u32() # command id + pad
-        a['object_id'] = br.read_u32()
-        a['player_id'] = br.read_u8()
+    __slots__ = ()
 
-        self._attributes = a
+    LAYOUT = CommandLayout("4xIB", ('object_id', 'player_id'))
 
+@register_command(0x75)
 class GarrisonCommand(TimestampedCommand):
+    __slots__ = ()
+
     GARRISON_TYPES = {
         1: "PACK", # For trebuchet
         2: "UNPACK", # For trebuchet
         4: "CANCEL", # when cancelling units in training queue
         5: "GARRISON", # garrisoning units in building or boat
     }
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        selection_count = br.read_u8()
-        br.read_u16()
-        a['building_id'] = br.read_u32()
-        a['garrison_type_id'] = br.read_u8()
-        a['garrison_type'] = self.GARRISON_TYPES.get(a['garrison_type_id'], "UNKNOWN")
-        # I believe this is the position in the queue which is cancelled
-        a['position'] = br.read_u8() # This may apply only to CANCEL commands. 
-        br.read_u16()
-        a['x_coord'] = br.read_float()
-        a['y_coord'] = br.read_float()
-        br.read_u32() # always FFs
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
-        def set_player_id(player_id):
-            a['player_id'] = player_id
-        game_context.lookup_player_from_objects(a['selected_ids'], set_player_id)
-        self._attributes = a
-
+    # I believe position is the position in the queue which is cancelled. This
+    # may apply only to CANCEL commands. The last word is always FFs.
+    LAYOUT = CommandLayout("xB2xIBB2xff4x",
+        (SELECTION_COUNT, 'building_id', 'garrison_type_id', 'position', 'x_coord', 'y_coord'),
+        labels={'garrison_type_id': ('garrison_type', GARRISON_TYPES)})
+    PLAYER_FROM = ('selected_ids',)
+
+@register_command(0x13)
 class GuardCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        selection_count = br.read_u8()
-        br.read_u16() # pad
-        a['guarded_id'] = br.read_u32()
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
-
-        def set_player_id(player_id):
-            a['player_id'] = player_id
-        game_context.lookup_player_from_object(a['guarded_id'], set_player_id)
-        game_context.lookup_player_from_objects(a['selected_ids'], set_player_id)
+    __slots__ = ()
 
-        self._attributes = a
+    LAYOUT = CommandLayout("xB2xI", (SELECTION_COUNT, 'guarded_id'))
+    PLAYER_FROM = ('guarded_id', 'selected_ids')
 
+@register_command(0x03)
 class MoveCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        a['player_id'] = br.read_u8()
-        br.read_u16()
-        br.read_u32()
-        selection_count = br.read_u32()
-        a['x_coord'] = br.read_float()
-        a['y_coord'] = br.read_float()
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
-
-        for id in a['selected_ids']:
-            game_context.create_unit(id, None, a['player_id'])
+    __slots__ = ()
 
-        self._attributes = a
+    LAYOUT = CommandLayout("xB2x4xIff", ('player_id', SELECTION_COUNT, 'x_coord', 'y_coord'))
+    OWNS_SELECTED = True
 
+@register_command(0x67)
 class MultipurposeCommand(TimestampedCommand):
+    __slots__ = ()
+
     ACTION_TYPES = {
         0: "Diplomacy",
         1: "Change Game Speed",
@@ -406,229 +990,254 @@ class MultipurposeCommand(TimestampedCommand):
         10: "Research Treason",
         11: "AI policy"
     }
+    # action type, player ID (or cheat response value), option1, option2, diplomatic stance
+    STRUCT = get_struct("xBBxB3xfB")
+
     def parse(self, game_context):
+        action_type_id, player_id, option1, option2, stance = unpack_command(self.STRUCT, self.data)
         a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        a['action_type_id'] = br.read_u8()
-        a['action_type'] = self.ACTION_TYPES.get(a['action_type_id'], 'UNKNOWN')
+        a['action_type_id'] = action_type_id
+        a['action_type'] = self.ACTION_TYPES.get(action_type_id, 'UNKNOWN')
         # This field isn't actually the player ID in a cheat response
         if a['action_type'] != "Cheat Response":
-            a['player_id'] = br.read_u8()
+            a['player_id'] = player_id
         else:
-            a['cheat_response_value'] = br.read_u8()
-        br.read_u8()
-        a['option1'] = br.read_u8()
-        br.read(3)
-        a['option2'] = br.read_float()
-        a['diplomatic_stance'] = br.read_u8()
+            a['cheat_response_value'] = player_id
+        a['option1'] = option1
+        a['option2'] = option2
+        a['diplomatic_stance'] = stance
 
         self._attributes = a
 
+    def parse_context(self, game_context):
+        action_type_id, player_id = unpack_command(self.STRUCT, self.data)[:2]
+        if self.ACTION_TYPES.get(action_type_id) != "Cheat Response":
+            self._attributes = {'player_id': player_id}
+
+@register_command(0x78)
 class RallyCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a =  {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        selection_count = br.read_u8()
-        br.read_u16()
-        # I assume that one of these is the unique ID, and one is the type? But
-        # I'm not really sure
-        a['target_id'] = br.read_u32()
-        a['target_unit_id'] = br.read_u32()
-        a['x_coord'] = br.read_float()
-        a['y_coord'] = br.read_float()
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
-
-        def set_player_id(player_id):
-            a['player_id'] = player_id
-        game_context.lookup_player_from_objects(a['selected_ids'], set_player_id)
+    __slots__ = ()
 
-        self._attributes = a
+    # I assume that one of target_id/target_unit_id is the unique ID, and one
+    # is the type? But I'm not really sure
+    LAYOUT = CommandLayout("xB2xIIff",
+        (SELECTION_COUNT, 'target_id', 'target_unit_id', 'x_coord', 'y_coord'))
+    PLAYER_FROM = ('selected_ids',)
 
+@register_command(0x65)
 class ResearchCommand(TimestampedCommand):
-    def parse(self, game_context):
-        # NOTE: Could infer the type of the building here based on what's being researched, if we need it
-        a = {}
-        br = BinReader(self.data)
-        br.read_u32()
-        a['building_id'] = br.read_u32()
-        a['player_id'] = br.read_u8()
-        br.read_u8()
-        a['technology_id'] = br.read_u16()
-        self._attributes = a
+    __slots__ = ()
+
+    # NOTE: Could infer the type of the building here based on what's being researched, if we need it
+    LAYOUT = CommandLayout("4xIBxH", ('building_id', 'player_id', 'technology_id'))
 
+@register_command(0x7A)
 class SellCommand(TimestampedCommand):
+    __slots__ = ()
+
     RESOURCE_TYPE = {
         0: "Food",
         1: "Wood",
         2: "Stone"
     }
 
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        a['player_id'] = br.read_u8()
-        a['resource_type_id'] = br.read_u8()
-        a['resource_type'] = self.RESOURCE_TYPE.get(a['resource_type_id'], "UNKNOWN")
-        a['amount'] = br.read_u8()
-        a['building_id'] = br.read_u32()
-        # We learned that this is a market, owned by player
-        game_context.create_building(a['building_id'], 84, a['player_id'])
-        self._attributes = a
+    LAYOUT = CommandLayout("xBBBI", ('player_id', 'resource_type_id', 'amount', 'building_id'),
+        labels={'resource_type_id': ('resource_type', RESOURCE_TYPE)})
+    # We learned that this is a market, owned by player
+    CREATES_BUILDING = ('building_id', 84)
 
+@register_command(0x12)
 class StanceCommand(TimestampedCommand):
+    __slots__ = ()
+
     STANCE_TYPE = {
         0: "Aggressive",
         1: "Defensive",
         2: "Stand Ground",
         3: "Passive"
     }
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        selection_count = br.read_u8()
-        a['stance_id'] = br.read_u8()
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
-
-        def set_player_id(player_id):
-            a['player_id'] = player_id
-
-        game_context.lookup_player_from_objects(a['selected_ids'], set_player_id)
-
-        self._attributes = a
+    LAYOUT = CommandLayout("xBB", (SELECTION_COUNT, 'stance_id'))
+    PLAYER_FROM = ('selected_ids',)
 
+@register_command(0x01)
 class StopCommand(TimestampedCommand):
-    def parse(self, game_context):
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        selected_count = br.read_u8()
-        a = {}
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selected_count)
-
-        def set_player_id(player_id):
-            a['player_id'] = player_id
-        game_context.lookup_player_from_objects(a['selected_ids'], set_player_id)
+    __slots__ = ()
 
-        self._attributes = a
+    LAYOUT = CommandLayout("xB", (SELECTION_COUNT,))
+    PLAYER_FROM = ('selected_ids',)
 
+@register_command(0x7F)
 class TownBellCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        br.read(3) # pad
-        a['building_id'] = br.read_u32()
-        a['active'] = br.read_u8()
+    __slots__ = ()
 
-        def set_player_id(player_id):
-            a['player_id'] = player_id
-        game_context.lookup_player_from_object(a['building_id'], set_player_id)
-
-        self._attributes = a
+    LAYOUT = CommandLayout("4xIB", ('building_id', 'active'))
+    PLAYER_FROM = ('building_id',)
 
+@register_command(0x81)
 class Train2Command(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        a['player_id'] = br.read_u8()
-        a['building_type'] = br.read_u16()
-        a['unknown1'] = br.read_u16()
-        a['unit_type'] = br.read_u16()
-        a['count'] = br.read_u16()
-        a['building_id'] = br.read_u16()
-        a['unknown2'] = br.read_u16()
-
-        game_context.create_building(a['building_id'], a['building_type'], a['player_id'])
+    __slots__ = ()
 
-        self._attributes = a
+    LAYOUT = CommandLayout("xBHHHHHH", ('player_id', 'building_type', 'unknown1', 'unit_type',
+        'count', 'building_id', 'unknown2'))
+    CREATES_BUILDING = ('building_id', 'building_type')
 
+@register_command(0x69)
 class WallCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        selection_count = br.read_u8()
-        a['player_id'] = br.read_u8()
-        a['start_x_coord'] = br.read_u8()
-        a['start_y_coord'] = br.read_u8()
-        a['end_x_coord'] = br.read_u8()
-        a['end_y_coord'] = br.read_u8()
-        br.read_u8() # pad
-        a['building_type'] = br.read_u32()
-        br.read_u32() # const
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
-
-        for id in a['selected_ids']:
-            game_context.create_unit(id, None, a['player_id'])
+    __slots__ = ()
 
-        self._attributes = a
+    # Followed by a constant u32
+    LAYOUT = CommandLayout("xBBBBBBxI4x", (SELECTION_COUNT, 'player_id', 'start_x_coord',
+        'start_y_coord', 'end_x_coord', 'end_y_coord', 'building_type'))
+    OWNS_SELECTED = True
 
+@register_command(0x10)
 class WaypointCommand(TimestampedCommand):
-    def parse(self, game_context):
-        a = {}
-        br = BinReader(self.data)
-        br.read_u8() # command id
-        a['player_id']  = br.read_u8()
-        selection_count = br.read_u8()
-        a['x_coord'] = br.read_u8()
-        a['y_coord'] = br.read_u8()
-        a['selected_ids'] = self.get_selected_ids(game_context, br, selection_count)
-
-        for id in a['selected_ids']:
-            # We learn who owns these units
-            game_context.create_unit(id, None, a['player_id'])
+    __slots__ = ()
 
-        self._attributes = a
+    LAYOUT = CommandLayout("xBBBB", ('player_id', SELECTION_COUNT, 'x_coord', 'y_coord'))
+    OWNS_SELECTED = True
+
+def command_class(command_type):
+    """Return the TimestampedCommand class used to parse a command type
+    """
+    # Create a specific derived type, if available
+    return COMMAND_CLASSES.get(command_type, TimestampedCommand)
+
+def context_command_types():
+    """Return the set of command types which update the GameContext when decoded
+    """
+    return {command_type for command_type, cls in COMMAND_CLASSES.items() if cls.updates_context()}
+
+def make_timestamped_command(op, game_context, lazy=False):
+    """Create a timestamped command from a Command op, in the current context
+    """
+    return command_class(op.type)(op.type, op.data, game_context, lazy)
+
+def context_checkpoints(bin_reader, interval_ms):
+    """Parse a body, taking a ContextCheckpoint at least every interval_ms
+
+    Returns the list of checkpoints, in body order and starting with one at
+    the beginning of the body. They share the ContextHistory of the pass.
+    """
+    game_context = GameContext(keep_history=True)
+    checkpoints = [game_context.checkpoint(0)]
+    next_checkpoint = interval_ms
+    for op in BodyParser(bin_reader):
+        if isinstance(op, Sync):
+            game_context.timestamp += op.time_delta
+            if game_context.timestamp >= next_checkpoint:
+                checkpoints.append(game_context.checkpoint(bin_reader.tell()))
+                next_checkpoint = game_context.timestamp + interval_ms
+        if isinstance(op, Command):
+            make_timestamped_command(op, game_context, lazy=True)
+    game_context.resolve_lookups()
+    game_context.history.lookup_owners = [lu.get('player_id') for lu in game_context.unresolved_lookups]
+    return checkpoints
+
+def commands_from_checkpoint(bin_reader, checkpoint, start_ms, end_ms):
+    """Return the timestamped commands with start_ms <= timestamp < end_ms
+
+    Parsing starts at checkpoint, which must be at or before start_ms. Commands
+    before start_ms only update the context. Player lookups of the window get
+    the player that the same lookup finally resolved to in the pass which took
+    the checkpoint, so that the commands are the same as those of a full
+    parse.
+    """
+    game_context = GameContext.from_checkpoint(checkpoint)
+    commands = []
+    for op in BodyParser(bin_reader, checkpoint.offset):
+        if isinstance(op, Sync):
+            game_context.timestamp += op.time_delta
+            if game_context.timestamp >= end_ms:
+                break
+        if isinstance(op, Command):
+            if game_context.timestamp >= start_ms:
+                commands.append(make_timestamped_command(op, game_context))
+            else:
+                make_timestamped_command(op, game_context, lazy=True)
+
+    # Lookups are deferred in the same order as in the full pass
+    for i, lu in enumerate(game_context.unresolved_lookups):
+        player_id = checkpoint.history.lookup_owners[checkpoint.lookup_count + i]
+        if player_id is not None and player_id != lu.get('player_id'):
+            game_context._resolve(lu, player_id)
+    return commands
+
+def feed_commands(bin_reader, consumers, keep_commands=False):
+    """Parse a body in a single pass, handing each timestamped command to consumers
 
-COMMAND_TYPE_MAP = {
-    "ATTACK": AttackCommand,
-    "BACKTOWORK": BackToWorkCommand,
-    "BUILD": BuildCommand,
-    "BUY": BuyCommand,
-    "DELETE": DeleteCommand,
-    "GARRISON": GarrisonCommand,
-    "GUARD": GuardCommand,
-    "MOVE": MoveCommand,
-    "MULTIPURPOSE": MultipurposeCommand,
-    "RALLY": RallyCommand,
-    "RESEARCH": ResearchCommand,
-    "SELL": SellCommand,
-    "STANCE": StanceCommand,
-    "STOP": StopCommand,
-    "TOWNBELL": TownBellCommand,
-    "TRAIN2": Train2Command,
-    "WALL": WallCommand,
-    "WAYPOINT": WaypointCommand,
-}
-
-def timestamped_commands(bin_reader):
+    Each consumer has an `on_command(cmd, pending)` method, called with every
+    command in order as soon as it is parsed, and a `finalize()` method,
+    called once the whole body is parsed. pending is set for commands with a
+    player lookup not yet resolved: their player ID may change until
+    finalize() is called.
+
+    Commands are returned as a list if keep_commands is set; otherwise the
+    list is never built, commands are decoded lazily, and None is returned.
+    """
+    game_context = GameContext()
+    commands = [] if keep_commands else None
+    for op in BodyParser(bin_reader):
+        if isinstance(op, Sync):
+            game_context.timestamp += op.time_delta
+        if isinstance(op, Command):
+            unresolved_count = len(game_context.unresolved_lookups)
+            cmd = make_timestamped_command(op, game_context, lazy=not keep_commands)
+            pending = len(game_context.unresolved_lookups) > unresolved_count
+            for consumer in consumers:
+                consumer.on_command(cmd, pending)
+            if keep_commands:
+                commands.append(cmd)
+
+    with stage("resolve_lookups"):
+        game_context.resolve_lookups()
+    for consumer in consumers:
+        consumer.finalize()
+    return commands
+
+def timestamped_commands(bin_reader, lazy=False, keep_data=True, command_types=None):
     """Parses a body and returns a list of timestamped commands
 
     Timestamps are inferred from the preceding Sync. I don't think this is
     the exactly right timestamp for simulation of the game. But it is
     close enough for our report purposes.
+
+    If lazy is set, commands only decode the state needed to track the game
+    context during the pass, and decode their attributes on first use. This
+    is much cheaper when only types, timestamps or player IDs are needed.
+
+    If keep_data is False, the raw bytes of each command are released once
+    it is decoded (see `TimestampedCommand.drop_data`). This overrides lazy.
+
+    If command_types is given, only commands of those types are returned.
+    Syncs, chats and the other commands are skipped without being decoded,
+    except for the commands which update the game context (see
+    `context_command_types`), which are decoded lazily so that the commands
+    returned are the same as without the filter.
     """
-    parser = BodyParser(bin_reader)
     game_context = GameContext()
     commands = []
-    for op in parser:
-        if isinstance(op, Sync):
-            game_context.timestamp += op.time_delta
-        if isinstance(op, Command):
-            # Create a specific derived type, if available
-            cmd_name = command_name(op.type)
-            if cmd_name in COMMAND_TYPE_MAP:
-                cmdType = COMMAND_TYPE_MAP[cmd_name]
-                tscmd = cmdType(op.type, op.data, game_context)
-            else: # make generic
-                tscmd = TimestampedCommand(op.type, op.data, game_context)
-            commands.append(tscmd)
+    if command_types is not None:
+        command_types = set(command_types)
+        parser = BodyParser(bin_reader, op_types={OP_COMMAND},
+            command_types=command_types | context_command_types())
+        for op in parser:
+            game_context.timestamp = parser.time
+            if op.type in command_types:
+                commands.append(make_timestamped_command(op, game_context, lazy))
+            else:
+                make_timestamped_command(op, game_context, lazy=True)
+    else:
+        for op in BodyParser(bin_reader):
+            if isinstance(op, Sync):
+                game_context.timestamp += op.time_delta
+            if isinstance(op, Command):
+                commands.append(make_timestamped_command(op, game_context, lazy))
 
     # Go back and update any player ID requests that we didn't know at the time
-    game_context.resolve_lookups()
+    with stage("resolve_lookups"):
+        game_context.resolve_lookups()
+    if not keep_data:
+        for cmd in commands:
+            cmd.drop_data()
     return commands
-
@@ -0,0 +1,213 @@
+from array import array
+import json
+import os
+import struct
+import tempfile
+
+import janissary.body
+from .command_table import CommandTable, NO_PLAYER
+from .parallel import parallel_timestamped_commands
+from .profiling import stage
+from .recorded_game import RecordedGame
+from .utils import BinReader, EndOfData, file_hash
+
+# Bump this whenever a change to the header or body parsers changes their
+# output, so that results cached by older versions are not used
+PARSER_VERSION = 3
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+MAGIC = b"JNSC"
+# Column order of the encoded command table
+COLUMNS = ('timestamps', 'types', 'player_ids', 'lengths', 'selection_offsets', 'selected_ids')
+
+def default_cache_dir():
+    """Cache directory, from $JANISSARY_CACHE_DIR or the user cache directory
+    """
+    if 'JANISSARY_CACHE_DIR' in os.environ:
+        return os.environ['JANISSARY_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "janissary")
+
+def encode_commands(timestamped_commands):
+    """Encode a sequence of timestamped commands into compact bytes
+
+    The commands are stored as the columns of a CommandTable, followed by
+    their raw bytes, so they can be decoded again without the game context.
+    """
+    table = CommandTable(None)
+    blob = bytearray()
+    for cmd in timestamped_commands:
+        if cmd.data is None:
+            raise ValueError("Can't encode commands whose raw bytes were dropped")
+        table.timestamps.append(cmd.timestamp)
+        table.types.append(cmd.type)
+        player_id = cmd.player_id()
+        table.player_ids.append(NO_PLAYER if player_id is None else player_id)
+        table.lengths.append(len(cmd.data))
+        table.selected_ids.extend(cmd.attributes().get('selected_ids', ()))
+        table.selection_offsets.append(len(table.selected_ids))
+        blob += cmd.data
+
+    out = bytearray()
+    for name in COLUMNS:
+        column = getattr(table, name)
+        out += struct.pack("<cL", column.typecode.encode('ascii'), len(column))
+        out += column.tobytes()
+    out += struct.pack("<L", len(blob))
+    out += blob
+    return bytes(out)
+
+def decode_commands(data):
+    """Decode bytes from `encode_commands` into a CommandTable
+
+    Raises EndOfData if data is truncated, or ValueError if it is otherwise
+    not a valid encoding.
+    """
+    br = BinReader(data)
+    columns = {}
+    for name in COLUMNS:
+        typecode = br.read_exact(1).decode('ascii')
+        count = br.read_u32()
+        column = array(typecode)
+        column.frombytes(br.read_exact(count * column.itemsize))
+        columns[name] = column
+    blob_length = br.read_u32()
+    blob = BinReader(br.read_exact(blob_length))
+    if sum(columns['lengths']) != blob_length:
+        raise ValueError("Command lengths don't match the encoded bytes")
+
+    table = CommandTable(blob)
+    for name, column in columns.items():
+        setattr(table, name, column)
+    offset = 0
+    for length in table.lengths:
+        table.offsets.append(offset)
+        offset += length
+    table.index_players()
+    return table
+
+class ParseCache(object):
+    """On-disk cache of parsed recordings
+
+    Each entry holds the header dict and the encoded timestamped commands of
+    one recording, keyed by a hash of its contents and the parser version.
+    Entries are evicted least recently used first once the cache grows past
+    max_bytes; the modification time of an entry records its last use.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, "%s-v%d.jcache" % (key, PARSER_VERSION))
+
+    def get(self, key):
+        """Return (header_dict, CommandTable) for a key, or None on a miss
+
+        An entry which can't be decoded (e.g. truncated) is removed, and is a
+        miss.
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        if data[:4] != MAGIC:
+            return None
+        try:
+            header_length = struct.unpack_from("<L", data, 4)[0]
+            header_dict = json.loads(data[8:8 + header_length].decode('utf-8'))
+            return header_dict, decode_commands(memoryview(data)[8 + header_length:])
+        except (struct.error, ValueError, EndOfData):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def put(self, key, header_dict, timestamped_commands):
+        """Store a parsed recording, then evict old entries if over the size cap
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        header = json.dumps(header_dict).encode('utf-8')
+        data = MAGIC + struct.pack("<L", len(header)) + header + encode_commands(timestamped_commands)
+        # Write to a temporary file first, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._entry_path(key))
+        self.evict(keep=self._entry_path(key))
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_bytes
+
+        The entry at path keep, if given, is never removed
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".jcache") and entry.path != keep:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        if keep is not None and os.path.exists(keep):
+            total += os.path.getsize(keep)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass # Already removed by another process
+            total -= size
+
+    def load(self, gamefile, workers=None):
+        """Return (header_dict, timestamped_commands) for a recording file
+
+        On a miss the recording is parsed (with workers as for `parse_game`)
+        and the result stored.
+        """
+        with stage("cache_lookup"):
+            key = file_hash(gamefile)
+            cached = self.get(key)
+            if cached is not None:
+                header_dict, table = cached
+                return header_dict, list(table)
+        header_dict, timestamped_commands = parse_game(gamefile, workers)
+        with stage("cache_store"):
+            self.put(key, header_dict, timestamped_commands)
+        return header_dict, timestamped_commands
+
+def parse_game(gamefile, workers=None):
+    """Parse a recording file, returning (header_dict, timestamped_commands)
+
+    If workers is given, the body is decoded across that many processes (see
+    `janissary.parallel`).
+    """
+    with open(gamefile, 'rb') as f:
+        rec = RecordedGame(f)
+        with stage("header"):
+            header_dict = rec.header().header_dict()
+        with stage("body"):
+            if workers is None:
+                with rec.body_reader() as body_reader:
+                    timestamped_commands = janissary.body.timestamped_commands(body_reader)
+            else:
+                timestamped_commands = parallel_timestamped_commands(rec.body_bytes(), workers)
+    return header_dict, timestamped_commands
+
+def load_game(gamefile, cache=None, workers=None):
+    """Return (header_dict, timestamped_commands) for a recording file
+
+    The result is taken from, or stored in, the ParseCache if one is given.
+    workers is as for `parse_game`.
+    """
+    with stage("load"):
+        if cache is None:
+            return parse_game(gamefile, workers)
+        return cache.load(gamefile, workers)
@@ -0,0 +1,290 @@
+"""SQLite catalog of the header metadata of a collection of recordings
+
+The catalog stores, for every recording, the game settings from its header,
+the game duration and, for every player, the header fields and the number of
+commands they issued. Updating the catalog only parses recordings which are
+new, or whose size or modification time changed since they were cataloged, so
+the catalog of a large archive can be kept up to date cheaply, and searched
+without parsing anything.
+"""
+import collections
+import concurrent.futures
+import itertools
+import os
+import sqlite3
+
+import janissary.static as static
+from .batch import quiet_call
+from .body import feed_commands
+from .cache import PARSER_VERSION, default_cache_dir, parse_game
+from .recorded_game import RecordedGame
+
+# Bump this whenever the tables below change; catalogs with another version are rebuilt
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE games (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    parser_version INTEGER NOT NULL,
+    error TEXT,
+    version REAL,
+    map_id INTEGER,
+    game_type INTEGER,
+    num_players INTEGER,
+    pop_limit INTEGER,
+    duration INTEGER
+);
+CREATE TABLE players (
+    game_id INTEGER NOT NULL REFERENCES games(id) ON DELETE CASCADE,
+    player_id INTEGER NOT NULL,
+    name TEXT,
+    civ INTEGER,
+    team INTEGER,
+    steam_id INTEGER,
+    command_count INTEGER NOT NULL
+);
+CREATE INDEX games_map_id ON games(map_id);
+CREATE INDEX games_duration ON games(duration);
+CREATE INDEX players_game_id ON players(game_id);
+CREATE INDEX players_civ ON players(civ);
+CREATE INDEX players_name ON players(name);
+CREATE INDEX players_steam_id ON players(steam_id);
+"""
+
+GAME_FIELDS = ('version', 'map_id', 'game_type', 'num_players', 'pop_limit')
+PLAYER_FIELDS = ('name', 'civ', 'team', 'steam_id')
+
+def default_catalog_path():
+    return os.path.join(default_cache_dir(), "catalog.sqlite")
+
+class CommandCounter(object):
+    """Body consumer (see `feed_commands`) counting the commands of each player
+    """
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.duration = 0
+        self._pending = []
+
+    def on_command(self, cmd, pending):
+        if pending:
+            self._pending.append(cmd)
+        else:
+            self.counts[cmd.player_id()] += 1
+        self.duration = cmd.timestamp
+
+    def finalize(self):
+        for cmd in self._pending:
+            self.counts[cmd.player_id()] += 1
+        self._pending = []
+
+def game_metadata(gamefile, parse_workers=None):
+    """Parse a recording into the dict of fields stored in the catalog
+
+    The game duration is the timestamp of the last command, in milliseconds.
+    If parse_workers is given, the body is decoded across that many processes
+    (see `janissary.parallel`).
+    """
+    counter = CommandCounter()
+    if parse_workers is None:
+        with open(gamefile, 'rb') as f:
+            rec = RecordedGame(f)
+            header_dict = rec.header().header_dict()
+            with rec.body_reader() as body_reader:
+                feed_commands(body_reader, [counter])
+    else:
+        header_dict, timestamped_commands = parse_game(gamefile, parse_workers)
+        for cmd in timestamped_commands:
+            counter.on_command(cmd, False)
+        counter.finalize()
+
+    metadata = {k: header_dict[k] for k in GAME_FIELDS}
+    metadata['duration'] = counter.duration
+    metadata['players'] = []
+    for p in header_dict['players']:
+        player = {k: p[k] for k in PLAYER_FIELDS}
+        player['player_id'] = p['player_index']
+        player['command_count'] = counter.counts[p['player_index']]
+        metadata['players'].append(player)
+    return metadata
+
+def catalog_worker(gamefile, parse_workers=None):
+    """Worker process entry point: return (gamefile, metadata, error), never raising
+    """
+    return (gamefile,) + quiet_call(game_metadata, gamefile, parse_workers)
+
+def _ids_for_name(name_map, name):
+    """IDs whose name in one of the janissary.static maps matches name (case insensitive)
+    """
+    return [k for k, v in name_map.items() if v.lower() == name.lower()]
+
+class Catalog(object):
+    """An SQLite database of recording metadata
+
+    Paths are stored as absolute paths. Recordings which failed to parse are
+    kept (with their error), so they are not retried until they change.
+    """
+    def __init__(self, path=None):
+        self.path = path if path is not None else default_catalog_path()
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self._create()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _create(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        with self.db:
+            self.db.execute("DROP TABLE IF EXISTS players")
+            self.db.execute("DROP TABLE IF EXISTS games")
+            self.db.executescript(SCHEMA)
+            self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def stale(self, gamefiles):
+        """Return (gamefile, size, mtime_ns) for the recordings not cataloged, or changed since they were
+        """
+        known = {
+            row['path']: (row['size'], row['mtime_ns'], row['parser_version'])
+            for row in self.db.execute("SELECT path, size, mtime_ns, parser_version FROM games")
+        }
+        stale = []
+        for gamefile in gamefiles:
+            st = os.stat(gamefile)
+            if known.get(gamefile) != (st.st_size, st.st_mtime_ns, PARSER_VERSION):
+                stale.append((gamefile, st.st_size, st.st_mtime_ns))
+        return stale
+
+    def store(self, gamefile, size, mtime_ns, metadata, error=None):
+        """Add or replace the entry for a recording
+
+        size and mtime_ns are those of the file before it was parsed, so that a
+        change made while parsing is picked up by the next update.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM games WHERE path = ?", (gamefile,))
+            values = {k: metadata[k] if metadata is not None else None for k in GAME_FIELDS + ('duration',)}
+            cursor = self.db.execute(
+                "INSERT INTO games (path, size, mtime_ns, parser_version, error, %s) VALUES (?, ?, ?, ?, ?, %s)" % (
+                    ", ".join(values), ", ".join("?" * len(values))),
+                (gamefile, size, mtime_ns, PARSER_VERSION, error) + tuple(values.values()))
+            if metadata is not None:
+                self.db.executemany(
+                    "INSERT INTO players (game_id, player_id, name, civ, team, steam_id, command_count) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(cursor.lastrowid, p['player_id'], p['name'], p['civ'], p['team'], p['steam_id'],
+                        p['command_count']) for p in metadata['players']])
+
+    def prune(self):
+        """Remove the entries of recordings which no longer exist; returns the number removed
+        """
+        missing = [(row['path'],) for row in self.db.execute("SELECT path FROM games")
+            if not os.path.exists(row['path'])]
+        with self.db:
+            self.db.executemany("DELETE FROM games WHERE path = ?", missing)
+        return len(missing)
+
+    def update(self, gamefiles, workers=None, callback=None, parse_workers=None):
+        """Catalog the new or changed recordings among gamefiles, across a process pool
+
+        Entries of recordings which no longer exist are removed.
+
+        Arguments:
+            gamefiles - List of recording paths
+            workers - Number of worker processes (default: one per CPU)
+            callback - Optionally called with (gamefile, error) as each recording is cataloged
+            parse_workers - If given, each worker decodes long bodies across
+            that many more processes (see `janissary.parallel`)
+        Returns:
+            A dict of counts: 'cataloged', 'unchanged', 'failed' and 'removed'
+        """
+        gamefiles = [os.path.abspath(g) for g in gamefiles]
+        stale = self.stale(gamefiles)
+        counts = {'cataloged': 0, 'unchanged': len(gamefiles) - len(stale), 'failed': 0}
+        if stale:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(catalog_worker, [gamefile for gamefile, _, _ in stale],
+                    itertools.repeat(parse_workers))
+                for (gamefile, size, mtime_ns), (_, metadata, error) in zip(stale, results):
+                    self.store(gamefile, size, mtime_ns, metadata, error)
+                    counts['failed' if error else 'cataloged'] += 1
+                    if callback is not None:
+                        callback(gamefile, error)
+        counts['removed'] = self.prune()
+        return counts
+
+    def query(self, map_type=None, civilization=None, player=None, steam_id=None,
+            min_duration=None, max_duration=None, num_players=None):
+        """Find cataloged games; every given condition must hold
+
+        Arguments:
+            map_type - Map name, e.g. "Arabia"
+            civilization - A civilization that one of the players played
+            player - Name of one of the players
+            steam_id - Steam ID of one of the players
+            min_duration, max_duration - Bounds on the game duration, in milliseconds
+            num_players - Number of players
+        Returns:
+            A list of dicts, one per game, ordered by path, each with a list of players
+        """
+        conditions = ["g.error IS NULL"]
+        params = []
+        def where(condition, *values):
+            conditions.append(condition)
+            params.extend(values)
+        def any_player(condition, *values):
+            where("EXISTS (SELECT 1 FROM players p WHERE p.game_id = g.id AND %s)" % condition, *values)
+        def in_ids(ids):
+            return "IN (%s)" % ", ".join("?" * len(ids)) if ids else "IN (NULL)"
+
+        if map_type is not None:
+            ids = _ids_for_name(static.MAP_TYPE_MAP, map_type)
+            where("g.map_id " + in_ids(ids), *ids)
+        if civilization is not None:
+            ids = _ids_for_name(static.CIVILIZATION_MAP, civilization)
+            any_player("p.civ " + in_ids(ids), *ids)
+        if player is not None:
+            any_player("p.name = ?", player)
+        if steam_id is not None:
+            any_player("p.steam_id = ?", steam_id)
+        if min_duration is not None:
+            where("g.duration >= ?", min_duration)
+        if max_duration is not None:
+            where("g.duration <= ?", max_duration)
+        if num_players is not None:
+            where("g.num_players = ?", num_players)
+
+        games = collections.OrderedDict()
+        for row in self.db.execute(
+                "SELECT g.* FROM games g WHERE %s ORDER BY g.path" % " AND ".join(conditions), params):
+            game = {k: row[k] for k in ('path',) + GAME_FIELDS + ('duration',)}
+            game['map_type'] = static.map_type_name(row['map_id'])
+            game['players'] = []
+            games[row['id']] = game
+        if games:
+            for row in self.db.execute(
+                    "SELECT * FROM players WHERE game_id IN (%s) ORDER BY game_id, player_id" % (
+                        ", ".join(str(i) for i in games))):
+                player = {k: row[k] for k in ('player_id',) + PLAYER_FIELDS + ('command_count',)}
+                player['civilization_name'] = static.civilization_name(row['civ'])
+                games[row['game_id']]['players'].append(player)
+        return list(games.values())
+
+    def failures(self):
+        """Return (path, error) for the recordings which failed to parse
+        """
+        return [(row['path'], row['error'])
+            for row in self.db.execute("SELECT path, error FROM games WHERE error IS NOT NULL ORDER BY path")]
@@ -0,0 +1,125 @@
+from array import array
+
+from .body import BodyParser, Command, DecodeContext, GameContext, Sync, command_class, make_timestamped_command
+
+# Stored in the player_id column when the owner of a command is unknown
+NO_PLAYER = -1
+
+class CommandTable(object):
+    """Columnar store of the timestamped commands in a log body
+
+    Instead of one TimestampedCommand object per command, the table keeps
+    parallel arrays with the timestamp, command type, player ID and the
+    position of the raw command bytes in the body. The selected IDs that each
+    command saw during the pass are kept in one flat array, so that any row
+    can be decoded again without replaying the game context.
+
+    Rows for a single player are indexed, so `player_rows()` is O(1).
+
+    The table behaves like a read-only list of TimestampedCommand objects:
+    indexing or iterating creates an object view of the row.
+    """
+    def __init__(self, bin_reader):
+        self._body = bin_reader
+        self.timestamps = array('q')
+        self.types = array('B')
+        self.player_ids = array('h')
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        # Row i selected selected_ids[selection_offsets[i]:selection_offsets[i+1]]
+        self.selection_offsets = array('I', [0])
+        self.selected_ids = array('I')
+        self._player_rows = {}
+
+    @staticmethod
+    def from_body(bin_reader):
+        """Parse a log body into a new CommandTable
+        """
+        table = CommandTable(bin_reader)
+        game_context = GameContext()
+        # Commands which left a player lookup unresolved, by row. They are
+        # kept until the lookups are resolved at the end of the pass.
+        pending = {}
+        for op in BodyParser(bin_reader):
+            if isinstance(op, Sync):
+                game_context.timestamp += op.time_delta
+            if isinstance(op, Command):
+                unresolved_count = len(game_context.unresolved_lookups)
+                tscmd = make_timestamped_command(op, game_context, lazy=True)
+                player_id = tscmd.player_id()
+                if len(game_context.unresolved_lookups) > unresolved_count:
+                    pending[len(table.types)] = tscmd
+                table._append(op, tscmd.timestamp, player_id, tscmd._attributes.get('selected_ids', ()))
+
+        game_context.resolve_lookups()
+        for row, tscmd in pending.items():
+            player_id = tscmd.player_id()
+            if player_id is not None:
+                table.player_ids[row] = player_id
+
+        table.index_players()
+        return table
+
+    def index_players(self):
+        """(Re)build the index of rows by player, from the player_id column
+        """
+        self._player_rows = {}
+        for row, player_id in enumerate(self.player_ids):
+            if player_id != NO_PLAYER:
+                self._player_rows.setdefault(player_id, array('I')).append(row)
+
+    def _append(self, op, timestamp, player_id, selected_ids):
+        self.timestamps.append(timestamp)
+        self.types.append(op.type)
+        self.player_ids.append(NO_PLAYER if player_id is None else player_id)
+        self.offsets.append(op.offset)
+        self.lengths.append(len(op.data))
+        self.selected_ids.extend(selected_ids)
+        self.selection_offsets.append(len(self.selected_ids))
+
+    def player_rows(self, player_id):
+        """Return the row indices of all commands from a player, in order
+        """
+        return self._player_rows.get(player_id, array('I'))
+
+    def player_id(self, row):
+        """Return the player ID for a row, or None if unknown
+        """
+        player_id = self.player_ids[row]
+        return None if player_id == NO_PLAYER else player_id
+
+    def data(self, row):
+        """Return the raw bytes of the command in a row
+        """
+        self._body.seek(self.offsets[row])
+        return self._body.read(self.lengths[row])
+
+    def command(self, row):
+        """Return a TimestampedCommand object view of a row
+        """
+        if row < 0:
+            row += len(self)
+        start, end = self.selection_offsets[row], self.selection_offsets[row + 1]
+        context = DecodeContext(self.timestamps[row], self.player_id(row), list(self.selected_ids[start:end]))
+        cmd_type = self.types[row]
+        return command_class(cmd_type)(cmd_type, self.data(row), context)
+
+    def player_commands(self, player_id):
+        """Generate object views of all commands from a player
+        """
+        for row in self.player_rows(player_id):
+            yield self.command(row)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self.command(r) for r in range(*row.indices(len(self)))]
+        if row >= len(self) or row < -len(self):
+            raise IndexError("CommandTable row out of range")
+        return self.command(row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.command(row)
@@ -0,0 +1,102 @@
+import asyncio
+import struct
+import time
+
+from .body import BodyParser, Command, GameContext, Sync, make_timestamped_command
+from .utils import BinReader
+
+class RecordingFollower(object):
+    """Incrementally parse a recording that is still being written
+
+    Each call to `poll()` reads whatever the game has appended to the file
+    since the last call, and returns the timestamped commands in it. The parse
+    position and GameContext are kept between polls. An op at the end of the
+    file which is not completely written yet is held back, and parsed once
+    the rest of it has been written.
+
+    Commands whose player can't be inferred when they are parsed get their
+    player_id later, in place, as soon as a later op tells us the owner of
+    their selection, exactly as in a full parse. Until `finish()`, which may
+    still prefer the owner learned for the selected objects themselves (see
+    `GameContext.resolve_lookups`), the player attribution of those commands
+    is provisional.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.game_context = GameContext()
+        self.header_length = None
+        # File offset of the first byte not yet parsed
+        self._offset = None
+        # Bytes from _offset which did not yet form a complete op
+        self._pending = b''
+
+    def body_offset(self):
+        """Body offset of the next op to be parsed, or None if the header isn't written yet
+        """
+        if self._offset is None:
+            return None
+        return self._offset - self.header_length
+
+    def poll(self):
+        """Parse any newly written ops, and return the new timestamped commands
+        """
+        with open(self.path, 'rb') as f:
+            if self.header_length is None:
+                length_word = f.read(4)
+                if len(length_word) < 4:
+                    return []
+                self.header_length = struct.unpack("<L", length_word)[0]
+                self._offset = self.header_length
+            f.seek(self._offset + len(self._pending))
+            new_data = f.read()
+
+        if len(new_data) == 0:
+            return []
+        data = self._pending + new_data
+        body_reader = BinReader(data)
+        parser = iter(BodyParser(body_reader))
+        commands = []
+        while True:
+            op_start = body_reader.tell()
+            try:
+                op = next(parser)
+            except StopIteration:
+                break
+            if isinstance(op, Sync):
+                self.game_context.timestamp += op.time_delta
+            if isinstance(op, Command):
+                commands.append(make_timestamped_command(op, self.game_context))
+
+        # Keep the incomplete op (if any) for the next poll
+        self._pending = data[op_start:]
+        self._offset += op_start
+        return commands
+
+    def finish(self):
+        """Resolve the player lookups still waiting, once the recording is complete
+
+        This is what a full parse does at the end of the log. Following may
+        go on afterwards, but later commands are then no longer guaranteed
+        the same players as in a full parse.
+        """
+        self.game_context.resolve_lookups()
+
+    async def follow(self, interval=0.2, idle_timeout=None):
+        """Asynchronously yield timestamped commands as they are written
+
+        The file is polled every interval seconds. If idle_timeout is given,
+        following stops once the file has not grown for that many seconds,
+        and the recording is then taken to be complete (see `finish()`).
+        """
+        last_growth = time.monotonic()
+        while True:
+            offset = self._offset, len(self._pending)
+            commands = await asyncio.get_running_loop().run_in_executor(None, self.poll)
+            for cmd in commands:
+                yield cmd
+            if (self._offset, len(self._pending)) != offset or commands:
+                last_growth = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - last_growth > idle_timeout:
+                self.finish()
+                return
+            await asyncio.sleep(interval)
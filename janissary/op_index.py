@@ -0,0 +1,262 @@
+from array import array
+import json
+import os
+import struct
+import tempfile
+import zlib
+
+from .body import (OBJECTS, OP_COMMAND, OP_SYNC, REMOVED, BodyParser, Command, ContextCheckpoint,
+    ContextHistory, Sync)
+from .cache import PARSER_VERSION
+from .recorded_game import RecordedGame
+from .utils import BinReader, file_hash
+
+SIDECAR_EXTENSION = ".jidx"
+MAGIC = b"JNIX"
+FORMAT_VERSION = 3
+# magic, format version, recording size, recording mtime (ns), sha256 of the recording, op count
+HEADER = struct.Struct("<4sLQq32sL")
+# After the columns: parser version and interval (ms) of the GameContext
+# checkpoints, and the length of their compressed data (0 if there are none)
+CHECKPOINTS_HEADER = struct.Struct("<LLL")
+
+class InvalidIndex(Exception):
+    pass
+
+class OpIndex(object):
+    """Index of the Sync and Command ops in a recording body
+
+    For every op it stores the byte offset in the body (of the op type word),
+    the op type, the command type (for commands) and the cumulative timestamp
+    once the op has been applied. Counting ops, the game duration and finding
+    the Nth command can be answered from the index alone; `read_command` reads
+    a single command op from the body.
+
+    The index is saved as a sidecar file next to the recording, and records the
+    size, modification time and sha256 of the recording it was built from. It
+    can also hold the GameContext checkpoints of the recording (see
+    `RecordedGame.context_checkpoints`), so that they are only built once.
+    """
+    def __init__(self, recording_size, recording_mtime_ns, recording_hash):
+        self.recording_size = recording_size
+        self.recording_mtime_ns = recording_mtime_ns
+        self.recording_hash = recording_hash
+        self.offsets = array('I')
+        self.op_types = array('B')
+        self.command_types = array('B')
+        self.timestamps = array('i')
+        self._command_ops = None
+        self.checkpoint_interval = None
+        # Compressed checkpoints, decoded on demand
+        self._checkpoint_data = b""
+
+    @staticmethod
+    def sidecar_path(gamefile):
+        return gamefile + SIDECAR_EXTENSION
+
+    @staticmethod
+    def build(gamefile):
+        """Build the index of a recording file by scanning its body
+        """
+        st = os.stat(gamefile)
+        index = OpIndex(st.st_size, st.st_mtime_ns, file_hash(gamefile))
+        with open(gamefile, 'rb') as f, RecordedGame(f).body_reader() as body_reader:
+            parser = iter(BodyParser(body_reader))
+            timestamp = 0
+            while True:
+                offset = body_reader.tell()
+                try:
+                    op = next(parser)
+                except StopIteration:
+                    break
+                if isinstance(op, Sync):
+                    timestamp += op.time_delta
+                    index._append(offset, OP_SYNC, 0, timestamp)
+                elif isinstance(op, Command):
+                    index._append(offset, OP_COMMAND, op.type, timestamp)
+        return index
+
+    def _append(self, offset, op_type, command_type, timestamp):
+        self.offsets.append(offset)
+        self.op_types.append(op_type)
+        self.command_types.append(command_type)
+        self.timestamps.append(timestamp)
+
+    def save(self, path):
+        """Write the index to path (atomically)
+        """
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, self.recording_size, self.recording_mtime_ns,
+            bytes.fromhex(self.recording_hash), len(self.offsets))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            for column in (self.offsets, self.op_types, self.command_types, self.timestamps):
+                f.write(column.tobytes())
+            f.write(CHECKPOINTS_HEADER.pack(PARSER_VERSION, self.checkpoint_interval or 0,
+                len(self._checkpoint_data)))
+            f.write(self._checkpoint_data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path, gamefile=None, verify=False):
+        """Read an index from path
+
+        If gamefile is given, the index is checked against the recording, and
+        InvalidIndex raised if it doesn't match. The recording is only read
+        (to compare its hash) if its size or modification time changed, or if
+        verify is set; otherwise the check is a stat().
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            raise InvalidIndex("Index file is truncated")
+        magic, version, size, mtime_ns, digest, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise InvalidIndex("Not an index file, or an unsupported version")
+
+        index = OpIndex(size, mtime_ns, digest.hex())
+        br = BinReader(data, HEADER.size)
+        for column in (index.offsets, index.op_types, index.command_types, index.timestamps):
+            column_bytes = br.read(count * column.itemsize)
+            if len(column_bytes) != count * column.itemsize:
+                raise InvalidIndex("Index file is truncated")
+            column.frombytes(column_bytes)
+        checkpoints_header = br.read(CHECKPOINTS_HEADER.size)
+        if len(checkpoints_header) != CHECKPOINTS_HEADER.size:
+            raise InvalidIndex("Index file is truncated")
+        parser_version, interval_ms, length = CHECKPOINTS_HEADER.unpack(checkpoints_header)
+        checkpoint_data = br.read(length)
+        if len(checkpoint_data) != length:
+            raise InvalidIndex("Index file is truncated")
+        # Checkpoints taken by another parser version may not replay the same
+        if parser_version == PARSER_VERSION and length:
+            index.checkpoint_interval = interval_ms
+            index._checkpoint_data = checkpoint_data
+
+        if gamefile is not None and not index.matches(gamefile, verify):
+            raise InvalidIndex("Index does not match %s" % gamefile)
+        return index
+
+    def matches(self, gamefile, verify=False):
+        """Whether the index was built from gamefile as it is now
+
+        A recording with the same size and modification time is assumed
+        unchanged, unless verify is set. If only the modification time
+        changed, the hash decides, and the index is updated to the new time.
+        """
+        st = os.stat(gamefile)
+        if st.st_size != self.recording_size:
+            return False
+        if st.st_mtime_ns == self.recording_mtime_ns and not verify:
+            return True
+        if file_hash(gamefile) != self.recording_hash:
+            return False
+        self.recording_mtime_ns = st.st_mtime_ns
+        return True
+
+    @staticmethod
+    def for_recording(gamefile, verify=False):
+        """Return the index of a recording, from its sidecar file if valid
+
+        Otherwise the index is built, and the sidecar file (re)written. verify
+        is as for `load`.
+        """
+        path = OpIndex.sidecar_path(gamefile)
+        if os.path.exists(path):
+            try:
+                index = OpIndex.load(path)
+                saved_mtime_ns = index.recording_mtime_ns
+                if index.matches(gamefile, verify):
+                    if index.recording_mtime_ns != saved_mtime_ns:
+                        # Only touched: save the new time, so the next load doesn't hash it again
+                        index.save(path)
+                    return index
+            except InvalidIndex:
+                pass
+        index = OpIndex.build(gamefile)
+        index.save(path)
+        return index
+
+    def context_checkpoints(self, interval_ms):
+        """Return the stored checkpoints, or None if there are none for interval_ms
+        """
+        if self.checkpoint_interval != interval_ms:
+            return None
+        try:
+            return _decode_checkpoints(self._checkpoint_data)
+        except (ValueError, KeyError, IndexError, TypeError, zlib.error):
+            return None
+
+    def set_context_checkpoints(self, interval_ms, checkpoints):
+        """Store the checkpoints (from one pass, taken every interval_ms) with the index
+        """
+        self.checkpoint_interval = interval_ms
+        self._checkpoint_data = _encode_checkpoints(checkpoints)
+
+    def op_count(self):
+        return len(self.op_types)
+
+    def command_ops(self):
+        """Return the op numbers of all commands, in order
+        """
+        if self._command_ops is None:
+            self._command_ops = array('I', (i for i, t in enumerate(self.op_types) if t == OP_COMMAND))
+        return self._command_ops
+
+    def command_count(self):
+        return len(self.command_ops())
+
+    def sync_count(self):
+        return self.op_count() - self.command_count()
+
+    def duration(self):
+        """Game duration in milliseconds, the timestamp after the last op
+        """
+        if len(self.timestamps) == 0:
+            return 0
+        return self.timestamps[-1]
+
+    def command_offset(self, n):
+        """Body offset of the Nth command op
+        """
+        return self.offsets[self.command_ops()[n]]
+
+    def command_timestamp(self, n):
+        return self.timestamps[self.command_ops()[n]]
+
+    def read_command(self, body_reader, n):
+        """Read the Nth Command op from a body reader
+        """
+        # Skip the op type word
+        body_reader.seek(self.command_offset(n) + 4)
+        return Command.parse(body_reader)
+
+def _encode_checkpoints(checkpoints):
+    history = checkpoints[0].history
+    changes = []
+    for table, key, value in history.changes:
+        if value is REMOVED:
+            value = None
+        elif table == OBJECTS:
+            value = [value['type'], value['object_type_id'], value['player_id']]
+        changes.append([table, key, value])
+    data = {
+        'changes': changes,
+        'lookup_owners': history.lookup_owners,
+        'checkpoints': [[c.offset, c.timestamp, c.last_selected_ids, c.change_count, c.lookup_count]
+            for c in checkpoints],
+    }
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf8'))
+
+def _decode_checkpoints(data):
+    data = json.loads(zlib.decompress(data))
+    history = ContextHistory()
+    for table, key, value in data['changes']:
+        if value is None:
+            value = REMOVED
+        elif table == OBJECTS:
+            value = {'type': value[0], 'object_id': key, 'object_type_id': value[1], 'player_id': value[2]}
+        history.changes.append((table, key, value))
+    history.lookup_owners = data['lookup_owners']
+    return [ContextCheckpoint(offset, timestamp, last_selected_ids, history, change_count, lookup_count)
+        for offset, timestamp, last_selected_ids, change_count, lookup_count in data['checkpoints']]
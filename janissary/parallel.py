@@ -0,0 +1,102 @@
+"""Decode a body across a process pool
+
+Decoding is in two phases, plus a serial stitch:
+
+1. A framing pass walks the ops without decoding them (see
+   `BodyParser.frames`), and splits the body into chunks at op boundaries,
+   noting the time at the start of each chunk.
+2. Each chunk is decoded on its own, in a worker process, in a ChunkContext:
+   everything but the selection reused from before the chunk and what the
+   commands tell us about object ownership.
+3. In body order, commands reusing the selection from before their chunk get
+   it, and every command updates the real GameContext, as in the serial pass.
+
+The commands returned are the same as those of `timestamped_commands`.
+"""
+import concurrent.futures
+import os
+
+from .body import (BodyParser, ChunkContext, Command, GameContext, Sync, make_timestamped_command,
+    timestamped_commands)
+from .profiling import stage
+from .utils import BinReader
+
+# Bodies are not split into chunks smaller than this
+MIN_CHUNK_BYTES = 256 * 1024
+
+def chunk_boundaries(body, chunk_count):
+    """Return (body offset, time) at the start of each of (up to) chunk_count chunks
+    """
+    chunk_bytes = max(len(body) // chunk_count, 1)
+    boundaries = [(0, 0)]
+    next_boundary = chunk_bytes
+    parser = BodyParser(BinReader(body))
+    for offset, _ in parser.frames():
+        if offset >= next_boundary:
+            boundaries.append((offset, parser.time))
+            next_boundary = offset + chunk_bytes
+    return boundaries
+
+def decode_chunk(chunk, start_time):
+    """Worker process entry point: decode the commands in a chunk of body
+
+    Returns:
+        commands - The timestamped commands, decoded in a ChunkContext
+        outer_rows - Indices of the commands which reuse the selection from before the chunk
+        last_selected_ids - The selection at the end of the chunk, or None if
+        no command in it sets the selection
+    """
+    game_context = ChunkContext(start_time)
+    commands = []
+    outer_rows = []
+    for op in BodyParser(BinReader(chunk)):
+        if isinstance(op, Sync):
+            game_context.timestamp += op.time_delta
+        if isinstance(op, Command):
+            cmd = make_timestamped_command(op, game_context)
+            if not game_context.selection_set and cmd.LAYOUT is not None and cmd.LAYOUT.has_selection:
+                outer_rows.append(len(commands))
+            commands.append(cmd)
+    last_selected_ids = game_context.last_selected_ids if game_context.selection_set else None
+    return commands, outer_rows, last_selected_ids
+
+def parallel_timestamped_commands(body, workers=None, chunk_count=None):
+    """Parse a body across a process pool, returning the same list of
+    timestamped commands as `timestamped_commands`
+
+    Arguments:
+        body - The body bytes (e.g. `RecordedGame.body_bytes()`)
+        workers - Number of worker processes (default: one per CPU)
+        chunk_count - Number of chunks the body is split into (default: 4 per worker)
+    Bodies too short to split are parsed serially, in this process.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_count is None:
+        chunk_count = 4 * workers
+    chunk_count = min(chunk_count, len(body) // MIN_CHUNK_BYTES)
+    if workers <= 1 or chunk_count <= 1:
+        return timestamped_commands(BinReader(body))
+
+    with stage("frame"):
+        boundaries = chunk_boundaries(body, chunk_count)
+    ends = [offset for offset, _ in boundaries[1:]] + [len(body)]
+
+    game_context = GameContext()
+    commands = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(decode_chunk,
+            [body[start:end] for (start, _), end in zip(boundaries, ends)],
+            [start_time for _, start_time in boundaries])
+        with stage("stitch"):
+            for chunk_commands, outer_rows, last_selected_ids in results:
+                outer_rows = set(outer_rows)
+                for row, cmd in enumerate(chunk_commands):
+                    cmd.stitch(game_context, game_context.last_selected_ids if row in outer_rows else None)
+                if last_selected_ids is not None:
+                    game_context.last_selected_ids = last_selected_ids
+                commands.extend(chunk_commands)
+
+    with stage("resolve_lookups"):
+        game_context.resolve_lookups()
+    return commands
@@ -0,0 +1,324 @@
+"""Per-player statistics aggregated across many recordings
+
+Each recording is reduced (in a worker process) to one PlayerStats per player:
+command counts by type, units trained, research timings and a quantile sketch
+of the per-minute APM. PlayerStats merge by addition, so the totals of a
+corpus are updated with new recordings without reprocessing the old ones.
+Players are matched across games by the steam_id in the header; players
+without one (AIs) are left out.
+"""
+from collections import Counter
+import concurrent.futures
+import json
+import math
+import os
+import tempfile
+
+import janissary.body as body
+import janissary.static as static
+from .batch import quiet_call
+from .recorded_game import RecordedGame
+from .reports.actions_rate_report import ActionsRateReport
+from .reports.command_summary_report import CommandSummaryReport
+from .reports.unit_production_report import UnitProductionReport
+
+FORMAT_VERSION = 1
+
+class QuantileSketch(object):
+    """Mergeable sketch of a distribution of non-negative values
+
+    Values are counted in logarithmic buckets, so that every quantile is
+    estimated within relative_accuracy of a value in the distribution (as in
+    DDSketch). Merging two sketches adds their bucket counts.
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = Counter()
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value <= 0:
+            self.zero_count += count
+        else:
+            self.buckets[math.ceil(math.log(value, self._gamma))] += count
+        self.count += count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with different accuracies")
+        self.buckets.update(other.buckets)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1), or None if the sketch is empty
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self._gamma ** index / (self._gamma + 1)
+        return 2 * self._gamma ** max(self.buckets) / (self._gamma + 1)
+
+    def serializable(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'zero_count': self.zero_count,
+            'buckets': {str(k): v for k, v in self.buckets.items()},
+        }
+
+    @staticmethod
+    def from_serializable(d):
+        sketch = QuantileSketch(d['relative_accuracy'])
+        sketch.buckets.update({int(k): v for k, v in d['buckets'].items()})
+        sketch.zero_count = d['zero_count']
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        return sketch
+
+class PlayerStats(object):
+    """Mergeable totals for one player, over one or more games
+    """
+    def __init__(self):
+        self.names = Counter()
+        self.games = 0
+        self.play_ms = 0
+        self.commands = Counter()
+        self.units = Counter()
+        # technology ID -> [games researched, sum of first research times, earliest first research time]
+        self.research = {}
+        # Distribution of the commands per minute, over every minute played
+        self.apm = QuantileSketch()
+
+    def add_research(self, technology_id, timestamp, count=1, total_ms=None):
+        total_ms = timestamp if total_ms is None else total_ms
+        entry = self.research.get(technology_id)
+        if entry is None:
+            self.research[technology_id] = [count, total_ms, timestamp]
+        else:
+            entry[0] += count
+            entry[1] += total_ms
+            entry[2] = min(entry[2], timestamp)
+
+    def merge(self, other):
+        self.names.update(other.names)
+        self.games += other.games
+        self.play_ms += other.play_ms
+        self.commands.update(other.commands)
+        self.units.update(other.units)
+        for technology_id, (count, total_ms, first_ms) in other.research.items():
+            self.add_research(technology_id, first_ms, count, total_ms)
+        self.apm.merge(other.apm)
+
+    def name(self):
+        """The name the player used most often
+        """
+        return self.names.most_common(1)[0][0] if self.names else ""
+
+    def average_apm(self):
+        if self.play_ms == 0:
+            return 0.0
+        return sum(self.commands.values()) * 60000.0 / self.play_ms
+
+    def summary(self):
+        """Return a dict of the headline figures derived from the totals
+        """
+        return {
+            'name': self.name(),
+            'games': self.games,
+            'average_apm': self.average_apm(),
+            'median_apm': self.apm.quantile(0.5),
+            'p90_apm': self.apm.quantile(0.9),
+            'commands': dict(self.commands.most_common()),
+            'units': dict(self.units.most_common()),
+            'research': {
+                t: {
+                    'games': count,
+                    'average_ms': total_ms / count,
+                    'earliest_ms': first_ms,
+                } for t, (count, total_ms, first_ms) in sorted(self.research.items())
+            },
+        }
+
+    def serializable(self):
+        return {
+            'names': dict(self.names),
+            'games': self.games,
+            'play_ms': self.play_ms,
+            'commands': dict(self.commands),
+            'units': dict(self.units),
+            'research': {str(k): v for k, v in self.research.items()},
+            'apm': self.apm.serializable(),
+        }
+
+    @staticmethod
+    def from_serializable(d):
+        stats = PlayerStats()
+        stats.names.update(d['names'])
+        stats.games = d['games']
+        stats.play_ms = d['play_ms']
+        stats.commands.update(d['commands'])
+        stats.units.update(d['units'])
+        stats.research = {int(k): list(v) for k, v in d['research'].items()}
+        stats.apm = QuantileSketch.from_serializable(d['apm'])
+        return stats
+
+class ResearchTimings(object):
+    """Body consumer (see `feed_commands`) recording when each player first
+    researched each technology, and the span of the game's commands
+    """
+    def __init__(self):
+        # (player_id, technology_id) -> timestamp
+        self.first_research = {}
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self._pending = []
+
+    def on_command(self, cmd, pending=False):
+        if self.first_timestamp is None:
+            self.first_timestamp = cmd.timestamp
+        self.last_timestamp = cmd.timestamp
+        if isinstance(cmd, body.ResearchCommand):
+            if pending:
+                self._pending.append(cmd)
+            else:
+                self._add(cmd)
+
+    def finalize(self):
+        for cmd in self._pending:
+            self._add(cmd)
+        self._pending = []
+
+    def _add(self, cmd):
+        key = (cmd.player_id(), cmd.attributes()['technology_id'])
+        if key not in self.first_research or cmd.timestamp < self.first_research[key]:
+            self.first_research[key] = cmd.timestamp
+
+def reduce_game(gamefile):
+    """Parse a recording and reduce it to a dict of steam_id -> PlayerStats
+
+    The command counts, APM and unit totals come from the CommandSummaryReport,
+    ActionsRateReport and UnitProductionReport of the game.
+    """
+    with open(gamefile, 'rb') as f:
+        rec = RecordedGame(f)
+        header_dict = rec.header().header_dict()
+        summary = CommandSummaryReport(header_dict)
+        rates = ActionsRateReport(header_dict)
+        production = UnitProductionReport(header_dict)
+        research = ResearchTimings()
+        with rec.body_reader() as body_reader:
+            body.feed_commands(body_reader, [summary, rates, production, research])
+
+    if research.first_timestamp is None:
+        # No commands at all
+        play_ms = 0
+    else:
+        play_ms = research.last_timestamp - research.first_timestamp
+    players = {}
+    for p in header_dict['players']:
+        if p['steam_id'] == 0:
+            continue
+        player_id = p['player_index']
+        stats = players.setdefault(p['steam_id'], PlayerStats())
+        stats.names[p['name']] += 1
+        stats.games += 1
+        stats.play_ms += play_ms
+        for cmd_id, count in summary.player_command_counts(player_id).items():
+            stats.commands[static.command_name(cmd_id)] += count
+        for unit_type, count in production.unit_totals(player_id).items():
+            stats.units[static.unit_name(unit_type)] += count
+        for _, rate in rates.series.get(player_id, ()):
+            stats.apm.add(rate['Total'])
+        for (research_player_id, technology_id), timestamp in research.first_research.items():
+            if research_player_id == player_id:
+                stats.add_research(technology_id, timestamp)
+    return players
+
+def stats_worker(gamefile):
+    """Worker process entry point: return (gamefile, players, error), never raising
+    """
+    return (gamefile,) + quiet_call(reduce_game, gamefile)
+
+class CorpusStats(object):
+    """PlayerStats merged across a corpus of recordings, and the recordings included
+
+    Recordings are identified by their absolute path, and are assumed not to
+    change once written; a recording already included is never counted again.
+    """
+    def __init__(self):
+        self.gamefiles = set()
+        self.players = {}
+
+    def merge_game(self, gamefile, players):
+        self.gamefiles.add(gamefile)
+        for steam_id, stats in players.items():
+            if steam_id in self.players:
+                self.players[steam_id].merge(stats)
+            else:
+                self.players[steam_id] = stats
+
+    def update(self, gamefiles, workers=None, callback=None):
+        """Reduce the recordings not yet included across a process pool, and merge them in
+
+        Arguments:
+            gamefiles - List of recording paths
+            workers - Number of worker processes (default: one per CPU)
+            callback - Optionally called with (gamefile, error) as each recording is merged
+        Returns:
+            A dict of counts: 'added', 'skipped' (already included) and 'failed'
+        """
+        # A recording given twice is only counted (and reduced) once
+        gamefiles = list(dict.fromkeys(os.path.abspath(g) for g in gamefiles))
+        new = [g for g in gamefiles if g not in self.gamefiles]
+        counts = {'added': 0, 'skipped': len(gamefiles) - len(new), 'failed': 0}
+        if new:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for gamefile, players, error in executor.map(stats_worker, new):
+                    if error is None:
+                        self.merge_game(gamefile, players)
+                        counts['added'] += 1
+                    else:
+                        counts['failed'] += 1
+                    if callback is not None:
+                        callback(gamefile, error)
+        return counts
+
+    def serializable(self):
+        return {
+            'version': FORMAT_VERSION,
+            'gamefiles': sorted(self.gamefiles),
+            'players': {str(k): v.serializable() for k, v in self.players.items()},
+        }
+
+    @staticmethod
+    def from_serializable(d):
+        if d.get('version') != FORMAT_VERSION:
+            raise ValueError("Unsupported player stats version %r" % (d.get('version'),))
+        corpus = CorpusStats()
+        corpus.gamefiles = set(d['gamefiles'])
+        corpus.players = {int(k): PlayerStats.from_serializable(v) for k, v in d['players'].items()}
+        return corpus
+
+    @staticmethod
+    def load(path):
+        """Read the stats saved at path, or return empty stats if there is no such file
+        """
+        if not os.path.exists(path):
+            return CorpusStats()
+        with open(path) as f:
+            return CorpusStats.from_serializable(json.load(f))
+
+    def save(self, path):
+        """Write the stats to path (atomically)
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.serializable(), f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,102 @@
+"""Per-stage wall and CPU time instrumentation
+
+The parsers and reports mark their stages with `stage()`. This costs nothing
+unless a StageTimer is active, in which case the time spent in each stage is
+recorded:
+
+    timer = StageTimer()
+    with timer:
+        header_dict, commands = janissary.cache.load_game(path)
+        janissary.reports.render_html(header_dict, commands)
+    print(timer.table())
+
+Stages may be nested; a nested stage is recorded under its parent's name, e.g.
+"report/UnitProductionReport".
+
+The active timer is per thread (and asyncio task), so a timer only sees the
+stages of the code it wraps, even in a threaded server.
+"""
+import contextlib
+import contextvars
+import time
+
+from tabulate import tabulate
+
+_active_timer = contextvars.ContextVar('janissary_active_timer', default=None)
+
+class StageTimer(object):
+    """Collects wall and CPU time for named stages while active
+    """
+    def __init__(self):
+        # stage path -> [wall seconds, cpu seconds, call count], in order of first use
+        self.stages = {}
+        self._stack = []
+        self._token = None
+        self._start = None
+        self.total_wall = None
+        self.total_cpu = None
+
+    def start(self):
+        """Make this the active timer
+        """
+        self._token = _active_timer.set(self)
+        self._start = (time.perf_counter(), time.process_time())
+
+    def stop(self):
+        """Deactivate the timer, and record the total time since start()
+        """
+        _active_timer.reset(self._token)
+        self.total_wall = time.perf_counter() - self._start[0]
+        self.total_cpu = time.process_time() - self._start[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._stack.append(name)
+        # Create the entry now, so that stages are listed before their children
+        entry = self.stages.setdefault("/".join(self._stack), [0.0, 0.0, 0])
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            entry[0] += time.perf_counter() - wall_start
+            entry[1] += time.process_time() - cpu_start
+            entry[2] += 1
+            self._stack.pop()
+
+    def results(self):
+        """Return a list of (stage, wall seconds, cpu seconds, calls)
+        """
+        return [(path, wall, cpu, calls) for path, (wall, cpu, calls) in self.stages.items()]
+
+    def table(self):
+        """Format the results as a table
+        """
+        rows = []
+        for path, wall, cpu, calls in self.results():
+            rows.append((path, "%.4f" % wall, "%.4f" % cpu, calls))
+        if self.total_wall is not None:
+            rows.append(("total", "%.4f" % self.total_wall, "%.4f" % self.total_cpu, ""))
+        return tabulate(rows, headers=["Stage", "Wall (s)", "CPU (s)", "Calls"])
+
+_null_stage = contextlib.nullcontext()
+
+def stage(name):
+    """Context manager marking a stage for the active StageTimer, if any
+    """
+    timer = _active_timer.get()
+    if timer is None:
+        return _null_stage
+    return timer.stage(name)
+
+def active_timer():
+    """Return the active StageTimer, or None
+    """
+    return _active_timer.get()
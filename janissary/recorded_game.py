@@ -1,30 +1,48 @@
-from io import BytesIO
+from bisect import bisect_right
+from io import UnsupportedOperation
+import mmap
+import os
 import struct
-import zlib
 
+from .body import commands_from_checkpoint, context_checkpoints
 from .header import Header
-from .utils import BinReader
+from .utils import BinReader, InflateStream
 
 class RecordedGame(object):
+    # Default game time between GameContext checkpoints, for commands_between
+    CHECKPOINT_INTERVAL = 60 * 1000 # ms
+
     def __init__(self, ioobj):
         self._file = ioobj
         self.header_length = self._get_header_length()
+        self._header_stream = None
+        self._body_reader = None
+        self._checkpoints = None
+
+    def header_stream(self):
+        """Get an IO object over the uncompressed header
+
+        The header is inflated on demand, only as far as it has been read, and
+        the stream is shared by every Header returned by `header()`.
+        """
+        if self._header_stream is None:
+            # Empirically, the first 4 bytes of the header are not part of the deflate
+            # data; in fact it seems to be zeros, but maybe not all the time. Skip it.
+            self._file.seek(8) # 4 for length word, + 4 for unknown empty word
+            self._header_stream = InflateStream(self._file.read(self.header_length-8))
+        return self._header_stream
 
     def header_bytes(self):
         """Get the uncompressed header bytes
         """
-        # Empirically, the first 4 bytes of the header are not part of the deflate
-        # data; in fact it seems to be zeros, but maybe not all the time. Skip it. 
-        self._file.seek(8) # 4 for length word, + 4 for unknown empty word
-        data = zlib.decompress(self._file.read(self.header_length-8), -15)
-        return data
+        stream = self.header_stream()
+        stream.seek(0)
+        return stream.read()
 
     def header(self):
         """Return a Header parser object
         """
-        header_bytes = self.header_bytes()
-        header_io = BinReader(BytesIO(header_bytes))
-        return Header(header_io)
+        return Header(BinReader(self.header_stream()))
 
     def body_bytes(self):
         """Get the uncompressed body bytes
@@ -33,6 +51,87 @@ class RecordedGame(object):
         data = self._file.read()
         return data
 
+    def body_reader(self):
+        """Get a BinReader over the body, without copying it
+
+        When the recording is a real file, the body is memory mapped. Otherwise
+        the body bytes are read once and wrapped in place. The caller should
+        close the reader (e.g. with a `with` block) once done with it.
+        """
+        try:
+            fileno = self._file.fileno()
+        except (AttributeError, UnsupportedOperation):
+            return BinReader(self.body_bytes())
+        data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        return BinReader(data, self.header_length)
+
+    def context_checkpoints(self, interval_ms=CHECKPOINT_INTERVAL):
+        """Return the GameContext checkpoints of the body
+
+        They are built with one pass over the body on first use, and kept. If
+        the recording is a file with a valid sidecar op index (see
+        `janissary.op_index`), they are read from the index when it holds
+        them, and otherwise saved in it once built.
+        """
+        if self._checkpoints is None:
+            index = self._sidecar_index()
+            if index is not None:
+                self._checkpoints = index.context_checkpoints(interval_ms)
+            if self._checkpoints is None:
+                self._checkpoints = context_checkpoints(self._shared_body_reader(), interval_ms)
+                if index is not None:
+                    index.set_context_checkpoints(interval_ms, self._checkpoints)
+                    try:
+                        index.save(index.sidecar_path(self._file.name))
+                    except OSError:
+                        pass
+        return self._checkpoints
+
+    def commands_between(self, start_ms, end_ms):
+        """Return the timestamped commands with start_ms <= timestamp < end_ms
+
+        Parsing resumes from the nearest context checkpoint before start_ms, so
+        only the window (and at most one checkpoint interval before it) is
+        parsed, once the checkpoints exist. The commands are the same as those
+        returned for the window by a full parse.
+        """
+        checkpoints = self.context_checkpoints()
+        i = bisect_right([c.timestamp for c in checkpoints], start_ms) - 1
+        return commands_from_checkpoint(self._shared_body_reader(), checkpoints[max(i, 0)],
+            start_ms, end_ms)
+
+    def _sidecar_index(self):
+        """Return the valid sidecar op index of the recording file, or None
+        """
+        from .op_index import InvalidIndex, OpIndex # op_index builds on this module
+        gamefile = getattr(self._file, 'name', None)
+        if not isinstance(gamefile, str) or not os.path.exists(OpIndex.sidecar_path(gamefile)):
+            return None
+        try:
+            return OpIndex.load(OpIndex.sidecar_path(gamefile), gamefile)
+        except (InvalidIndex, OSError):
+            return None
+
+    def close(self):
+        """Close the body reader used by `commands_between`, if any
+
+        The file object passed in is left open, for its owner to close.
+        """
+        if self._body_reader is not None:
+            self._body_reader.close()
+            self._body_reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _shared_body_reader(self):
+        if self._body_reader is None:
+            self._body_reader = self.body_reader()
+        return self._body_reader
+
     def _get_header_length(self):
         self._file.seek(0)
         # The first 4 bytes of the file appear to encode the length of the header
@@ -1,4 +1,4 @@
-from .html import render_html
-from .report import report
+from .html import HtmlRenderer, render_html, write_html
+from .report import consume_commands, report, report_consumers, write_report_json
 from .command_summary_report import CommandSummaryReport
 from .unit_production_report import UnitProductionReport
\ No newline at end of file
@@ -1,63 +1,149 @@
+from collections import Counter
+
 import janissary.body as body
 import janissary.static as static
+from janissary.command_table import CommandTable
 
-def collect_events(player_id, timestamped_commands, period_ms):
-    """Collect the number of commands per second in each time window
+def command_columns(timestamped_commands):
+    """Return the timestamp, command type and player ID columns of a command list
+
+    A CommandTable already stores its commands as columns, and is used as-is.
+    """
+    if isinstance(timestamped_commands, CommandTable):
+        return timestamped_commands.timestamps, timestamped_commands.types, timestamped_commands.player_ids
+    timestamps = [cmd.timestamp for cmd in timestamped_commands]
+    types = [cmd.type for cmd in timestamped_commands]
+    player_ids = [cmd.player_id() for cmd in timestamped_commands]
+    return timestamps, types, player_ids
+
+def bin_commands(timestamps, types, player_ids, period_ms):
+    """Count the commands in each (player, command type, time bin) in a single pass
+
+    Bins are period_ms wide, and start at the first timestamp. Commands at or
+    after the end of the last bin that starts before the final timestamp are
+    not counted, which matches the time points returned.
 
-    Arguments:
-        player_id - Only commands from this player are considered
-        timestamped_commands - list of TimestampedCommand objects
-        period_ms - The binning resolution in miliseconds
     Returns:
-        time, command_rate - A list of time points, and corresponding command
-        rate at that time (normalized to commands per minute)
+        time, counts - A list of the bin start times, and a Counter keyed by
+        (player_id, command_type, bin_index)
     """
-    time = []
+    if len(timestamps) == 0:
+        return [], Counter()
+    start_time = timestamps[0]
+    end_time = timestamps[-1]
+    bin_count = max(0, -(-(end_time - start_time) // period_ms))
+    time = [start_time + i * period_ms for i in range(bin_count)]
+
+    bins = [(t - start_time) // period_ms for t in timestamps]
+    counts = Counter(zip(player_ids, types, bins))
+    for key in [k for k in counts if k[2] >= bin_count]:
+        del counts[key]
+    return time, counts
+
+def command_rates(player_id, time, counts, command_types, period_ms):
+    """Build the per-bin command rates of a player from the binned counts
+
+    command_types is the ordered list of command type IDs to report; each bin
+    has a 'Total' entry followed by one entry per command name, normalized to
+    commands per minute.
+    """
+    command_names = list(dict.fromkeys(static.command_name(t) for t in command_types))
     command_rate = []
-    cur_time = timestamped_commands[0].timestamp
-    end_time = timestamped_commands[-1].timestamp
-
-    all_command_types = []
-    for cmd in timestamped_commands:
-        if cmd.command_name() not in all_command_types:
-            all_command_types.append(cmd.command_name())
-    
-    cmd_idx = 0
-    while cur_time < end_time:
+    for bin_index in range(len(time)):
         commands_this_period = {'Total': 0}
-        for cmd in all_command_types:
-            commands_this_period[cmd] = 0
-
-        while cmd_idx < len(timestamped_commands) and timestamped_commands[cmd_idx].timestamp < cur_time + period_ms:
-            if timestamped_commands[cmd_idx].player_id() == player_id:
-                commands_this_period['Total'] += 1
-                commands_this_period[timestamped_commands[cmd_idx].command_name()] += 1
-            cmd_idx += 1
-        time.append(cur_time)
+        for name in command_names:
+            commands_this_period[name] = 0
+        for cmd_type in command_types:
+            count = counts.get((player_id, cmd_type, bin_index), 0)
+            if count:
+                commands_this_period['Total'] += count
+                commands_this_period[static.command_name(cmd_type)] += count
         # Normalize command counts to counts per minute
         for k, v in commands_this_period.items():
             commands_this_period[k] = 60 * v / (period_ms * 1e-3)
         command_rate.append(commands_this_period)
-        cur_time += period_ms
+    return command_rate
 
-    return time, command_rate
+def collect_events(player_id, timestamped_commands, period_ms):
+    """Collect the number of commands per second in each time window
+
+    Arguments:
+        player_id - Only commands from this player are considered
+        timestamped_commands - list of TimestampedCommand objects, or a CommandTable
+        period_ms - The binning resolution in miliseconds
+    Returns:
+        time, command_rate - A list of time points, and corresponding command
+        rate at that time (normalized to commands per minute)
+    """
+    timestamps, types, player_ids = command_columns(timestamped_commands)
+    time, counts = bin_commands(timestamps, types, player_ids, period_ms)
+    return time, command_rates(player_id, time, counts, list(dict.fromkeys(types)), period_ms)
 
 class ActionsRateReport(object):
-    def __init__(self, header_dict, timestamped_commands):
-        TIME_SERIES_PERIOD = 60 * 1000 # ms
+    # Default width of the time series bins
+    TIME_SERIES_PERIOD = 60 * 1000 # ms
+
+    def __init__(self, header_dict, timestamped_commands=None, period_ms=TIME_SERIES_PERIOD):
+        """Create the report from a list of commands (or a CommandTable), or,
+        if none are given, incrementally with `on_command` and `finalize`
+        """
         self._num_players = header_dict['num_players']
         self._header_dict = header_dict
+        self._period_ms = period_ms
+        self._timestamps = []
+        self._types = []
+        self._player_ids = []
+        # (row, command) of the commands whose player ID is read at finalize()
+        self._pending = []
+
+        if timestamped_commands is not None:
+            self._compute(*command_columns(timestamped_commands))
+
+    def on_command(self, cmd, pending=False):
+        """Add the next command
+
+        If pending is set, the player ID of the command may still change, and
+        it is only read by `finalize`.
+        """
+        if pending:
+            self._pending.append((len(self._player_ids), cmd))
+        self._timestamps.append(cmd.timestamp)
+        self._types.append(cmd.type)
+        self._player_ids.append(cmd.player_id())
 
-        start_time = timestamped_commands[0].timestamp
-        end_time = timestamped_commands[-1].timestamp
+    def finalize(self):
+        """Compute the report, once all player IDs are known
+        """
+        for row, cmd in self._pending:
+            self._player_ids[row] = cmd.player_id()
+        self._pending = []
+        self._compute(self._timestamps, self._types, self._player_ids)
 
+    def _compute(self, timestamps, types, player_ids):
+        period_ms = self._period_ms
         self.series = {}
         self.average = {}
+        if not timestamps:
+            # No commands, e.g. a game left right away
+            for player_id in range(1, self._num_players + 1):
+                self.series[player_id] = []
+                self.average[player_id] = 0.0
+            return
+        start_time = timestamps[0]
+        end_time = timestamps[-1]
+
+        time, counts = bin_commands(timestamps, types, player_ids, period_ms)
+        # All command types, in order of first appearance
+        command_types = list(dict.fromkeys(types))
+        player_counts = Counter(player_ids)
+
         for player_id in range(1, self._num_players + 1):
-            time, command_rate = collect_events(player_id, timestamped_commands, TIME_SERIES_PERIOD)
+            command_rate = command_rates(player_id, time, counts, command_types, period_ms)
             self.series[player_id] = [(t, r) for t, r in zip(time, command_rate)]
-            count = sum([1 for cmd in timestamped_commands if cmd.player_id() == player_id])
-            self.average[player_id] = float(count) * 1000.0 / (end_time - start_time)
+            if end_time > start_time:
+                self.average[player_id] = float(player_counts[player_id]) * 1000.0 / (end_time - start_time)
+            else:
+                self.average[player_id] = 0.0
 
     def serializeable(self):
         """Returns a serializable dict for this report
@@ -67,4 +153,4 @@ class ActionsRateReport(object):
         return {
             'series': self.series,
             'average': self.average
-        }
\ No newline at end of file
+        }
@@ -2,16 +2,55 @@
 import janissary.static as static
 
 class CommandSummaryReport(object):
-    def __init__(self, header_dict, timestamped_commands):
+    def __init__(self, header_dict, timestamped_commands=None):
+        """Create the report from a list of commands, or, if none are given,
+        incrementally with `on_command` and `finalize`
+        """
         self._num_players = header_dict['num_players']
         self._header_dict = header_dict
         self._player_commands = {}
         self._unassigned_commands = {}
-        for c in timestamped_commands:
-            if c.player_id() is not None:
-                self._count_player_command(c.player_id(), c.type)
-            else:
-                self._count_unassigned_command(c.type)
+        # Row of the first unassigned command of each type
+        self._unassigned_first_row = {}
+        # (row, command) of the commands counted at finalize()
+        self._pending = []
+        self._row = 0
+        if timestamped_commands is not None:
+            for c in timestamped_commands:
+                self.on_command(c)
+            self.finalize()
+
+    def on_command(self, cmd, pending=False):
+        """Count the next command
+
+        If pending is set, the player ID of the command may still change, and
+        it is only counted by `finalize`.
+        """
+        if pending:
+            self._pending.append((self._row, cmd))
+        else:
+            self._count_command(self._row, cmd.player_id(), cmd.type)
+        self._row += 1
+
+    def finalize(self):
+        """Count the pending commands, once all player IDs are known
+        """
+        for row, cmd in self._pending:
+            self._count_command(row, cmd.player_id(), cmd.type)
+        self._pending = []
+        # Keep the unassigned command types in order of first appearance
+        first_row = self._unassigned_first_row
+        self._unassigned_commands = {cmd_id: self._unassigned_commands[cmd_id]
+            for cmd_id in sorted(self._unassigned_commands, key=first_row.get)}
+
+    def _count_command(self, row, player_id, cmd_id):
+        if player_id is not None:
+            self._count_player_command(player_id, cmd_id)
+        else:
+            first_row = self._unassigned_first_row
+            if cmd_id not in first_row or row < first_row[cmd_id]:
+                first_row[cmd_id] = row
+            self._count_unassigned_command(cmd_id)
 
     def _count_player_command(self, player_id, cmd_id):
         if cmd_id not in self._player_commands:
@@ -23,6 +62,12 @@ class CommandSummaryReport(object):
             self._unassigned_commands[cmd_id] = 0
         self._unassigned_commands[cmd_id] += 1
 
+    def player_command_counts(self, player_id):
+        """Return a dict of command type ID -> number of commands issued by a player
+        """
+        return {cmd_id: counts[player_id] for cmd_id, counts in self._player_commands.items()
+            if counts.get(player_id)}
+
     def player_command_headers(self):
         """Return a list of strings which can be used as a header to table
         
@@ -0,0 +1,107 @@
+"""Encodings of the timestamped commands in the report output
+
+Two layouts are supported:
+
+Schema 1 (the default) is a list with one dict per command, as returned by
+`TimestampedCommand.serializable()`.
+
+Schema 2 (compact) is a single dict of column arrays:
+
+    {
+        "schema_version": 2,
+        "bytes_encoding": "hex",
+        "names": {"<id>": "<command name>", ...},
+        "ids": [...],
+        "times": [...],
+        "player_ids": [...],      # null where the player is unknown
+        "bytes": [...],           # omitted if bytes_encoding is "none"
+        "attributes": {
+            "<command name>": {
+                "rows": [...],    # indices into the arrays above
+                "columns": {"<attribute>": [...], ...}
+            },
+            ...
+        }
+    }
+
+A schema 1 payload is a list, and carries no version field.
+"""
+import base64
+
+from janissary.static import command_name
+
+ROWS_SCHEMA_VERSION = 1
+COLUMNS_SCHEMA_VERSION = 2
+
+BYTES_ENCODINGS = ('ints', 'hex', 'base64', 'none')
+
+def encode_bytes(data, encoding):
+    """Encode raw command bytes for JSON output
+    """
+    if encoding == 'ints':
+        return [b for b in data]
+    elif encoding == 'hex':
+        return bytes(data).hex()
+    elif encoding == 'base64':
+        return base64.b64encode(data).decode('ascii')
+    raise ValueError("Unknown bytes encoding %r" % (encoding,))
+
+def _encode_command_bytes(cmd, encoding):
+    # Commands whose bytes were dropped (see TimestampedCommand.drop_data) give None
+    if cmd.data is None:
+        return None
+    return encode_bytes(cmd.data, encoding)
+
+def serializable_command(cmd, bytes_encoding='ints'):
+    """Schema 1 dict for a command, with its bytes in the given encoding
+    """
+    r = cmd.serializable()
+    if bytes_encoding == 'none':
+        del r['bytes']
+    elif bytes_encoding != 'ints':
+        r['bytes'] = _encode_command_bytes(cmd, bytes_encoding)
+    return r
+
+def compact_commands(timestamped_commands, bytes_encoding='hex'):
+    """Return the schema 2 (columnar) payload for a sequence of commands
+    """
+    if bytes_encoding not in BYTES_ENCODINGS:
+        raise ValueError("Unknown bytes encoding %r" % (bytes_encoding,))
+    names = {}
+    ids = []
+    times = []
+    player_ids = []
+    raw = []
+    attributes = {}
+    for row, cmd in enumerate(timestamped_commands):
+        ids.append(cmd.type)
+        times.append(cmd.timestamp)
+        player_ids.append(cmd.player_id())
+        if bytes_encoding != 'none':
+            raw.append(_encode_command_bytes(cmd, bytes_encoding))
+
+        name = names.setdefault(cmd.type, command_name(cmd.type))
+        group = attributes.setdefault(name, {'rows': [], 'columns': {}})
+        columns = group['columns']
+        for key, value in cmd.attributes().items():
+            if key not in columns:
+                # Attribute first seen on this row; earlier rows didn't have it
+                columns[key] = [None] * len(group['rows'])
+            columns[key].append(value)
+        group['rows'].append(row)
+        for column in columns.values():
+            if len(column) < len(group['rows']):
+                column.append(None)
+
+    payload = {
+        'schema_version': COLUMNS_SCHEMA_VERSION,
+        'bytes_encoding': bytes_encoding,
+        'names': names,
+        'ids': ids,
+        'times': times,
+        'player_ids': player_ids,
+    }
+    if bytes_encoding != 'none':
+        payload['bytes'] = raw
+    payload['attributes'] = attributes
+    return payload
@@ -2,31 +2,101 @@ import jinja2
 import json
 import os
 
-from .report import report
+from markupsafe import Markup
 
-@jinja2.contextfunction                                                                                                                                                                                         
-def include_file(ctx, name):
-    """Create a jinja2 function for including a file without parsing it as a template
+from .report import report, write_report_json
+from janissary.profiling import stage
 
-    The standard jinja2 `include` function will attempt to parse the included 
-    file as a template, and javascript (not enclosed in a <script> tag) is not a valid
-    jinja2 template. 
+# Stands in for the report data while the template is generated, so that the
+# data can be written straight to the output in its place
+_DATA_MARKER = "\x00janissary-report-data\x00"
+
+class HtmlRenderer(object):
+    """Renders HTML report pages
+
+    The template and the javascript bundle it includes are loaded once, when
+    the renderer is created, and reused for every report.
+    """
+    def __init__(self):
+        fileDir = os.path.dirname(os.path.realpath(__file__))
+        searchpath = [os.path.join(fileDir, "templates/"), os.path.join(fileDir, "js/dist")]
+        templateLoader = jinja2.FileSystemLoader(searchpath=searchpath)
+        self._env = jinja2.Environment(loader=templateLoader)
+        self._env.globals['include_file'] = self.include_file
+        self._included = {}
+        self._template = self._env.get_template("report.html")
+
+    def include_file(self, name):
+        """Include a file without parsing it as a template
+
+        The standard jinja2 `include` function will attempt to parse the included
+        file as a template, and javascript (not enclosed in a <script> tag) is not a valid
+        jinja2 template. The file is read once.
+        """
+        if name not in self._included:
+            self._included[name] = Markup(self._env.loader.get_source(self._env, name)[0])
+        return self._included[name]
+
+    def render(self, report_data):
+        """Return the HTML page for a report dict, as returned by `report()`
+        """
+        return self.render_json(json.dumps(report_data))
+
+    def render_json(self, report_json):
+        """Return the HTML page for a report already encoded as JSON
+        """
+        with stage("render_html"):
+            return self._template.render(jsdata=report_json)
+
+    def write(self, f, header_dict, timestamped_commands, compact=False, bytes_encoding=None, consumers=None):
+        """Write the HTML page for a report to the file handle f, as it is produced
+
+        The page is generated in chunks, and the report data is encoded
+        straight into the output by `write_report_json`. Arguments are as for
+        `render_html`.
+        """
+        chunks = self._template.generate(jsdata=_DATA_MARKER)
+        with stage("render_html"):
+            before = []
+            for chunk in chunks:
+                head, marker, after = chunk.partition(_DATA_MARKER)
+                before.append(head)
+                if marker:
+                    break
+            else:
+                raise RuntimeError("The report template does not include jsdata")
+        with stage("write"):
+            f.writelines(before)
+        write_report_json(f, header_dict, timestamped_commands, compact, bytes_encoding, consumers)
+        with stage("render_html"):
+            after = [after] + list(chunks)
+        with stage("write"):
+            f.writelines(after)
+
+_default_renderer = None
+
+def default_renderer():
+    """Return the HtmlRenderer shared by `render_html` and `write_html`
     """
-    env = ctx.environment
-    return jinja2.Markup(env.loader.get_source(env, name)[0])  
+    global _default_renderer
+    if _default_renderer is None:
+        _default_renderer = HtmlRenderer()
+    return _default_renderer
 
-def render_html(header_dict, timestamped_commands):
+def render_html(header_dict, timestamped_commands, compact=False, bytes_encoding=None, consumers=None):
     """Returns HTML output for report file
 
     header_dict - A dict containing the information parsed from the header of the log file
     timestamped_commands - List of TimestampedCommand objects parsed from the body of the log file
+    compact, bytes_encoding, consumers - As for `report()`
+    """
+    report_data = report(header_dict, timestamped_commands, compact, bytes_encoding, consumers)
+    return default_renderer().render(report_data)
+
+def write_html(f, header_dict, timestamped_commands, compact=False, bytes_encoding=None, consumers=None):
+    """Write the HTML output for a report file to the file handle f
+
+    Same as writing the result of `render_html`, but the page is streamed to f
+    rather than built as one string.
     """
-    report_data = report(header_dict, timestamped_commands)
-
-    fileDir = os.path.dirname(os.path.realpath(__file__))
-    searchpath = [os.path.join(fileDir, "templates/"), os.path.join(fileDir, "js/dist")]
-    templateLoader = jinja2.FileSystemLoader(searchpath=searchpath)
-    templateEnv = jinja2.Environment(loader=templateLoader)
-    templateEnv.globals['include_file'] = include_file
-    template = templateEnv.get_template("report.html")
-    return template.render(jsdata=json.dumps(report_data))
\ No newline at end of file
+    default_renderer().write(f, header_dict, timestamped_commands, compact, bytes_encoding, consumers)
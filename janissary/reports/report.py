@@ -1,44 +1,161 @@
+import json
 from typing import List
 
 from .command_summary_report import CommandSummaryReport
 from .unit_production_report import UnitProductionReport
 from .actions_rate_report import ActionsRateReport
+from .commands_payload import compact_commands, serializable_command
 
 from janissary.body import TimestampedCommand
 import janissary.static as static
+from janissary.profiling import stage
+
+# Commands encoded together by write_report_json, to keep the per-stage overhead low
+JSON_BATCH_SIZE = 1000
     
 
-def report(header_dict, timestamped_commands: List[TimestampedCommand]):
+def decorated_player(p: dict) -> dict:
+    return {
+        'player_id': p['player_index'],
+        'name': p['name'],
+        'civilization_name': static.civilization_name(p['civ']),
+        'team': p['team']
+    }
+
+def report_header(header_dict):
+    """Return the "header" section of the report
+    """
+    return {
+        "game_attributes": [
+            ('Title', header_dict['game_title']),
+            ('Map Size', header_dict['map_size']),
+            ('Map Type', static.map_type_name(header_dict['map_id'])),
+            ('Game Type', static.game_type_name(header_dict['game_type'])),
+        ],
+        "players": [decorated_player(p) for p in header_dict['players']]
+    }
+
+def report_consumers(header_dict):
+    """Return (name, report) for each report, ready to be fed commands
+
+    Each report is an incremental consumer, with `on_command` and `finalize`
+    methods (see `janissary.body.feed_commands`).
+    """
+    return [
+        ("command_summary", CommandSummaryReport(header_dict)),
+        ("unit_production", UnitProductionReport(header_dict)),
+        ("actions_rate", ActionsRateReport(header_dict)),
+    ]
+
+def consume_commands(consumers, timestamped_commands):
+    """Feed a list of commands to the consumers from `report_consumers`, and finalize them
+    """
+    with stage("consume"):
+        for cmd in timestamped_commands:
+            for _, consumer in consumers:
+                consumer.on_command(cmd)
+    for _, consumer in consumers:
+        with stage(type(consumer).__name__):
+            consumer.finalize()
+    return consumers
+
+def report_sections(header_dict, timestamped_commands, consumers=None):
+    """Generate (name, serializable dict) for each report, one at a time
+
+    The reports are computed in a single pass over timestamped_commands. If
+    consumers (from `report_consumers`) are given, they must already have been
+    fed the commands and finalized, and timestamped_commands is not used.
+    """
+    if consumers is None:
+        consumers = consume_commands(report_consumers(header_dict), timestamped_commands)
+    for name, consumer in consumers:
+        with stage(type(consumer).__name__):
+            section = consumer.serializeable()
+        yield name, section
+
+def report(header_dict, timestamped_commands: List[TimestampedCommand], compact=False, bytes_encoding=None,
+        consumers=None):
     """Return a dict with all report outputs
     
     This dict is what gets serialized to JSON and passed to the React display
     app.
+
+    If compact is set, the commands are output as column arrays (schema 2, see
+    `commands_payload`) rather than a list of dicts. bytes_encoding is one of
+    'ints', 'hex', 'base64' or 'none', and defaults to 'ints' for the list
+    layout, and 'hex' for the compact layout.
+
+    If consumers from `report_consumers`, already fed with the commands, are
+    given, timestamped_commands may be None, and the report then has no
+    "commands".
     """
-    def decorated_player(p: dict) -> dict:
-        return {
-            'player_id': p['player_index'],
-            'name': p['name'],
-            'civilization_name': static.civilization_name(p['civ']),
-            'team': p['team']
+    with stage("report"):
+        report =  {
+            "header_raw": header_dict,
+            "header": report_header(header_dict),
+            "reports": {},
         }
+        if timestamped_commands is not None:
+            with stage("commands"):
+                report["commands"] = commands_payload(timestamped_commands, compact, bytes_encoding)
 
-    report =  {
-        "header_raw": header_dict,
-        "header": {
-            "game_attributes": [
-                ('Title', header_dict['game_title']),
-                ('Map Size', header_dict['map_size']),
-                ('Map Type', static.map_type_name(header_dict['map_id'])),
-                ('Game Type', static.game_type_name(header_dict['game_type'])),
-            ],
-            "players": [decorated_player(p) for p in header_dict['players']]
-        },
-        "reports": {},
-        "commands": [c.serializable() for c in timestamped_commands]
-    }
+        for name, section in report_sections(header_dict, timestamped_commands, consumers):
+            report["reports"][name] = section
+
+        return report
 
-    report["reports"]["command_summary"] = CommandSummaryReport(header_dict, timestamped_commands).serializeable()
-    report["reports"]["unit_production"] = UnitProductionReport(header_dict, timestamped_commands).serializeable()
-    report["reports"]["actions_rate"] = ActionsRateReport(header_dict, timestamped_commands).serializeable()
+def commands_payload(timestamped_commands, compact=False, bytes_encoding=None):
+    if compact:
+        return compact_commands(timestamped_commands, bytes_encoding or 'hex')
+    return [serializable_command(c, bytes_encoding or 'ints') for c in timestamped_commands]
 
-    return report
\ No newline at end of file
+def write_report_json(f, header_dict, timestamped_commands, compact=False, bytes_encoding=None,
+        consumers=None):
+    """Write the report as JSON to the file handle f, as it is produced
+
+    The output is identical to `json.dumps(report(...))`, but each section,
+    and each batch of JSON_BATCH_SIZE commands, is encoded and written on its
+    own, so the whole report is never held in memory. (The compact command
+    columns are encoded in one piece.) consumers are as for `report()`.
+    """
+    with stage("report"):
+        _write_json(f, header_dict, '{"header_raw": ')
+        _write_json(f, report_header(header_dict), ', "header": ')
+        f.write(', "reports": {')
+        for i, (name, section) in enumerate(report_sections(header_dict, timestamped_commands, consumers)):
+            _write_json(f, section, '%s%s: ' % (', ' if i > 0 else '', json.dumps(name)))
+        f.write('}')
+        if timestamped_commands is None:
+            f.write('}')
+            return
+        f.write(', "commands": ')
+        with stage("commands"):
+            if compact:
+                _write_json(f, commands_payload(timestamped_commands, compact, bytes_encoding))
+            else:
+                f.write('[')
+                batch = []
+                separator = ''
+                for c in timestamped_commands:
+                    batch.append(serializable_command(c, bytes_encoding or 'ints'))
+                    if len(batch) == JSON_BATCH_SIZE:
+                        _write_json(f, batch, separator, strip_brackets=True)
+                        batch = []
+                        separator = ', '
+                if batch:
+                    _write_json(f, batch, separator, strip_brackets=True)
+                f.write(']')
+        f.write('}')
+
+def _write_json(f, value, prefix='', strip_brackets=False):
+    """Encode value in the json_encode stage, and write it to f after prefix in the write stage
+
+    With strip_brackets, value is a list, and only its items are written.
+    """
+    with stage("json_encode"):
+        text = json.dumps(value)
+    if strip_brackets:
+        text = text[1:-1]
+    with stage("write"):
+        f.write(prefix)
+        f.write(text)
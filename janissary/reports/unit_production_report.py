@@ -1,9 +1,12 @@
+import itertools
 import math
 
 import janissary.body as body
 import janissary.static as static
 
 class UnitLogEntry(object):
+    __slots__ = ('player_id', 'unit_type', 'building_id', 'delta', 'timestamp')
+
     def __init__(self, player_id, unit_type, building_id, delta, timestamp):
         self.player_id = player_id
         self.unit_type = unit_type
@@ -12,7 +15,7 @@ class UnitLogEntry(object):
         self.timestamp = timestamp
 
     def serializeable(self):
-        return self.__dict__
+        return {name: getattr(self, name) for name in self.__slots__}
 
 class UnitProductionReport(object):
     """Count the number of units produced throughout the game
@@ -46,67 +49,115 @@ class UnitProductionReport(object):
     """
 
     
-    def __init__(self, header_dict, timestamped_commands):
+    def __init__(self, header_dict, timestamped_commands=None):
+        """Create the report from a list of commands, or, if none are given,
+        incrementally with `on_command` and `finalize`
+        """
         self._num_players = header_dict['num_players']
         self._header_dict = header_dict
-        self.unit_log = []
         self._type_ids = []
         
-        unique_cancel_commands = {}
-        
-        for cmd in timestamped_commands:
-            # TODO: I believe other versions of the game use the TRAIN
-            # command for this same purpose. But as I haven't tried to parse
-            # any of these, I don't support it yet. 
+        self._unique_cancel_commands = {}
+        # Every TRAIN2 entry, in order; cancelled entries are left out of unit_log at the end
+        self._ledger = []
+        self._removed = set()
+        # building_id -> indices into the ledger of the entries still standing, in order
+        self._building_entries = {}
+        self._type_id_set = set()
+        self._first_timestamp = None
+        self._last_timestamp = None
+
+        if timestamped_commands is not None:
+            for cmd in timestamped_commands:
+                self.on_command(cmd)
+            self.finalize()
+
+    def on_command(self, cmd, pending=False):
+        """Add the next command
+
+        The player IDs of the commands are not used, so pending is ignored.
+        """
+        if self._first_timestamp is None:
+            self._first_timestamp = cmd.timestamp
+        self._last_timestamp = cmd.timestamp
+
+        # TODO: I believe other versions of the game use the TRAIN
+        # command for this same purpose. But as I haven't tried to parse
+        # any of these, I don't support it yet. 
+        if isinstance(cmd, body.Train2Command):
             attr = cmd.attributes()
-            if isinstance(cmd, body.Train2Command):
-                self.unit_log.append(UnitLogEntry(
-                    attr['player_id'],
-                    attr['unit_type'],
-                    attr['building_id'],
-                    attr['count'],
-                    cmd.timestamp))
-                # Pre-compute a list of all the type IDs trained in the game
-                # TODO: Order columns more sensically, by category, or building they are produced at
-                if attr['unit_type'] not in self._type_ids:
-                    self._type_ids.append(attr['unit_type'])
-            elif isinstance(cmd, body.GarrisonCommand) and attr['garrison_type'] == 'CANCEL':
-                # Cancel the last unit produced in the specified building
-                # This is quite naive, as it could have been any unit in the 
-                # queue that was cancelled. We don't know which, but we could
-                # create a model of training time to make better guesses. 
-
-                # Empirically, it seems its possible to send multiple cancel commands in 
-                # the same timestamp, and that these duplicates are not acted upon. So 
-                # remove duplicate cancels by skipping this command if we've seen it
-                # before, and storing its hash to check later if we have not. 
-                cmd_hash = hash((attr['building_id'], cmd.timestamp))
-                if cmd_hash in unique_cancel_commands:
-                    continue
-                unique_cancel_commands[cmd_hash] = True
-
-                entry_to_update = None
-                if len(attr['selected_ids']) != 1:
-                    raise RuntimeError("CANCEL command has %d selected_ids. what do? (%s)" % attr)
-                for entry in reversed(self.unit_log):
-                    if entry.building_id == attr['selected_ids'][0]:
-                        entry_to_update = entry
-                        break
-                if entry_to_update is None:
-                    # I don't believe this is possible, so will fail loudly if it occurs
-                    #raise RuntimeError("Couldn't find corresponding TRAIN command for CANCEL: %s" % attr)
-                    print("Couldn't find corresponding TRAIN command for CANCEL: %s" % attr)
-                    continue
-                if entry_to_update.delta == 1:
-                    self.unit_log.remove(entry_to_update)
-                else:
-                    entry_to_update.delta -= 1
-
-        self.time_vector = self._compute_time_points(timestamped_commands)
+            self._building_entries.setdefault(attr['building_id'], []).append(len(self._ledger))
+            self._ledger.append(UnitLogEntry(
+                attr['player_id'],
+                attr['unit_type'],
+                attr['building_id'],
+                attr['count'],
+                cmd.timestamp))
+            # Pre-compute a list of all the type IDs trained in the game
+            # TODO: Order columns more sensically, by category, or building they are produced at
+            if attr['unit_type'] not in self._type_id_set:
+                self._type_id_set.add(attr['unit_type'])
+                self._type_ids.append(attr['unit_type'])
+        elif isinstance(cmd, body.GarrisonCommand) and cmd.attributes()['garrison_type'] == 'CANCEL':
+            attr = cmd.attributes()
+            # Cancel the last unit produced in the specified building
+            # This is quite naive, as it could have been any unit in the 
+            # queue that was cancelled. We don't know which, but we could
+            # create a model of training time to make better guesses. 
+
+            # Empirically, it seems its possible to send multiple cancel commands in 
+            # the same timestamp, and that these duplicates are not acted upon. So 
+            # remove duplicate cancels by skipping this command if we've seen it
+            # before, and storing its hash to check later if we have not. 
+            cmd_hash = hash((attr['building_id'], cmd.timestamp))
+            if cmd_hash in self._unique_cancel_commands:
+                return
+            self._unique_cancel_commands[cmd_hash] = True
+
+            if len(attr['selected_ids']) != 1:
+                raise RuntimeError("CANCEL command has %d selected_ids. what do? (%s)" % attr)
+            entries = self._building_entries.get(attr['selected_ids'][0])
+            if not entries:
+                # I don't believe this is possible, so will fail loudly if it occurs
+                #raise RuntimeError("Couldn't find corresponding TRAIN command for CANCEL: %s" % attr)
+                print("Couldn't find corresponding TRAIN command for CANCEL: %s" % attr)
+                return
+            entry_to_update = self._ledger[entries[-1]]
+            if entry_to_update.delta == 1:
+                self._removed.add(entries.pop())
+            else:
+                entry_to_update.delta -= 1
+
+    def finalize(self):
+        """Build the unit log and its indexes once all commands are added
+        """
+        self.unit_log = [entry for i, entry in enumerate(self._ledger) if i not in self._removed]
+        self._ledger = None
+        self._building_entries = None
+
+        # Index the log by player, and total the units by (player, unit type)
+        self._player_logs = {}
+        self._totals = {}
+        for entry in self.unit_log:
+            self._player_logs.setdefault(entry.player_id, []).append(entry)
+            key = (entry.player_id, entry.unit_type)
+            self._totals[key] = self._totals.get(key, 0) + entry.delta
+
+        if self._first_timestamp is None:
+            # No commands
+            self.time_vector = []
+        else:
+            self.time_vector = self._compute_time_points(self._first_timestamp, self._last_timestamp)
         
     def unit_log_for_player(self, player_id):
-        return [x for x in self.unit_log if x.player_id == player_id]
+        return list(self._player_logs.get(player_id, ()))
     
+    def unit_totals(self, player_id):
+        """Return a dict of unit type ID -> number of units produced by a player
+        """
+        return {unit_type: total for (entry_player_id, unit_type), total in self._totals.items()
+            if entry_player_id == player_id}
+
     def total_units_table_header(self):
         return ["Unit"] + [self._header_dict['players'][player_id]['name'] for player_id in range(self._num_players)]
 
@@ -120,18 +171,20 @@ class UnitProductionReport(object):
         return rows
              
     def _count_total(self, player_id=None, unit_type=None):
+        if player_id is not None and unit_type is not None:
+            return self._totals.get((player_id, unit_type), 0)
         count = 0
-        for entry in self.unit_log:
-            if (player_id is None or entry.player_id == player_id) and \
-                (unit_type is None or entry.unit_type == unit_type):
-                count += entry.delta
+        for (entry_player_id, entry_unit_type), total in self._totals.items():
+            if (player_id is None or entry_player_id == player_id) and \
+                (unit_type is None or entry_unit_type == unit_type):
+                count += total
         return count
 
     @staticmethod
-    def _compute_time_points(timestamped_commands, deltaT=60.0):
+    def _compute_time_points(first_timestamp, last_timestamp, deltaT=60.0):
         time = []
-        cur_time = round(timestamped_commands[0].timestamp * 1e-3 / 60.0) * 60.0
-        end_time = timestamped_commands[-1].timestamp * 1e-3
+        cur_time = round(first_timestamp * 1e-3 / 60.0) * 60.0
+        end_time = last_timestamp * 1e-3
         while cur_time < end_time: 
             time.append(cur_time)
             cur_time += deltaT
@@ -139,28 +192,31 @@ class UnitProductionReport(object):
     
     def _compute_player_counts(self):
         def _compute_unit_counts(player_id):
-            player_log = self.unit_log_for_player(player_id)
-            # Collect all the unit types built by this player during the game
+            player_log = self._player_logs.get(player_id, [])
+            # Collect all the unit types built by this player during the game,
+            # and the units of each type added in each period
             unit_counts = {}
+            period_deltas = {}
             for entry in player_log:
                 if entry.unit_type not in unit_counts:
                     unit_counts[entry.unit_type] = {
                         'unit_name': static.unit_name(entry.unit_type),
                         'counts': []
                     }
-            
+                    period_deltas[entry.unit_type] = [0] * len(self.time_vector)
+
             log_idx = 0
-            period_counter = { unit_id: 0 for unit_id in unit_counts.keys() }
-            for cur_time in self.time_vector:
+            for period, cur_time in enumerate(self.time_vector):
                 while log_idx < len(player_log):
                     entry = player_log[log_idx]
                     if entry.timestamp * 1e-3 > cur_time:
                         break
                     log_idx += 1
-                    period_counter[entry.unit_type] += entry.delta
+                    period_deltas[entry.unit_type][period] += entry.delta
 
-                for unit_id in unit_counts.keys(): 
-                    unit_counts[unit_id]['counts'].append(period_counter[unit_id])
+            # The series are the running totals (prefix sums) of the deltas
+            for unit_id in unit_counts.keys():
+                unit_counts[unit_id]['counts'] = list(itertools.accumulate(period_deltas[unit_id]))
             return unit_counts
 
         player_counts = {}
@@ -1,17 +1,55 @@
+import asyncio
 import click
+import cProfile
 import janissary
+import janissary.batch
 import janissary.body
+import janissary.cache
+import janissary.catalog
+import janissary.follow
+import janissary.op_index
+import janissary.player_stats
+import janissary.profiling
+import janissary.server
 import json
+import sys
 import yaml
 from tabulate import tabulate
 
 from janissary.static import command_name
+from janissary.reports.commands_payload import BYTES_ENCODINGS
 import janissary.reports
 
 
 @click.group()
-def main():
-    pass
+@click.option('--no-cache', is_flag=True, default=False, help="Don't read or write the parse cache")
+@click.option('--cache-dir', default=None, help="Parse cache directory (default: $JANISSARY_CACHE_DIR or ~/.cache/janissary)")
+@click.option('--profile', is_flag=True, default=False, help="Print wall and CPU time spent in each stage")
+@click.option('--profile-output', default=None, help="Also write cProfile stats (pstats format) to this file")
+@click.option('--parse-workers', type=int, default=None,
+    help="Decode each long recording body across this many processes")
+@click.pass_context
+def main(ctx, no_cache, cache_dir, profile, profile_output, parse_workers):
+    ctx.obj = {
+        'cache': None if no_cache else janissary.cache.ParseCache(cache_dir),
+        'parse_workers': parse_workers,
+    }
+    if profile or profile_output:
+        timer = janissary.profiling.StageTimer()
+        timer.start()
+        profiler = None
+        if profile_output:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        def print_profile():
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(profile_output)
+            timer.stop()
+            click.echo("", err=True)
+            click.echo(timer.table(), err=True)
+        ctx.call_on_close(print_profile)
 
 @main.command()
 @click.argument('gamefile')
@@ -85,21 +123,20 @@ def print_hex(data):
 def command_summary(gamefile):
     """Print some info about the commands found in the log body (debug)
     """
+    command_counts = {}
     with open(gamefile, 'rb') as f:
         rec = janissary.RecordedGame(f)
-        body = janissary.BodyParser(janissary.BinReader(rec.body_bytes()))
-    
-    command_counts = {}
-    for op in body:
-        if isinstance(op, janissary.Sync):
-            print("Sync %d" % op.time)
-        if isinstance(op, janissary.Command):
-            if op.type not in command_counts:
-                command_counts[op.type] = 0
-            command_counts[op.type] += 1
-            if op.type == 0x81:
-                print("Command %x" % op.type)
-                print_hex(op.data)
+        with rec.body_reader() as body_reader:
+            for op in janissary.BodyParser(body_reader):
+                if isinstance(op, janissary.Sync):
+                    print("Sync %d" % op.time)
+                if isinstance(op, janissary.Command):
+                    if op.type not in command_counts:
+                        command_counts[op.type] = 0
+                    command_counts[op.type] += 1
+                    if op.type == 0x81:
+                        print("Command %x" % op.type)
+                        print_hex(op.data)
 
 
     print("Cmd  | Count")
@@ -115,19 +152,78 @@ def command_summary(gamefile):
 @main.command()
 @click.argument('gamefile')
 @click.argument('outputfile')
-def command_yaml(gamefile, outputfile):
+@click.option('--type', 'command_names', multiple=True, type=click.Choice(sorted(janissary.body.COMMAND_TYPE_MAP)),
+    help="Only write commands of this type (can be repeated)")
+@click.pass_obj
+def command_yaml(obj, gamefile, outputfile, command_names):
     """Create a yaml output with commands
     """
-    with open(gamefile, 'rb') as f:
-        rec = janissary.RecordedGame(f)
-        body_reader = janissary.BinReader(rec.body_bytes())
-        commands = janissary.body.timestamped_commands(body_reader)
-    
+    if command_names:
+        # Skipping the other commands while parsing is faster than using the cache
+        command_types = {k for k in janissary.body.COMMAND_CLASSES if command_name(k) in command_names}
+        with open(gamefile, 'rb') as f:
+            rec = janissary.RecordedGame(f)
+            with rec.body_reader() as body_reader:
+                commands = janissary.body.timestamped_commands(body_reader, command_types=command_types)
+    else:
+        _, commands = janissary.cache.load_game(gamefile, obj['cache'], obj['parse_workers'])
+
     commands = [c.serializable() for c in commands]
     with open(outputfile, 'w') as f:
         yaml.dump(commands, f)
 
 
+@main.command()
+@click.argument('gamefile')
+@click.option('--rebuild', is_flag=True, default=False, help="Rebuild the index even if a valid one exists")
+@click.option('--verify', is_flag=True, default=False,
+    help="Check the hash of the log file, even if its size and modification time are unchanged")
+@click.option('--checkpoints', is_flag=True, default=False,
+    help="Also store the game state checkpoints used to parse a time window of the game")
+def index(gamefile, rebuild, verify, checkpoints):
+    """Build (or check) the sidecar op index of a log file, and print a summary
+    """
+    if rebuild:
+        op_index = janissary.op_index.OpIndex.build(gamefile)
+        op_index.save(janissary.op_index.OpIndex.sidecar_path(gamefile))
+    else:
+        op_index = janissary.op_index.OpIndex.for_recording(gamefile, verify)
+
+    duration_s = op_index.duration() // 1000
+    rows = [
+        ("Index", janissary.op_index.OpIndex.sidecar_path(gamefile)),
+        ("Ops", op_index.op_count()),
+        ("Commands", op_index.command_count()),
+        ("Syncs", op_index.sync_count()),
+        ("Duration", "%d:%02d" % (duration_s // 60, duration_s % 60)),
+    ]
+    if checkpoints:
+        # Read from the index if present, otherwise built and saved in it
+        with open(gamefile, 'rb') as f, janissary.RecordedGame(f) as rec:
+            rows.append(("Checkpoints", len(rec.context_checkpoints())))
+    print(tabulate(rows))
+
+@main.command()
+@click.argument('gamefile')
+@click.option('--interval', default=0.2, show_default=True, help="Seconds between checks for new data")
+@click.option('--idle-timeout', type=float, default=None, help="Stop once the file hasn't grown for this many seconds")
+@click.option('--skip-existing', is_flag=True, default=False, help="Don't print commands already in the file at start")
+def follow(gamefile, interval, idle_timeout, skip_existing):
+    """Print commands from a log file as they are written, one JSON object per line
+    """
+    follower = janissary.follow.RecordingFollower(gamefile)
+    if skip_existing:
+        follower.poll()
+
+    async def run():
+        async for cmd in follower.follow(interval, idle_timeout):
+            print(json.dumps(cmd.serializable()), flush=True)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
 @main.command()
 @click.argument('gamefile')
 def sync_summary(gamefile):
@@ -135,27 +231,175 @@ def sync_summary(gamefile):
     """
     with open(gamefile, 'rb') as f:
         rec = janissary.RecordedGame(f)
-        body_reader = janissary.BinReader(rec.body_bytes())
-
-    body = janissary.BodyParser(body_reader)
-    for op in body:
-        if isinstance(op, janissary.Sync):
-            print("SYNC time_delta=%d, player_id=%d" % (op.time_delta, op.player_index))
+        with rec.body_reader() as body_reader:
+            for op in janissary.BodyParser(body_reader):
+                if isinstance(op, janissary.Sync):
+                    print("SYNC time_delta=%d, player_id=%d" % (op.time_delta, op.player_index))
 
 @main.command()
 @click.argument('gamefile')
 @click.argument('outputfile')
 @click.option('--json', 'json_output_flag', is_flag=True, default=False, help="Write JSON output")
-def report(gamefile, outputfile, json_output_flag):
+@click.option('--compact', is_flag=True, default=False, help="Write the commands as column arrays")
+@click.option('--bytes', 'bytes_encoding', type=click.Choice(BYTES_ENCODINGS), default=None,
+    help="Encoding of raw command bytes (default: ints, or hex with --compact)")
+@click.option('--no-commands', is_flag=True, default=False, help="Leave the list of commands out of the report")
+@click.pass_obj
+def report(obj, gamefile, outputfile, json_output_flag, compact, bytes_encoding, no_commands):
     """Render report as HTML or JSON"""
-    with open(gamefile, 'rb') as f:
-        rec = janissary.RecordedGame(f)
-        header_dict = rec.header().header_dict()
-        body_reader = janissary.BinReader(rec.body_bytes())
-        timestamped_commands = janissary.body.timestamped_commands(body_reader)
-    
-    with open(outputfile, 'w') as f:
-        if json_output_flag:
-            f.write(json.dumps(janissary.reports.report(header_dict, timestamped_commands)))
+    janissary.batch.write_report(gamefile, outputfile, json_output_flag, obj['cache'], compact, bytes_encoding,
+        not no_commands, obj['parse_workers'])
+
+@main.command()
+@click.argument('directory')
+@click.option('--host', default="127.0.0.1", show_default=True, help="Address to listen on")
+@click.option('--port', default=8000, show_default=True, help="Port to listen on")
+@click.option('--max-games', default=janissary.server.DEFAULT_MAX_GAMES, show_default=True,
+    help="Number of parsed games kept in memory")
+@click.option('--pattern', default=janissary.batch.DEFAULT_PATTERN, show_default=True,
+    help="File name pattern of the recordings")
+@click.pass_obj
+def serve(obj, directory, host, port, max_games, pattern):
+    """Serve reports for the recordings in a directory over HTTP
+    """
+    server = janissary.server.make_server(directory, host, port, max_games, obj['cache'], pattern,
+        obj['parse_workers'])
+    print("Serving reports for %s on http://%s:%d/" % (directory, host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+@main.group()
+@click.option('--db', default=None, help="Catalog database (default: catalog.sqlite in the cache directory)")
+@click.pass_context
+def catalog(ctx, db):
+    """Build and search a catalog of recording metadata
+    """
+    ctx.obj['catalog'] = db
+
+@catalog.command('update')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--workers', '-j', type=int, default=None, help="Number of worker processes (default: one per CPU)")
+@click.option('--pattern', default=janissary.batch.DEFAULT_PATTERN, show_default=True,
+    help="File name pattern used when searching directories")
+@click.pass_obj
+def catalog_update(obj, paths, workers, pattern):
+    """Add new or changed recordings in directories or globs to the catalog
+    """
+    gamefiles = janissary.batch.find_recordings(paths, pattern)
+    def progress(gamefile, error):
+        if error is None:
+            print("OK     %s" % gamefile)
         else:
-            f.write(janissary.reports.render_html(header_dict, timestamped_commands))
+            print("FAILED %s: %s" % (gamefile, error))
+
+    with janissary.catalog.Catalog(obj['catalog']) as catalog:
+        counts = catalog.update(gamefiles, workers, progress, obj['parse_workers'])
+    print(tabulate([(k.capitalize(), v) for k, v in counts.items()]))
+
+@catalog.command('query')
+@click.option('--map', 'map_type', default=None, help="Map name, e.g. Arabia")
+@click.option('--civ', 'civilization', default=None, help="A civilization played in the game")
+@click.option('--player', default=None, help="Name of a player in the game")
+@click.option('--steam-id', type=int, default=None, help="Steam ID of a player in the game")
+@click.option('--players', 'num_players', type=int, default=None, help="Number of players")
+@click.option('--min-minutes', type=float, default=None, help="Minimum game duration")
+@click.option('--max-minutes', type=float, default=None, help="Maximum game duration")
+@click.option('--json', 'json_output_flag', is_flag=True, default=False, help="Print the games as JSON")
+@click.pass_obj
+def catalog_query(obj, map_type, civilization, player, steam_id, num_players, min_minutes, max_minutes,
+        json_output_flag):
+    """Search the catalog for games matching all of the given conditions
+    """
+    def to_ms(minutes):
+        return None if minutes is None else int(minutes * 60000)
+
+    with janissary.catalog.Catalog(obj['catalog']) as catalog:
+        games = catalog.query(map_type, civilization, player, steam_id, to_ms(min_minutes), to_ms(max_minutes),
+            num_players)
+    if json_output_flag:
+        print(json.dumps(games, indent=2))
+        return
+
+    rows = []
+    for game in games:
+        duration_s = game['duration'] // 1000
+        players = ", ".join("%s (%s)" % (p['name'], p['civilization_name']) for p in game['players'])
+        rows.append((game['path'], game['map_type'], "%d:%02d" % (duration_s // 60, duration_s % 60), players))
+    print(tabulate(rows, headers=["Recording", "Map", "Duration", "Players"]))
+    print("\n%d games" % len(games))
+
+@main.command()
+@click.argument('paths', nargs=-1)
+@click.option('--stats', 'stats_file', required=True, help="File the merged stats are read from and saved to")
+@click.option('--workers', '-j', type=int, default=None, help="Number of worker processes (default: one per CPU)")
+@click.option('--pattern', default=janissary.batch.DEFAULT_PATTERN, show_default=True,
+    help="File name pattern used when searching directories")
+@click.option('--json', 'json_output_flag', is_flag=True, default=False, help="Print the player stats as JSON")
+def player_stats(paths, stats_file, workers, pattern, json_output_flag):
+    """Merge the player stats of new recordings into a stats file, and print them
+    """
+    corpus = janissary.player_stats.CorpusStats.load(stats_file)
+    if paths:
+        def progress(gamefile, error):
+            if error is not None:
+                print("FAILED %s: %s" % (gamefile, error), file=sys.stderr)
+        counts = corpus.update(janissary.batch.find_recordings(paths, pattern), workers, progress)
+        corpus.save(stats_file)
+        print(", ".join("%s: %d" % (k.capitalize(), v) for k, v in counts.items()), file=sys.stderr)
+
+    summaries = {steam_id: stats.summary() for steam_id, stats in corpus.players.items()}
+    if json_output_flag:
+        print(json.dumps(summaries, indent=2))
+        return
+
+    def apm(value):
+        return "" if value is None else "%.1f" % value
+    rows = []
+    for steam_id, s in sorted(summaries.items(), key=lambda x: -x[1]['games']):
+        top_unit = next(iter(s['units']), "")
+        rows.append((steam_id, s['name'], s['games'], apm(s['average_apm']), apm(s['median_apm']),
+            apm(s['p90_apm']), top_unit))
+    print(tabulate(rows, headers=["Steam ID", "Name", "Games", "APM", "Median APM", "P90 APM", "Top unit"]))
+
+@main.command()
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--output-dir', '-o', required=True, help="Directory to write reports to")
+@click.option('--json', 'json_output_flag', is_flag=True, default=False, help="Write JSON output")
+@click.option('--workers', '-j', type=int, default=None, help="Number of worker processes (default: one per CPU)")
+@click.option('--pattern', default=janissary.batch.DEFAULT_PATTERN, show_default=True,
+    help="File name pattern used when searching directories")
+@click.pass_obj
+def batch_report(obj, paths, output_dir, json_output_flag, workers, pattern):
+    """Render reports for all recordings in directories or globs
+    """
+    gamefiles = janissary.batch.find_recordings(paths, pattern)
+    if len(gamefiles) == 0:
+        print("No recordings found")
+        return
+
+    print("Writing reports for %d recordings to %s..." % (len(gamefiles), output_dir))
+    def progress(result):
+        if result.ok():
+            print("OK     %s (%.2fs)" % (result.gamefile, result.elapsed))
+        else:
+            print("FAILED %s: %s" % (result.gamefile, result.error))
+
+    results, elapsed = janissary.batch.run_batch(gamefiles, output_dir, json_output_flag, workers, progress, obj['cache'],
+        obj['parse_workers'])
+
+    failures = [r for r in results if not r.ok()]
+    total_mb = sum(r.size for r in results) / 1e6
+    print("")
+    print(tabulate([
+        ("Files", len(results)),
+        ("Failures", len(failures)),
+        ("Wall time (s)", "%.2f" % elapsed),
+        ("Files/s", "%.2f" % (len(results) / elapsed)),
+        ("MB/s", "%.2f" % (total_mb / elapsed)),
+    ]))
+    if failures:
+        sys.exit(1)
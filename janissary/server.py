@@ -0,0 +1,219 @@
+"""Local HTTP server for browsing the reports of a directory of recordings
+
+    janissary serve recordings/
+
+Routes:
+    /                      - Index page listing the recordings
+    /api/games             - The same list, as JSON
+    /report?file=<path>    - HTML report of a recording (path relative to the directory)
+    /report.json?file=...  - JSON report of a recording, as written by `janissary report --json`
+
+Reports are built on first request and kept in a bounded in-memory cache.
+Concurrent requests for a report that is being built wait for it, rather than
+parsing the recording again.
+"""
+import collections
+import concurrent.futures
+import html
+import http.server
+import io
+import json
+import os
+import threading
+import urllib.parse
+
+import janissary.reports
+import janissary.static as static
+from .batch import DEFAULT_PATTERN, find_recordings, report_in_one_pass
+from .cache import load_game
+from .recorded_game import RecordedGame
+
+DEFAULT_MAX_GAMES = 16
+
+def file_key(path):
+    """Identify a version of a file, so that changed files are parsed again
+    """
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+
+def game_summary(header_dict):
+    """Return the fields of a header shown in the list of games
+    """
+    return {
+        'title': header_dict['game_title'],
+        'map_type': static.map_type_name(header_dict['map_id']),
+        'players': [{
+            'name': p['name'],
+            'civilization_name': static.civilization_name(p['civ']),
+            'team': p['team'],
+        } for p in header_dict['players']],
+    }
+
+class ReportStore(object):
+    """Builds and caches the reports of the recordings in a directory
+
+    At most max_games reports are kept, least recently used first out. If a
+    ParseCache is given, parsed recordings are also taken from or stored in it.
+    If parse_workers is given, long bodies are decoded across that many
+    processes (see `janissary.parallel`).
+    """
+    def __init__(self, directory, max_games=DEFAULT_MAX_GAMES, cache=None, pattern=DEFAULT_PATTERN,
+            parse_workers=None):
+        self.directory = os.path.realpath(directory)
+        self.max_games = max_games
+        self.cache = cache
+        self.pattern = pattern
+        self.parse_workers = parse_workers
+        self._lock = threading.Lock()
+        # file key -> report JSON text
+        self._reports = collections.OrderedDict()
+        # file key -> Future of a report being built
+        self._building = {}
+        # path -> (file key, game summary), for the recordings last listed
+        self._summaries = {}
+
+    def resolve(self, relpath):
+        """Return the full path of a recording given relative to the directory
+
+        Raises KeyError if it is not a recording inside the directory
+        """
+        path = os.path.realpath(os.path.join(self.directory, relpath))
+        if os.path.commonpath([path, self.directory]) != self.directory or not os.path.isfile(path):
+            raise KeyError(relpath)
+        return path
+
+    def games(self):
+        """Return a list of dicts describing each recording, from its header
+        """
+        games = []
+        paths = find_recordings([self.directory], self.pattern)
+        for path in paths:
+            game = {'file': os.path.relpath(path, self.directory)}
+            try:
+                game.update(self._summary(path))
+            except Exception as e:
+                game['error'] = "%s: %s" % (type(e).__name__, e)
+            games.append(game)
+        # Forget the summaries of recordings which are gone
+        with self._lock:
+            for path in set(self._summaries).difference(paths):
+                del self._summaries[path]
+        return games
+
+    def _summary(self, path):
+        key = file_key(path)
+        with self._lock:
+            cached = self._summaries.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(path, 'rb') as f:
+            summary = game_summary(RecordedGame(f).header().header_dict())
+        with self._lock:
+            self._summaries[path] = (key, summary)
+        return summary
+
+    def report_json(self, path):
+        """Return the JSON report of a recording, building it if needed
+        """
+        key = file_key(path)
+        with self._lock:
+            if key in self._reports:
+                self._reports.move_to_end(key)
+                return self._reports[key]
+            future = self._building.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._building[key] = future
+        if not owner:
+            return future.result()
+
+        try:
+            report = self._build(path)
+        except BaseException as e:
+            with self._lock:
+                del self._building[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._building[key]
+            self._reports[key] = report
+            while len(self._reports) > self.max_games:
+                self._reports.popitem(last=False)
+        future.set_result(report)
+        return report
+
+    def report_html(self, path):
+        """Return the HTML report page of a recording
+        """
+        return janissary.reports.html.default_renderer().render_json(self.report_json(path))
+
+    def _build(self, path):
+        if self.cache is None and self.parse_workers is None:
+            header_dict, timestamped_commands, consumers = report_in_one_pass(path)
+        else:
+            header_dict, timestamped_commands = load_game(path, self.cache, self.parse_workers)
+            consumers = None
+        out = io.StringIO()
+        janissary.reports.write_report_json(out, header_dict, timestamped_commands, consumers=consumers)
+        return out.getvalue()
+
+class ReportRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Set on the server: a ReportStore
+    store = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            if url.path == "/":
+                self._send(200, "text/html; charset=utf-8", self._index_page())
+            elif url.path == "/api/games":
+                self._send(200, "application/json", json.dumps(self.store.games()))
+            elif url.path in ("/report", "/report.json"):
+                try:
+                    path = self.store.resolve(query.get('file', [""])[0])
+                except KeyError:
+                    self._send(404, "text/plain", "No such recording")
+                    return
+                if url.path == "/report":
+                    self._send(200, "text/html; charset=utf-8", self.store.report_html(path))
+                else:
+                    self._send(200, "application/json", self.store.report_json(path))
+            else:
+                self._send(404, "text/plain", "Not found")
+        except Exception as e:
+            self._send(500, "text/plain", "Failed to build report: %s: %s" % (type(e).__name__, e))
+
+    def _send(self, status, content_type, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _index_page(self):
+        rows = []
+        for game in self.store.games():
+            link = "/report?" + urllib.parse.urlencode({'file': game['file']})
+            if 'error' in game:
+                players = "Unreadable header: %s" % game['error']
+            else:
+                players = ", ".join("%s (%s)" % (p['name'], p['civilization_name']) for p in game['players'])
+            rows.append("<tr><td><a href=\"%s\">%s</a></td><td>%s</td><td>%s</td></tr>" % (
+                html.escape(link), html.escape(game['file']),
+                html.escape(game.get('map_type', "")), html.escape(players)))
+        return ("<html><head><title>janissary</title></head><body>"
+            "<table><tr><th>Recording</th><th>Map</th><th>Players</th></tr>%s</table>"
+            "</body></html>" % "".join(rows))
+
+def make_server(directory, host="127.0.0.1", port=8000, max_games=DEFAULT_MAX_GAMES, cache=None,
+        pattern=DEFAULT_PATTERN, parse_workers=None):
+    """Create a threaded HTTP server for the recordings in directory
+
+    Call serve_forever() on the result to run it.
+    """
+    handler = type("Handler", (ReportRequestHandler,),
+        {'store': ReportStore(directory, max_games, cache, pattern, parse_workers)})
+    return http.server.ThreadingHTTPServer((host, port), handler)
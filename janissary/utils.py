@@ -1,13 +1,55 @@
-from io import BytesIO
+import hashlib
+import mmap
 import struct
+import zlib
+
+from .profiling import stage
 
 class EndOfData(Exception):
     pass
 
+# Precompiled little-endian layouts for the fixed size fields
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<L")
+S32 = struct.Struct("<l")
+U64 = struct.Struct("<Q")
+FLOAT = struct.Struct("<f")
+
+_STRUCT_CACHE = {}
+
+def get_struct(fmt):
+    """Return a cached, precompiled little-endian struct.Struct for fmt
+    """
+    st = _STRUCT_CACHE.get(fmt)
+    if st is None:
+        st = struct.Struct("<%s" % fmt)
+        _STRUCT_CACHE[fmt] = st
+    return st
+
+def file_hash(path):
+    """sha256 hex digest of a file's contents
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
 class BinReader(object):
     """Utility class used as a IO handle for parsers
     It look like any IO object, but with the addition of helper methods for
     concise reading of values (e.g. read_u32)
+
+    When constructed from a buffer (bytes, bytearray, memoryview or mmap), the
+    reader keeps a memoryview of it and an integer cursor, and decodes fields
+    in place with `unpack_from`, so neither the buffer nor the fields are
+    copied. Any other object is assumed to be a file-like IO object.
+
+    A reader over an mmap owns it: `close()` (or leaving a `with` block)
+    closes the mapping. IO objects are left to their owner.
     """
     def __init__(self, data, offset=0):
         """Create a new BinReader
@@ -15,57 +57,199 @@ class BinReader(object):
         offset optionally allows the derived stream to begin at the specified
         offset in data
         """
-        if isinstance(data, bytes):
-            self._data = BytesIO(data)
+        self._mmap = None
+        if isinstance(data, BUFFER_TYPES):
+            self._buf = memoryview(data)[offset:]
+            self._pos = 0
+            self._data = None
+            if isinstance(data, mmap.mmap):
+                self._mmap = data
         else: # Assume it is an IO object
+            self._buf = None
             self._data = data
         self._offset = offset
 
+    def close(self):
+        """Release the buffer, and close it if it is an mmap
+
+        The reader can't be used afterwards.
+        """
+        if self._buf is not None:
+            self._buf.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
     def seek(self, pos):
-        self._data.seek(pos + self._offset)
+        if self._buf is not None:
+            self._pos = pos
+        else:
+            self._data.seek(pos + self._offset)
 
     def tell(self):
+        if self._buf is not None:
+            return self._pos
         return self._data.tell() - self._offset
 
-    def read(self, length):
+    def size(self):
+        """Total length of the underlying buffer, or None for IO objects
+        """
+        if self._buf is not None:
+            return len(self._buf)
+        return None
+
+    def read(self, length=-1):
+        if self._buf is not None:
+            pos = self._pos
+            end = len(self._buf) if length < 0 else min(pos + length, len(self._buf))
+            self._pos = max(end, pos)
+            return self._buf[pos:end].tobytes()
         return self._data.read(length)
 
-    def read_fmt(self, fmt, size):
-        d = self._data.read(size)
-        if len(d) < size:
+    def read_exact(self, length):
+        """Like read, but raise EndOfData if fewer than length bytes are left
+        """
+        data = self.read(length)
+        if len(data) < length:
             raise EndOfData
-        return struct.unpack("<%s" % fmt, d)[0]
-    
+        return data
+
+    def skip(self, length):
+        """Advance the cursor by length bytes without reading them
+
+        For buffers, raises EndOfData (without moving) if fewer than length
+        bytes are left.
+        """
+        if self._buf is not None:
+            if self._pos + length > len(self._buf):
+                raise EndOfData
+            self._pos += length
+        else:
+            self._data.seek(length, 1)
+
+    def read_struct(self, st):
+        """Decode one precompiled struct.Struct at the cursor
+
+        Returns the full tuple of values
+        """
+        if self._buf is not None:
+            pos = self._pos
+            end = pos + st.size
+            if end > len(self._buf):
+                raise EndOfData
+            self._pos = end
+            return st.unpack_from(self._buf, pos)
+        d = self._data.read(st.size)
+        if len(d) < st.size:
+            raise EndOfData
+        return st.unpack(d)
+
+    def read_fmt(self, fmt, size):
+        return self.read_struct(get_struct(fmt))[0]
+
     def read_u8(self):
-        return self.read_fmt("B", 1)
+        return self.read_struct(U8)[0]
 
     def read_u16(self):
-        return self.read_fmt("H", 2)
-    
+        return self.read_struct(U16)[0]
+
     def read_u32(self):
-        return self.read_fmt("L", 4)
+        return self.read_struct(U32)[0]
 
     def read_s32(self):
-        return self.read_fmt("l", 4)
+        return self.read_struct(S32)[0]
 
     def read_u64(self):
-        return self.read_fmt("Q", 8)
+        return self.read_struct(U64)[0]
 
     def read_float(self):
-        return self.read_fmt("f", 4)
-    
+        return self.read_struct(FLOAT)[0]
+
     def read_string(self):
-        """Strings in the aoe2record file header are stored with a 2-byte 
+        """Strings in the aoe2record file header are stored with a 2-byte
         length, followed by the string
         """
 
         len = self.read_u16()
         strcode = self.read_u16()
-        if strcode != 0x0A60: 
+        if strcode != 0x0A60:
             print("WARNING: Got unexpected string code %04x @ pos %d" % (strcode, self.tell() - 4))
-        return self._data.read(len).decode('utf-8')
-    
+        return self.read(len).decode('utf-8')
+
     @staticmethod
     def from_bytes(data):
-        return BinReader(BytesIO(data))
-    
\ No newline at end of file
+        return BinReader(data)
+
+class InflateStream(object):
+    """Read-only IO object over raw deflate data, inflated on demand
+
+    Only as much data as has been asked for (by read or seek) is inflated.
+    Everything inflated so far is kept, so seeking backwards is free.
+    """
+    # Compressed bytes fed to the decompressor at a time, and the least
+    # output produced per call, so short reads don't inflate too far ahead
+    CHUNK_SIZE = 1024
+    MIN_OUTPUT = 4096
+
+    def __init__(self, compressed, wbits=-15):
+        self._src = memoryview(compressed)
+        self._src_pos = 0
+        self._inflater = zlib.decompressobj(wbits)
+        self._buf = bytearray()
+        self._pos = 0
+
+    def inflated_length(self):
+        """Number of bytes inflated so far
+        """
+        return len(self._buf)
+
+    def _fill(self, end):
+        """Inflate until at least `end` bytes are available, or input runs out
+        end may be None to inflate everything
+        """
+        with stage("inflate"):
+            self._inflate(end)
+
+    def _inflate(self, end):
+        while end is None or len(self._buf) < end:
+            data = self._inflater.unconsumed_tail
+            if not data:
+                if self._src_pos >= len(self._src):
+                    if not self._inflater.eof:
+                        self._buf += self._inflater.flush()
+                    break
+                data = self._src[self._src_pos:self._src_pos + self.CHUNK_SIZE]
+                self._src_pos += len(data)
+            max_length = 0 if end is None else max(end - len(self._buf), self.MIN_OUTPUT)
+            self._buf += self._inflater.decompress(data, max_length)
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            self._fill(None)
+            pos += len(self._buf)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, length=-1):
+        pos = self._pos
+        if length is None or length < 0:
+            self._fill(None)
+            end = len(self._buf)
+        else:
+            end = pos + length
+            if end > len(self._buf):
+                self._fill(end)
+            end = min(end, len(self._buf))
+        self._pos = max(end, pos)
+        return bytes(self._buf[pos:end])
@@ -1,4 +1,19 @@
+import gzip
+import json
+import mmap
+import os
 import janissary
+import janissary.body
+import janissary.cache
+import janissary.catalog
+import janissary.follow
+import janissary.op_index
+import janissary.parallel
+import janissary.recorded_game
+import janissary.utils
+import pytest
+import shutil
+import struct
 import yaml
 
 def test_header_length(datafile):
@@ -19,4 +34,317 @@ def test_header_bytes(datafile):
     assert isinstance(header_bytes, bytes)
     assert len(header_bytes) == 1036223
 
-            
\ No newline at end of file
+
+def test_body_reader_matches_body_bytes(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        from_bytes = janissary.body.timestamped_commands(janissary.BinReader(rec.body_bytes()))
+        with rec.body_reader() as body_reader:
+            from_mmap = janissary.body.timestamped_commands(body_reader)
+
+        # Closing a reader closes its mmap
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with janissary.BinReader(data, rec.header_length) as body_reader:
+            assert body_reader.read_u32() is not None
+        assert data.closed
+
+    assert len(from_mmap) == len(from_bytes)
+    assert [c.serializable() for c in from_mmap] == [c.serializable() for c in from_bytes]
+
+def test_bin_reader_buffer():
+    br = janissary.BinReader(b'\x01\x02\x03\x04\x05\x06\x07', offset=1)
+    assert br.read_u16() == 0x0302
+    assert br.read_u32() == 0x07060504
+    assert br.tell() == 6
+    br.seek(0)
+    assert br.read(2) == b'\x02\x03'
+    br.seek(5)
+    with pytest.raises(janissary.utils.EndOfData):
+        br.read_u16()
+    with pytest.raises(janissary.utils.EndOfData):
+        br.skip(2)
+    assert br.tell() == 5
+    br.skip(1)
+    assert br.read() == b''
+
+def test_header_inflated_on_demand(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        rec.header().get_version()
+        assert rec.header_stream().inflated_length() < 64 * 1024
+        rec.header().header_dict()
+        assert rec.header_stream().inflated_length() < 64 * 1024
+        assert len(rec.header_bytes()) == 1036223
+        # Already inflated data is reused by later parsers
+        assert rec.header().get_version() == ("VER 9.4", 12.5)
+
+def test_lazy_timestamped_commands(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        eager = janissary.body.timestamped_commands(rec.body_reader())
+        lazy = janissary.body.timestamped_commands(rec.body_reader(), lazy=True)
+
+    assert [c.player_id() for c in lazy] == [c.player_id() for c in eager]
+    assert [c.serializable() for c in lazy] == [c.serializable() for c in eager]
+
+def test_filtered_timestamped_commands(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        body_reader = janissary.BinReader(rec.body_bytes())
+    commands = janissary.body.timestamped_commands(body_reader)
+
+    # Train and research commands take their player from earlier selections and buildings
+    wanted = {0x81, 0x65}
+    filtered = janissary.body.timestamped_commands(body_reader, command_types=wanted)
+    assert [c.serializable() for c in filtered] == [c.serializable() for c in commands if c.type in wanted]
+
+    # Skipped syncs still count towards the time
+    full = janissary.BodyParser(body_reader)
+    ops = list(full)
+    chats = janissary.BodyParser(body_reader, op_types={janissary.body.OP_CHAT})
+    chat_types = (janissary.Chat, janissary.GameStart)
+    assert [type(op) for op in chats] == [type(op) for op in ops if isinstance(op, chat_types)]
+    assert chats.time == full.time == commands[-1].timestamp
+
+def test_parallel_timestamped_commands(datafile, monkeypatch):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        body = janissary.RecordedGame(f).body_bytes()
+    commands = janissary.body.timestamped_commands(janissary.BinReader(body))
+
+    # Enough chunks that selections and ownership carry across chunk boundaries
+    monkeypatch.setattr(janissary.parallel, 'MIN_CHUNK_BYTES', 1024)
+    assert len(janissary.parallel.chunk_boundaries(body, 16)) == 16
+    parallel = janissary.parallel.parallel_timestamped_commands(body, workers=2, chunk_count=16)
+    assert [c.player_id() for c in parallel] == [c.player_id() for c in commands]
+    assert [c.serializable() for c in parallel] == [c.serializable() for c in commands]
+
+def test_drop_command_data(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        commands = janissary.body.timestamped_commands(rec.body_reader())
+        dropped = janissary.body.timestamped_commands(rec.body_reader(), keep_data=False)
+
+    assert not hasattr(commands[0], '__dict__')
+    assert all(c.data is None for c in dropped)
+    assert [c.attributes() for c in dropped] == [c.attributes() for c in commands]
+    assert dropped[0].serializable()['bytes'] is None
+
+def test_register_command():
+    @janissary.body.register_command(0x6C)
+    class TributeCommand(janissary.body.TimestampedCommand):
+        __slots__ = ()
+        LAYOUT = janissary.body.CommandLayout("xBBBf", ('player_id', 'to_player_id', 'resource_id', 'amount'))
+
+    try:
+        data = bytes([0x6C, 1, 2, 3]) + struct.pack("<f", 100.0)
+        cmd = janissary.body.make_timestamped_command(janissary.body.Command(0x6C, data, 0),
+            janissary.body.GameContext())
+        assert isinstance(cmd, TributeCommand)
+        assert cmd.attributes() == {'player_id': 1, 'to_player_id': 2, 'resource_id': 3, 'amount': 100.0}
+        with pytest.raises(janissary.utils.EndOfData):
+            janissary.body.make_timestamped_command(janissary.body.Command(0x6C, data[:5], 0),
+                janissary.body.GameContext())
+    finally:
+        del janissary.body.COMMAND_CLASSES[0x6C]
+        del janissary.body.COMMAND_TYPE_MAP["TRIBUTE"]
+
+def test_ownership_groups():
+    ctx = janissary.body.GameContext()
+    resolved = []
+    assert ctx.lookup_player_from_objects([1, 2], resolved.append) is None
+    assert ctx.lookup_player_from_objects([2, 3], resolved.append) is None
+    assert ctx.lookup_player_from_object(1, resolved.append) is None
+    assert resolved == []
+    # Learning the owner of one object resolves every lookup on its group
+    ctx.create_unit(3, None, 4)
+    assert resolved == [4, 4, 4]
+    assert ctx.lookup_player_from_object(1) == 4
+
+    # Groups known to have different owners are not merged
+    ctx.create_unit(10, None, 1)
+    ctx.create_unit(11, None, 2)
+    ctx.lookup_player_from_objects([10, 11])
+    assert ctx.lookup_player_from_object(10) == 1
+    assert ctx.lookup_player_from_object(11) == 2
+    assert ctx._find(10) != ctx._find(11)
+
+def test_command_table(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        commands = janissary.body.timestamped_commands(rec.body_reader())
+        table = janissary.CommandTable.from_body(rec.body_reader())
+
+    assert len(table) == len(commands)
+    assert list(table.timestamps) == [c.timestamp for c in commands]
+    assert [table.player_id(i) for i in range(len(table))] == [c.player_id() for c in commands]
+    assert [c.serializable() for c in table] == [c.serializable() for c in commands]
+    for player_id in (1, 2):
+        rows = table.player_rows(player_id)
+        assert [table[i].serializable() for i in rows] == \
+            [c.serializable() for c in commands if c.player_id() == player_id]
+    assert table[-1].serializable() == commands[-1].serializable()
+
+def test_parse_cache(datafile, tmp_path):
+    cache = janissary.cache.ParseCache(str(tmp_path))
+    header_dict, commands = janissary.cache.load_game(datafile('example_v5.8.aoe2record'), cache)
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    cached_header, cached_commands = cache.load(datafile('example_v5.8.aoe2record'))
+    assert cached_header == header_dict
+    assert [c.serializable() for c in cached_commands] == [c.serializable() for c in commands]
+
+    # A cap smaller than one entry evicts everything but the newest entry
+    small_cache = janissary.cache.ParseCache(str(tmp_path), max_bytes=1)
+    small_cache.put("other", header_dict, commands[:10])
+    assert os.listdir(str(tmp_path)) == [os.path.basename(small_cache._entry_path("other"))]
+
+    # A damaged entry is a miss, and is removed
+    path = small_cache._entry_path("other")
+    with open(path, 'rb') as f:
+        data = f.read()
+    for damaged in (data[:len(data) // 2], data[:6], data[:-1], data[:8] + b"\xff" * (len(data) - 8)):
+        with open(path, 'wb') as f:
+            f.write(damaged)
+        assert small_cache.get("other") is None
+        assert not os.path.exists(path)
+
+def test_catalog(datafile, tmp_path):
+    gamefile = str(tmp_path / "game.aoe2record")
+    shutil.copy(datafile('example_v5.8.aoe2record'), gamefile)
+    with janissary.catalog.Catalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        assert catalog.update([gamefile], workers=1) == {'cataloged': 1, 'unchanged': 0, 'failed': 0, 'removed': 0}
+        assert catalog.update([gamefile], workers=1)['unchanged'] == 1
+
+        games = catalog.query(civilization="turks", min_duration=20 * 60000)
+        assert [g['path'] for g in games] == [gamefile]
+        assert [p['name'] for p in games[0]['players']] == ["Squisher", "punkkiri"]
+        assert sum(p['command_count'] for p in games[0]['players']) == 681
+        assert catalog.query(civilization="Mayans") == []
+        assert catalog.query(player="punkkiri", max_duration=20 * 60000) == []
+
+        os.remove(gamefile)
+        assert catalog.update([], workers=1)['removed'] == 1
+        assert catalog.query() == []
+
+def test_op_index(datafile, tmp_path, monkeypatch):
+    gamefile = str(tmp_path / "game.aoe2record")
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        data = f.read()
+    with open(gamefile, 'wb') as f:
+        f.write(data)
+
+    built = janissary.op_index.OpIndex.for_recording(gamefile)
+    assert os.path.exists(janissary.op_index.OpIndex.sidecar_path(gamefile))
+    index = janissary.op_index.OpIndex.load(janissary.op_index.OpIndex.sidecar_path(gamefile), gamefile)
+    assert list(index.offsets) == list(built.offsets)
+
+    with open(gamefile, 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        commands = janissary.body.timestamped_commands(rec.body_reader())
+        body_reader = rec.body_reader()
+        assert index.command_count() == len(commands)
+        assert index.duration() >= commands[-1].timestamp
+        for n in (0, 100, len(commands) - 1):
+            assert index.read_command(body_reader, n).data == commands[n].data
+            assert index.command_timestamp(n) == commands[n].timestamp
+
+    # Loading only stats the recording, unless it changed or verify is set
+    path = janissary.op_index.OpIndex.sidecar_path(gamefile)
+    def no_hash(gamefile):
+        raise AssertionError("hashed %s" % gamefile)
+    with monkeypatch.context() as m:
+        m.setattr(janissary.op_index, 'file_hash', no_hash)
+        janissary.op_index.OpIndex.load(path, gamefile)
+        with pytest.raises(AssertionError):
+            janissary.op_index.OpIndex.load(path, gamefile, verify=True)
+
+    # A recording changed in place, with its modification time kept, is only caught by verify
+    st = os.stat(gamefile)
+    with open(gamefile, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([data[-1] ^ 0xFF]))
+    os.utime(gamefile, ns=(st.st_atime_ns, st.st_mtime_ns))
+    janissary.op_index.OpIndex.load(path, gamefile)
+    with pytest.raises(janissary.op_index.InvalidIndex):
+        janissary.op_index.OpIndex.load(path, gamefile, verify=True)
+
+    # A modified recording no longer matches its index
+    with open(gamefile, 'ab') as f:
+        f.write(b'\0')
+    with pytest.raises(janissary.op_index.InvalidIndex):
+        janissary.op_index.OpIndex.load(path, gamefile)
+
+@pytest.mark.parametrize("filename", [
+    'example_v5.8.aoe2record',
+    'MP Replay v5.8 @2025.06.14 223810 (1).aoe2record',
+    'SP Replay v5.8 @2025.06.14 220844.aoe2record',
+])
+def test_player_attribution_against_baseline(datafile, filename):
+    # The player of each command as attributed before ownership groups were
+    # added. Groups may attribute more commands, but never change one.
+    with gzip.open(datafile('baseline_player_ids.json.gz')) as f:
+        baseline = json.load(f)[filename]
+    with open(datafile(filename), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        for lazy in (False, True):
+            commands = janissary.body.timestamped_commands(rec.body_reader(), lazy=lazy)
+            assert len(commands) == len(baseline)
+            changed = [(i, expected, c.player_id()) for i, (expected, c) in enumerate(zip(baseline, commands))
+                if expected is not None and c.player_id() != expected]
+            assert changed == []
+
+@pytest.mark.parametrize("filename, windows", [
+    ('example_v5.8.aoe2record', [(0, 60000), (10 * 60000, 15 * 60000), (123456, 654321)]),
+    # Commands of this window wait for owners learned after it
+    ('MP Replay v5.8 @2025.06.14 223810 (1).aoe2record', [(0, 5 * 60000), (65 * 60000, 70 * 60000)]),
+])
+def test_commands_between(datafile, tmp_path, monkeypatch, filename, windows):
+    # On a copy with a sidecar index, which the checkpoints are saved in
+    gamefile = str(tmp_path / filename)
+    shutil.copyfile(datafile(filename), gamefile)
+    janissary.op_index.OpIndex.for_recording(gamefile)
+
+    with open(gamefile, 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        commands = janissary.body.timestamped_commands(rec.body_reader())
+        assert len(rec.context_checkpoints()) > 10
+        for start_ms, end_ms in windows:
+            window = rec.commands_between(start_ms, end_ms)
+            expected = [c for c in commands if start_ms <= c.timestamp < end_ms]
+            assert len(window) > 0
+            assert [c.serializable() for c in window] == [c.serializable() for c in expected]
+
+    # Another instance reads them from the index, without a pass over the body
+    def no_pass(bin_reader, interval_ms):
+        raise AssertionError("checkpoints rebuilt")
+    monkeypatch.setattr(janissary.recorded_game, 'context_checkpoints', no_pass)
+    with open(gamefile, 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        for start_ms, end_ms in windows:
+            window = rec.commands_between(start_ms, end_ms)
+            expected = [c for c in commands if start_ms <= c.timestamp < end_ms]
+            assert [c.serializable() for c in window] == [c.serializable() for c in expected]
+
+@pytest.mark.parametrize("filename, chunk_size", [
+    ('example_v5.8.aoe2record', 4099),
+    ('MP Replay v5.8 @2025.06.14 223810 (1).aoe2record', 4099),
+    ('MP Replay v5.8 @2025.06.14 223810 (1).aoe2record', 65537),
+])
+def test_follow_growing_recording(datafile, tmp_path, filename, chunk_size):
+    with open(datafile(filename), 'rb') as f:
+        data = f.read()
+        commands = janissary.body.timestamped_commands(janissary.RecordedGame(f).body_reader())
+
+    gamefile = str(tmp_path / "live.aoe2record")
+    follower = janissary.follow.RecordingFollower(gamefile)
+    followed = []
+    with open(gamefile, 'wb') as f:
+        # Odd sized chunks, so that ops are split between writes
+        for pos in range(0, len(data), chunk_size):
+            f.write(data[pos:pos + chunk_size])
+            f.flush()
+            followed.extend(follower.poll())
+    follower.finish()
+
+    assert [(c.type, c.timestamp, c.data) for c in followed] == [(c.type, c.timestamp, c.data) for c in commands]
+    assert [c.serializable() for c in followed] == [c.serializable() for c in commands]
@@ -1,5 +1,21 @@
+import io
+import json
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.request
 import janissary
+import janissary.batch
+import janissary.body
+import janissary.parallel
+import janissary.player_stats
+import janissary.profiling
+import janissary.reports
+import janissary.server
 from janissary.reports import CommandSummaryReport
+from janissary.reports.actions_rate_report import ActionsRateReport
+from janissary.reports.commands_payload import compact_commands
 
 def test_command_summary_v58(datafile):
     with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
@@ -22,3 +38,232 @@ def test_command_summary_v58(datafile):
     # TODO: Check the unassigned values, but this is still in flux and most of them will be assigned
 
 
+
+def test_actions_rate_v58(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        timestamped_commands = janissary.body.timestamped_commands(rec.body_reader())
+        table = janissary.CommandTable.from_body(rec.body_reader())
+        header_dict = rec.header().header_dict()
+
+    report = ActionsRateReport(header_dict, timestamped_commands)
+    duration = timestamped_commands[-1].timestamp - timestamped_commands[0].timestamp
+    for player_id in (1, 2):
+        count = len([c for c in timestamped_commands if c.player_id() == player_id])
+        assert report.average[player_id] == count * 1000.0 / duration
+        assert len(report.series[player_id]) == -(-duration // 60000)
+        # Every command in a full bin is counted once
+        binned = sum(r['Total'] for _, r in report.series[player_id])
+        assert binned <= count
+
+    assert ActionsRateReport(header_dict, table).serializeable() == report.serializeable()
+    fine = ActionsRateReport(header_dict, timestamped_commands, period_ms=10000)
+    assert len(fine.series[1]) == -(-duration // 10000)
+
+def test_batch_report(datafile, tmp_path):
+    bad_file = tmp_path / "corrupt.aoe2record"
+    bad_file.write_bytes(b"not a recording")
+    gamefiles = janissary.batch.find_recordings([datafile('example_v5.8.aoe2record'), str(tmp_path)])
+    assert len(gamefiles) == 2
+
+    results, elapsed = janissary.batch.run_batch(gamefiles, str(tmp_path / "out"), json_output=True, workers=2)
+    results = {os.path.basename(r.gamefile): r for r in results}
+    assert results['example_v5.8.aoe2record'].ok()
+    assert os.path.exists(results['example_v5.8.aoe2record'].outputfile)
+    assert not results['corrupt.aoe2record'].ok()
+
+def test_stage_timer(datafile, tmp_path):
+    with janissary.profiling.StageTimer() as timer:
+        janissary.batch.write_report(datafile('example_v5.8.aoe2record'), str(tmp_path / "report.html"))
+
+    stages = [r[0] for r in timer.results()]
+    for expected in ["load", "load/header", "load/body", "report", "report/UnitProductionReport", "report/json_encode",
+            "report/commands/json_encode", "render_html", "write"]:
+        assert expected in stages
+    assert janissary.profiling.active_timer() is None
+    assert timer.total_wall >= sum(r[1] for r in timer.results() if "/" not in r[0])
+
+def test_stage_timer_per_thread():
+    # Each thread's timer only records its own stages
+    started = threading.Barrier(2)
+    timers = {}
+    def work(name):
+        with janissary.profiling.StageTimer() as timer:
+            started.wait()
+            with janissary.profiling.stage(name):
+                started.wait()
+        timers[name] = timer
+    threads = [threading.Thread(target=work, args=(name,)) for name in ("a", "b")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [r[0] for r in timers["a"].results()] == ["a"]
+    assert [r[0] for r in timers["b"].results()] == ["b"]
+    assert janissary.profiling.active_timer() is None
+
+def test_write_report_json(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        timestamped_commands = janissary.body.timestamped_commands(rec.body_reader())
+        header_dict = rec.header().header_dict()
+
+    out = io.StringIO()
+    janissary.reports.write_report_json(out, header_dict, timestamped_commands)
+    assert out.getvalue() == json.dumps(janissary.reports.report(header_dict, timestamped_commands))
+
+def test_compact_commands(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        timestamped_commands = janissary.body.timestamped_commands(rec.body_reader())
+
+    payload = compact_commands(timestamped_commands, 'hex')
+    assert payload['schema_version'] == 2
+    assert len(payload['ids']) == len(timestamped_commands)
+
+    # Rebuild each command from the columns
+    rows = [None] * len(timestamped_commands)
+    for name, group in payload['attributes'].items():
+        for i, row in enumerate(group['rows']):
+            attributes = {k: v[i] for k, v in group['columns'].items() if v[i] is not None}
+            rows[row] = (name, attributes)
+    for i, cmd in enumerate(timestamped_commands):
+        assert payload['ids'][i] == cmd.type
+        assert payload['times'][i] == cmd.timestamp
+        assert payload['player_ids'][i] == cmd.player_id()
+        assert bytes.fromhex(payload['bytes'][i]) == bytes(cmd.data)
+        assert rows[i] == (cmd.command_name(), {k: v for k, v in cmd.attributes().items() if v is not None})
+
+    assert 'bytes' not in compact_commands(timestamped_commands, 'none')
+
+def test_single_pass_report(datafile, tmp_path):
+    gamefile = datafile('example_v5.8.aoe2record')
+    with open(gamefile, 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        timestamped_commands = janissary.body.timestamped_commands(rec.body_reader())
+        header_dict = rec.header().header_dict()
+    expected = janissary.reports.report(header_dict, timestamped_commands)
+
+    header_dict, commands, consumers = janissary.batch.report_in_one_pass(gamefile, keep_commands=False)
+    assert commands is None
+    del expected['commands']
+    assert janissary.reports.report(header_dict, None, consumers=consumers) == expected
+
+    janissary.batch.write_report(gamefile, str(tmp_path / "report.json"), json_output=True)
+    with open(tmp_path / "report.json") as f:
+        assert json.load(f)['reports'] == json.loads(json.dumps(expected['reports']))
+
+def test_parse_workers_report(datafile, tmp_path, monkeypatch):
+    gamefile = datafile('example_v5.8.aoe2record')
+    janissary.batch.write_report(gamefile, str(tmp_path / "serial.json"), json_output=True)
+    # Small enough chunks that the example body is split
+    monkeypatch.setattr(janissary.parallel, 'MIN_CHUNK_BYTES', 1024)
+    janissary.batch.write_report(gamefile, str(tmp_path / "parallel.json"), json_output=True, parse_workers=2)
+    with open(tmp_path / "serial.json") as serial, open(tmp_path / "parallel.json") as parallel:
+        assert parallel.read() == serial.read()
+
+def test_write_html(datafile):
+    with open(datafile('example_v5.8.aoe2record'), 'rb') as f:
+        rec = janissary.RecordedGame(f)
+        timestamped_commands = janissary.body.timestamped_commands(rec.body_reader())
+        header_dict = rec.header().header_dict()
+
+    out = io.StringIO()
+    janissary.reports.write_html(out, header_dict, timestamped_commands)
+    assert out.getvalue() == janissary.reports.render_html(header_dict, timestamped_commands)
+
+def test_report_store(datafile, tmp_path):
+    shutil.copy(datafile('example_v5.8.aoe2record'), tmp_path / "game.aoe2record")
+    store = janissary.server.ReportStore(str(tmp_path), max_games=1)
+    builds = []
+    build = store._build
+    store._build = lambda path: builds.append(path) or build(path)
+
+    # Concurrent requests for the same recording share one parse
+    path = store.resolve("game.aoe2record")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.report_json(path))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(builds) == 1
+    assert len(set(results)) == 1
+    assert store.report_json(path) == results[0]
+    assert len(builds) == 1
+
+    # Game summaries are only kept for the recordings still listed
+    shutil.copy(datafile('example_v5.8.aoe2record'), tmp_path / "gone.aoe2record")
+    assert len(store.games()) == 2
+    assert len(store._summaries) == 2
+    os.remove(tmp_path / "gone.aoe2record")
+    assert [g['file'] for g in store.games()] == ["game.aoe2record"]
+    assert list(store._summaries) == [path]
+
+    server = janissary.server.make_server(str(tmp_path), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:%d" % server.server_address[1]
+    try:
+        with urllib.request.urlopen(base + "/api/games") as r:
+            games = json.load(r)
+        assert [g['file'] for g in games] == ["game.aoe2record"]
+        assert len(games[0]['players']) == 2
+        with urllib.request.urlopen(base + "/report.json?file=game.aoe2record") as r:
+            assert json.load(r) == json.loads(results[0])
+        with urllib.request.urlopen(base + "/report?file=game.aoe2record") as r:
+            assert b"<html" in r.read()
+        for bad in ("missing.aoe2record", "../" + os.path.basename(tmp_path)):
+            try:
+                urllib.request.urlopen(base + "/report.json?file=" + bad)
+                assert False
+            except urllib.error.HTTPError as e:
+                assert e.code == 404
+        # A KeyError while building a report is a server error, not a missing recording
+        def fail(path):
+            raise KeyError(0)
+        server.RequestHandlerClass.store._build = fail
+        shutil.copy(datafile('example_v5.8.aoe2record'), tmp_path / "other.aoe2record")
+        try:
+            urllib.request.urlopen(base + "/report.json?file=other.aoe2record")
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 500
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_player_stats(datafile, tmp_path):
+    sketch = janissary.player_stats.QuantileSketch()
+    other = janissary.player_stats.QuantileSketch()
+    for value in range(1, 51):
+        sketch.add(value)
+        other.add(value + 50)
+    sketch.merge(other)
+    assert abs(sketch.quantile(0.5) - 50) <= 1
+    assert abs(sketch.quantile(0.9) - 90) <= 1
+
+    gamefile = datafile('example_v5.8.aoe2record')
+    corpus = janissary.player_stats.CorpusStats()
+    assert corpus.update([gamefile, gamefile], workers=1) == {'added': 1, 'skipped': 0, 'failed': 0}
+    assert corpus.update([gamefile, os.path.relpath(gamefile)], workers=1)['skipped'] == 1
+    corpus.save(str(tmp_path / "stats.json"))
+    corpus = janissary.player_stats.CorpusStats.load(str(tmp_path / "stats.json"))
+
+    # The same game merged in again doubles every total
+    corpus.merge_game("copy", janissary.player_stats.reduce_game(gamefile))
+    squisher = corpus.players[76561198045460446]
+    summary = squisher.summary()
+    assert summary['name'] == "Squisher"
+    assert summary['games'] == 2
+    assert summary['units']['Peasant'] == 78
+    assert sum(summary['commands'].values()) == 2 * 391
+    assert squisher.apm.count == 2 * 26
+
+def test_player_stats_without_commands(datafile, monkeypatch):
+    # A recording without any command has no play time
+    feed_commands = janissary.body.feed_commands
+    monkeypatch.setattr(janissary.body, 'feed_commands',
+        lambda bin_reader, consumers: feed_commands(janissary.BinReader(b""), consumers))
+    players = janissary.player_stats.reduce_game(datafile('example_v5.8.aoe2record'))
+    assert [stats.play_ms for stats in players.values()] == [0, 0]
+    assert all(stats.games == 1 for stats in players.values())